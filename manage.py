@@ -3,7 +3,8 @@ import os
 import sys
 
 if __name__ == "__main__":
-    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.test_settings"
+                          if sys.argv[1:2] == ["test"] else "mysite.settings")
 
     from django.core.management import execute_from_command_line
 
@@ -0,0 +1,11 @@
+"""
+The admin, loaded on first use by mysite.urls.
+
+Registering every ModelAdmin (autodiscover) is deferred until then as well,
+see the admin entry in INSTALLED_APPS.
+"""
+from django.contrib import admin
+
+admin.autodiscover()
+
+urlpatterns = admin.site.get_urls()
@@ -32,9 +32,52 @@ DATABASES = {
         'PASSWORD': '',
         'HOST': '',                      # Empty for localhost through domain sockets or '127.0.0.1' for localhost through TCP.
         'PORT': '',                      # Set to empty string for default.
-    }
+        # Seconds a SQLite connection waits for another one's write lock.
+        'OPTIONS': {'timeout': 20},
+        # A file rather than memory, so that tests can write from threads.
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')},
+    },
+    # A read replica of 'default', used once it is listed in DATABASE_REPLICAS.
+    # Locally it is just a second connection to the same SQLite file; in tests
+    # it mirrors the test database, so reads through it only see committed rows.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'OPTIONS': {'timeout': 20},
+        'TEST': {'MIRROR': 'default'},
+    },
 }
 
+# Vote rows can be partitioned by poll over several databases, see
+# polls/sharding.py. POLLS_VOTE_SHARDS=N spreads them over N extra SQLite
+# files (run `manage.py migrate --database votesN` for each). Votes of
+# existing polls stay in 'default' until `manage.py rebalance_vote_shards`.
+def vote_shard_database(alias):
+    return {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, '%s.sqlite3' % alias),
+        'OPTIONS': {'timeout': 20},
+    }
+
+VOTE_SHARDS = ['votes%d' % i for i in range(int(os.environ.get('POLLS_VOTE_SHARDS', 0)))]
+for alias in VOTE_SHARDS:
+    DATABASES[alias] = vote_shard_database(alias)
+
+# Run on every new SQLite connection, see polls/sqlite.py. In WAL mode
+# pages are read while votes are written; synchronous=normal is safe with
+# WAL and saves an fsync per transaction.
+SQLITE_PRAGMAS = [('journal_mode', 'wal'), ('synchronous', 'normal')]
+# Times a vote or poll write is retried when SQLite reports it is locked,
+# after random delays of up to 10ms, 20ms, 40ms...
+POLLS_WRITE_RETRIES = 5
+POLLS_WRITE_RETRY_DELAY = 0.01
+
+DATABASE_ROUTERS = ['polls.routers.PrimaryReplicaRouter']
+# Aliases from DATABASES that reads are spread over. Empty: read from 'default'.
+DATABASE_REPLICAS = []
+# How long a client keeps reading from the primary after writing something.
+REPLICA_PIN_SECONDS = 15
+
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.5/ref/settings/#allowed-hosts
 ALLOWED_HOSTS = []
@@ -134,6 +177,8 @@ TEMPLATES = [
 
 
 MIDDLEWARE_CLASSES = (
+    'polls.middleware.MetricsMiddleware',
+    'polls.middleware.ReplicaPinningMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -143,6 +188,49 @@ MIDDLEWARE_CLASSES = (
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
+# Throttling of the views that write, see polls/throttling.py. Rates are
+# (requests, seconds) per user and per IP address. With more than several
+# worker processes, point CACHES at a shared cache (e.g. memcached) so the
+# limits apply to all of them together.
+POLLS_THROTTLE_USER_RATE = (10, 60)
+POLLS_THROTTLE_IP_RATE = (30, 60)
+POLLS_MAX_INFLIGHT_WRITES = 20
+
+# Upper bound on how long shared pages (index, category, results) stay in
+# the cache. They are dropped earlier when their polls change.
+POLLS_SHELL_CACHE_SECONDS = 600
+# Listings (index, category) aren't dropped when votes come in, so their
+# vote counts and the order of hot polls may be this many seconds old.
+POLLS_LISTING_CACHE_SECONDS = 60
+
+# Sitemaps at /polls/sitemap.xml list this many primary keys per chunk
+# (at most 50,000), each chunk cached until one of its polls changes.
+POLLS_SITEMAP_CHUNK_SIZE = 5000
+POLLS_SITEMAP_CACHE_SECONDS = 24 * 60 * 60
+
+# Keep the tallies of the POLLS_TALLY_POLLS hottest polls in a memory-mapped
+# file shared by all workers on this machine (see polls/tallies.py), e.g.
+# POLLS_TALLY_FILE = '/dev/shm/polls-tallies'. None disables it.
+POLLS_TALLY_FILE = None
+POLLS_TALLY_POLLS = 20
+POLLS_TALLY_REFRESH = 60
+# Slots of the table; at most half of them are filled, so it should be
+# over twice the number of choices of POLLS_TALLY_POLLS polls, plus one
+# per poll.
+POLLS_TALLY_SLOTS = 4096
+
+# New polls whose question has at least this share of trigrams in common
+# with a public poll are held back until the user confirms, see
+# polls/duplicates.py.
+POLLS_DUPLICATE_THRESHOLD = 0.5
+
+# Metrics at /polls/metrics, for Prometheus scrapers from INTERNAL_IPS (and
+# staff). Set POLLS_METRICS_FILE, e.g. '/dev/shm/polls-metrics', to add up
+# the metrics of all workers on this machine; None keeps them per process.
+POLLS_METRICS_FILE = None
+POLLS_METRICS_SLOTS = 1024
+INTERNAL_IPS = ['127.0.0.1']
+
 ROOT_URLCONF = 'mysite.urls'
 
 # Python dotted path to the WSGI application used by Django's runserver.
@@ -157,7 +245,9 @@ INSTALLED_APPS = (
     'django.contrib.messages',
     'django.contrib.staticfiles',
     # Uncomment the next line to enable the admin:
-    'django.contrib.admin',
+    # (SimpleAdminConfig doesn't import every admin.py at startup, that's
+    # done by mysite/admin_urls.py when the admin is first visited.)
+    'django.contrib.admin.apps.SimpleAdminConfig',
     # Uncomment the next line to enable admin documentation:
     # 'django.contrib.admindocs',
     'polls',
@@ -167,7 +257,11 @@ INSTALLED_APPS = (
 )
 
 ACCOUNT_ACTIVATION_DAYS = 2
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# Mail is only queued in EMAIL_OUTBOX_DIR while serving requests; run
+# `manage.py send_queued_mail` to deliver it through EMAIL_DELIVERY_BACKEND.
+EMAIL_BACKEND = 'polls.mail.OutboxEmailBackend'
+EMAIL_DELIVERY_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+EMAIL_OUTBOX_DIR = os.path.join(BASE_DIR, 'outbox')
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
@@ -0,0 +1,6 @@
+# Settings for `manage.py test`, which uses them unless told otherwise.
+from .settings import *  # noqa
+
+# The tests of sharding need two vote shards, whether used by the others or not.
+for alias in ('votes0', 'votes1'):
+    DATABASES.setdefault(alias, vote_shard_database(alias))
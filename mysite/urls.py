@@ -1,12 +1,19 @@
-from django.conf.urls import patterns, include, url
-from django.contrib import admin
+from django.conf.urls import include, url
+
+
+def lazy_include(module, namespace):
+    """
+    Like include(), but the URLconf is only imported when a URL inside it
+    is first resolved or reversed. Only namespaced includes stay lazy:
+    reversing a name without namespace has to look into every include.
+    """
+    return (module, namespace, namespace)
 
-admin.autodiscover()
 
 urlpatterns = [
     url(r'^polls/', include('polls.urls', namespace="polls")),
     url(r'^accounts/', include('registration.backends.default.urls')),
     url('^', include('django.contrib.auth.urls')),
     url(r'^comments/', include('django_comments.urls')),
-    url(r'^admin/', include(admin.site.urls)),
+    url(r'^admin/', lazy_include('mysite.admin_urls', 'admin')),
     ]
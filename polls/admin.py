@@ -1,10 +1,17 @@
 from mptt.admin import MPTTModelAdmin
 
+from django import forms
+from django.conf.urls import url
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied, ValidationError
 from django.core.urlresolvers import reverse
+from django.http import HttpResponseRedirect
+from django.template.response import TemplateResponse
 from django.utils.html import format_html
 
-from .models import Choice, Poll, Vote, PollCategory
+from .models import ArchivedVote, Ballot, Choice, Poll, Vote, PollCategory, Survey
+from .search import search_polls
+from .categories import import_categories, rebuild_tree, check_tree
 
 
 class ChoiceInline(admin.TabularInline):
@@ -15,16 +22,17 @@ class ChoiceInline(admin.TabularInline):
 class PollAdmin(admin.ModelAdmin):
     fieldsets = [
         (None, {
-            'fields': ['question', 'category', 'created_by',],
+            'fields': ['question', 'category', 'created_by', 'ranked'],
         }),
         ('Date information', {
-            'fields': ['pub_date'],
+            'fields': ['pub_date', 'closes_at'],
             'classes': ['collapse'],
         }),
     ]
     inlines = [ChoiceInline]
-    list_display = ('question', 'pub_date', 'category_link', 'num_voters', 'was_published_recently')
-    list_filter = ['pub_date']
+    list_display = ('question', 'pub_date', 'category_link', 'num_voters', 'was_published_recently', 'deletion_status')
+    list_filter = ['pub_date', 'deleted_at']
+    actions = ['delete_in_background']
     search_fields = ['question']
     date_hierarchy = 'pub_date'
 
@@ -34,8 +42,86 @@ class PollAdmin(admin.ModelAdmin):
 
     category_link.allow_tags = True
 
+    def get_actions(self, request):
+        # The stock action cascades over every vote within the request.
+        actions = super(PollAdmin, self).get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def delete_model(self, request, obj):
+        # Deleting from the change page, the same way as the action.
+        obj.mark_deleted()
+
+    def delete_in_background(self, request, queryset):
+        for poll in queryset:
+            poll.mark_deleted()
+        self.message_user(request, '%d polls hidden, they will be purged by '
+                          'purge_deleted_polls.' % len(queryset))
+
+    delete_in_background.short_description = 'Delete selected polls in the background'
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        return search_polls(search_term, queryset), False
+
+
+class CategoryImportForm(forms.Form):
+    paths = forms.CharField(
+            widget=forms.Textarea(attrs={'rows': 20, 'cols': 80}),
+            help_text='One category per line, with its parents: "Science > Physics".')
+
+
+class PollCategoryAdmin(MPTTModelAdmin):
+    change_list_template = 'admin/polls/pollcategory/change_list.html'
+    actions = ['rebuild_category_tree']
+
+    def get_urls(self):
+        return [
+            url(r'^import/$', self.admin_site.admin_view(self.import_view),
+                name='polls_pollcategory_import'),
+        ] + super(PollCategoryAdmin, self).get_urls()
+
+    def import_view(self, request):
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        form = CategoryImportForm(request.POST or None)
+        if form.is_valid():
+            try:
+                created = import_categories(form.cleaned_data['paths'].splitlines())
+            except ValidationError as e:
+                for number, errors in sorted(e.message_dict.items()):
+                    for error in errors:
+                        form.add_error('paths', u'Line {0}: {1}'.format(number, error))
+            else:
+                self.message_user(request, '%d categories created.' % created)
+                return HttpResponseRedirect(reverse('admin:polls_pollcategory_changelist'))
+        context = dict(self.admin_site.each_context(request),
+                       form=form, opts=self.model._meta, title='Import categories')
+        return TemplateResponse(request, 'admin/polls/pollcategory/import.html', context)
+
+    def rebuild_category_tree(self, request, queryset):
+        # The whole table is rebuilt whatever the selection.
+        updated = rebuild_tree()
+        problems = check_tree()
+        if problems:
+            self.message_user(request, ' '.join(problems), level='error')
+        else:
+            self.message_user(request, 'Tree rebuilt, %d categories moved.' % updated)
+
+    rebuild_category_tree.short_description = 'Rebuild and check the category tree'
+
+
+class SurveyAdmin(admin.ModelAdmin):
+    list_display = ('title', 'pub_date', 'created_by')
+    filter_horizontal = ['polls']
+    raw_id_fields = ['created_by']
+
 
 admin.site.register(Poll, PollAdmin)
 admin.site.register(Choice)
 admin.site.register(Vote)
-admin.site.register(PollCategory, MPTTModelAdmin)
+admin.site.register(ArchivedVote)
+admin.site.register(Ballot)
+admin.site.register(PollCategory, PollCategoryAdmin)
+admin.site.register(Survey, SurveyAdmin)
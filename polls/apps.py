@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class PollsConfig(AppConfig):
+    name = 'polls'
+
+    def ready(self):
+        # Connect the signal handlers keeping the search and trigram indexes,
+        # the vote shards and cached pages in sync, and setting up SQLite
+        # connections.
+        from . import search, duplicates, sharding, caching, sqlite
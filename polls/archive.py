@@ -0,0 +1,79 @@
+'''
+Moving the votes of inactive polls out of the Vote table.
+
+A poll is inactive once it closed or nobody voted in it for a while: a
+hot_score below the weight of a single vote cast at the cutoff means no
+vote came in since. Its votes are moved to ArchivedVote, which lives in
+the default database even when the votes are on a shard, in batches of
+bounded size. Each batch adds its tallies to Choice.archived_votes and
+Poll.archived_voters in the same transaction, so results, voter counts
+and the "already voted" checks of Poll see archived votes without
+reading them for every view. Votes are saved after check_not_archived(),
+as no index spans both tables.
+
+Ranked polls are left alone, their ballots are a table of their own.
+'''
+import datetime
+import time
+from collections import Counter
+
+from django.db import IntegrityError, router, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import ArchivedVote, Choice, Poll, Vote, hot_weight
+from .sharding import vote_alias
+
+
+def inactive_polls(days):
+    '''
+    Live polls that closed or got no vote in the last `days` days. Polls
+    without a hot_score got no vote through register_vote(), e.g. all
+    their votes are older than the score itself.
+    '''
+    now = timezone.now()
+    cutoff = hot_weight(now - datetime.timedelta(days=days))
+    return Poll.objects.live().filter(ranked=False).filter(
+            Q(closes_at__lte=now) | Q(hot_score__lt=cutoff) | Q(hot_score__isnull=True))
+
+
+def check_not_archived(user_pk, poll_pks):
+    '''
+    Raise IntegrityError if the user has an archived vote in one of the
+    polls. Call it in the transaction saving the user's votes, since a
+    poll's archived_voters may have been read before its votes moved.
+    '''
+    archived = ArchivedVote.objects.using(router.db_for_write(ArchivedVote))
+    if archived.filter(user_id=user_pk, poll_id__in=poll_pks).exists():
+        raise IntegrityError('The user has an archived vote in one of the polls.')
+
+
+def archive_poll(poll, batch_size=1000, pause=0, progress=None):
+    '''
+    Move all votes of `poll` to ArchivedVote. `progress`, if given, is
+    called with the number of votes moved after every batch.
+    '''
+    alias = vote_alias(poll.vote_shard)
+    votes = poll.votes().using(alias).order_by('pk')
+    while True:
+        # Both databases commit together, unless a shard fails in between.
+        with transaction.atomic(), transaction.atomic(using=alias):
+            batch = list(votes.values_list('pk', 'choice_id', 'user_id')[:batch_size])
+            if batch:
+                ArchivedVote.objects.bulk_create(
+                        ArchivedVote(poll_id=poll.pk, choice_id=choice_id, user_id=user_id)
+                        for pk, choice_id, user_id in batch)
+                counts = Counter(choice_id for pk, choice_id, user_id in batch)
+                for choice_id, count in counts.items():
+                    Choice.objects.filter(pk=choice_id).update(
+                            archived_votes=F('archived_votes') + count)
+                Poll.objects.filter(pk=poll.pk).update(
+                        archived_voters=F('archived_voters') + len(batch))
+                Vote.objects.using(alias).filter(pk__in=[row[0] for row in batch]).delete()
+        if not batch:
+            break
+        poll.archived_voters += len(batch)
+        if progress is not None:
+            progress(len(batch))
+        if pause:
+            time.sleep(pause)
@@ -0,0 +1,149 @@
+'''
+Creating many polls at once.
+
+Polls are described by dicts like::
+
+    {"question": "Cats or dogs?", "category": "Pets",
+     "choices": ["Cats", "Dogs"], "pub_date": "2016-03-01T12:00:00Z"}
+
+where category is a PollCategory name or primary key and pub_date is
+optional. All polls are validated before anything is written, and then
+everything is inserted in one transaction with a few bulk queries. On
+SQLite, which doesn't report the primary keys of bulk inserts, they are
+read with last_insert_rowid() after every batch. No signals are sent for
+the new polls: they are indexed and the caches bumped once at the end.
+'''
+import random
+
+from django.core.exceptions import ValidationError
+from django.db import connections, models, router, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Poll, Choice, PollCategory, vote_shards
+from .search import index_polls
+from .duplicates import index_questions
+from .caching import bump_version, reschedule_publications, sitemap_key
+from .sqlite import retry_on_lock
+
+
+def _text(value, what, errors):
+    if not isinstance(value, basestring) or not value.strip():
+        errors.append(u'{0} must be a non-empty string.'.format(what))
+    elif len(value) > 200:
+        errors.append(u'{0} is longer than 200 characters.'.format(what))
+    else:
+        return value.strip()
+
+
+def clean_poll(data, categories):
+    '''
+    Return (poll fields, choice texts, errors) for one poll description.
+    `categories` maps both names and primary keys to PollCategory objects.
+    '''
+    errors = []
+    if not isinstance(data, dict):
+        return None, None, [u'A poll must be an object.']
+
+    fields = {'question': _text(data.get('question'), u'Question', errors)}
+    category = data.get('category')
+    if isinstance(category, bool) or not isinstance(category, (basestring, int, long)):
+        errors.append(u'Category must be a name or a primary key.')
+        category = None
+    elif category not in categories:
+        errors.append(u'Unknown category: {0}.'.format(category))
+    fields['category'] = categories.get(category)
+
+    if data.get('pub_date') is not None:
+        try:
+            pub_date = parse_datetime(data['pub_date'])
+        except (TypeError, ValueError):
+            pub_date = None
+        if pub_date is None:
+            errors.append(u'Invalid pub_date: {0}.'.format(data['pub_date']))
+        elif timezone.is_naive(pub_date):
+            pub_date = timezone.make_aware(pub_date)
+        fields['pub_date'] = pub_date
+
+    choices = data.get('choices', [])
+    if not isinstance(choices, list):
+        errors.append(u'Choices must be a list.')
+        choices = []
+    choices = [_text(text, u'Choice', errors) for text in choices]
+    if len(set(choices)) != len(choices):
+        errors.append(u'Choices must be unique.')
+    return fields, choices, errors
+
+
+def insert_polls(polls):
+    '''
+    Insert `polls` without sending signals and set their primary keys.
+    Call it in a transaction.
+    '''
+    using = router.db_for_write(Poll)
+    connection = connections[using]
+    # Set by Django 1.10 and later for backends like PostgreSQL.
+    if getattr(connection.features, 'can_return_ids_from_bulk_insert', False):
+        Poll.objects.using(using).bulk_create(polls)
+    elif connection.vendor == 'sqlite':
+        # Each batch is one INSERT, and nobody else writes before the
+        # transaction ends, so its rows are numbered in order up to
+        # last_insert_rowid().
+        fields = [f for f in Poll._meta.concrete_fields if not isinstance(f, models.AutoField)]
+        batch_size = connection.ops.bulk_batch_size(fields, polls)
+        for start in range(0, len(polls), batch_size):
+            batch = polls[start:start + batch_size]
+            Poll.objects.using(using).bulk_create(batch, batch_size=len(batch))
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT last_insert_rowid()')
+                last = cursor.fetchone()[0]
+            for pk, poll in enumerate(batch, last - len(batch) + 1):
+                poll.pk = pk
+    else:
+        for poll in polls:
+            poll.pk = Poll.objects.using(using)._insert(
+                    [poll], fields=[f for f in Poll._meta.local_concrete_fields
+                                    if not isinstance(f, models.AutoField)],
+                    return_id=True)
+
+
+@retry_on_lock
+@transaction.atomic
+def create_polls(polls, user):
+    '''
+    Create polls owned by `user` from a list of poll descriptions and
+    return their primary keys. Raise ValidationError with a dict of error
+    lists keyed by the position of the offending polls if any is invalid.
+    '''
+    if not isinstance(polls, list):
+        raise ValidationError({'polls': [u'Expected a list of polls.']})
+    categories = {}
+    for category in PollCategory.objects.all():
+        categories[category.pk] = categories[category.name] = category
+
+    cleaned, errors = [], {}
+    for position, data in enumerate(polls):
+        fields, choices, poll_errors = clean_poll(data, categories)
+        if poll_errors:
+            errors[position] = poll_errors
+        cleaned.append((fields, choices))
+    if errors:
+        raise ValidationError(errors)
+
+    shards = vote_shards()
+    objects = [Poll(created_by=user,
+                    vote_shard=random.choice(shards) if shards else '',
+                    **fields)
+               for fields, choices in cleaned]
+    insert_polls(objects)
+
+    Choice.objects.bulk_create(
+            Choice(poll_id=poll.pk, choice_text=text)
+            for poll, (fields, choices) in zip(objects, cleaned)
+            for text in choices)
+    pks = [poll.pk for poll in objects]
+    index_polls(pks)
+    index_questions(pks)
+    bump_version('polls', *set(sitemap_key('polls', pk) for pk in pks))
+    reschedule_publications()
+    return pks
@@ -0,0 +1,181 @@
+'''
+Caching of the pages everybody sees the same.
+
+Cached pages are keyed by version counters: 'poll:<pk>' for everything
+shown about one poll and 'polls' for listings. The counters are bumped
+whenever polls, choices, votes or comments change, which makes every page
+built from older data unreachable at once; votes only bump 'poll:<pk>',
+and listings catch up with them within POLLS_LISTING_CACHE_SECONDS.
+
+Listings also change when a poll scheduled for the future goes live or a
+poll closes, without anything being saved. The time of the next such
+event is kept in the cache, and the first request after it bumps 'polls'
+and 'publications'.
+
+With read replicas, only pages read from the primary are cached, since a
+replica may not have the changes a version was bumped for yet. Requests
+pinned to the primary (see polls.routers) render the page anew rather
+than use a cached copy, so that users always see their own writes.
+
+Sitemaps are cached in chunks of POLLS_SITEMAP_CHUNK_SIZE primary keys,
+each with a counter of its own (see sitemap_key()), so that votes and new
+polls leave all but the last chunk alone.
+'''
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils import timezone
+
+from django_comments.signals import comment_was_posted
+
+from .charts import chart_key
+from .routers import is_pinned
+
+
+def _new_version():
+    # Never reuse numbers handed out before the counter was evicted.
+    return int(time.time() * 1000)
+
+
+def get_version(key):
+    value = cache.get('version:' + key)
+    if value is None:
+        value = _new_version()
+        if not cache.add('version:' + key, value, None):
+            value = cache.get('version:' + key, value)
+    return value
+
+
+def bump_version(*keys):
+    for key in keys:
+        try:
+            cache.incr('version:' + key)
+        except ValueError:
+            cache.set('version:' + key, _new_version(), None)
+
+
+NEXT_PUBLICATION_KEY = 'polls:next_publication'
+NEVER = 'never'
+
+
+def reschedule_publications():
+    '''Forget the next publication time, e.g. because a pub_date changed.'''
+    cache.delete(NEXT_PUBLICATION_KEY)
+
+
+def check_publications():
+    '''
+    Bump the 'polls' version if a scheduled poll went live or a poll closed
+    since the last call. Costs one cache read, plus two queries after each
+    such event.
+    '''
+    from .models import Poll
+
+    now = timezone.now()
+    next_publication = cache.get(NEXT_PUBLICATION_KEY)
+    if next_publication is not None:
+        if next_publication == NEVER or next_publication > now:
+            return
+        bump_version('polls', 'publications')
+    polls = Poll.objects.live()
+    events = [
+        polls.filter(pub_date__gt=now).order_by('pub_date').values_list(
+                'pub_date', flat=True).first(),
+        polls.filter(closes_at__gt=now).order_by('closes_at').values_list(
+                'closes_at', flat=True).first(),
+    ]
+    events = [when for when in events if when is not None]
+    cache.set(NEXT_PUBLICATION_KEY, min(events) if events else NEVER, None)
+
+
+def sitemap_key(section, pk):
+    '''Version key of the chunk of sitemap `section` listing the object with `pk`.'''
+    size = getattr(settings, 'POLLS_SITEMAP_CHUNK_SIZE', 5000)
+    return 'sitemap:{0}:{1}'.format(section, (pk - 1) // size)
+
+
+def cache_shell(*version_keys, **options):
+    '''
+    Cache GET responses of a view that doesn't depend on who is asking,
+    per path and query string. `version_keys` may use the view's keyword
+    arguments, e.g. 'poll:{pk}'. The `timeout_setting` option names the
+    setting holding how many seconds responses are kept (default:
+    POLLS_SHELL_CACHE_SECONDS).
+    '''
+    timeout_setting = options.get('timeout_setting', 'POLLS_SHELL_CACHE_SECONDS')
+
+    def decorator(view):
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if request.method != 'GET':
+                return view(request, *args, **kwargs)
+            replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+            keys = [key.format(**kwargs) for key in version_keys]
+            if 'polls' in keys:
+                check_publications()
+            cache_key = 'shell:{0}:{1}'.format(
+                    hashlib.md5(request.get_full_path().encode('utf-8')).hexdigest(),
+                    ':'.join(str(get_version(key)) for key in keys))
+            cached = None if replicas and is_pinned() else cache.get(cache_key)
+            if cached is not None:
+                content, headers = cached
+                response = HttpResponse(content)
+                for header, value in headers:
+                    response[header] = value
+                return response
+
+            response = view(request, *args, **kwargs)
+            if callable(getattr(response, 'render', None)):
+                response = response.render()
+            if response.status_code == 200 and (not replicas or is_pinned()):
+                cache.set(cache_key, (response.content, response.items()),
+                          getattr(settings, timeout_setting, 600))
+            return response
+        return wrapped
+    return decorator
+
+
+@receiver(post_save, sender='polls.Poll', dispatch_uid='polls_caching_poll_saved')
+@receiver(post_delete, sender='polls.Poll', dispatch_uid='polls_caching_poll_deleted')
+def poll_changed(sender, instance, **kwargs):
+    bump_version('poll:{0}'.format(instance.pk), 'polls', sitemap_key('polls', instance.pk))
+    reschedule_publications()
+
+
+@receiver(post_save, sender='polls.Choice', dispatch_uid='polls_caching_choice_saved')
+@receiver(post_delete, sender='polls.Choice', dispatch_uid='polls_caching_choice_deleted')
+def choice_changed(sender, instance, **kwargs):
+    bump_version('poll:{0}'.format(instance.poll_id), 'polls')
+    cache.delete(chart_key(instance.poll_id))
+
+
+# Deleted votes and ballots are not tracked: a post_delete receiver would stop Django
+# from deleting votes in bulk. Votes are only deleted along with polls.
+# Votes leave 'polls' alone, or a busy poll would empty the cache of the
+# listings all the time: they are kept for POLLS_LISTING_CACHE_SECONDS.
+@receiver(post_save, sender='polls.Vote', dispatch_uid='polls_caching_vote_saved')
+def vote_saved(sender, instance, **kwargs):
+    bump_version('poll:{0}'.format(instance.poll_id))
+
+
+@receiver(post_save, sender='polls.Ballot', dispatch_uid='polls_caching_ballot_saved')
+def ballot_saved(sender, instance, **kwargs):
+    bump_version('poll:{0}'.format(instance.poll_id))
+
+
+@receiver(post_save, sender='polls.PollCategory', dispatch_uid='polls_caching_category_saved')
+@receiver(post_delete, sender='polls.PollCategory', dispatch_uid='polls_caching_category_deleted')
+def category_changed(sender, instance, **kwargs):
+    bump_version('polls', sitemap_key('categories', instance.pk))
+
+
+@receiver(comment_was_posted, dispatch_uid='polls_caching_comment_posted')
+def comment_posted(sender, comment, **kwargs):
+    if comment.content_type.app_label == 'polls':
+        bump_version('poll:{0}'.format(comment.object_pk))
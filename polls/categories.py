@@ -0,0 +1,163 @@
+'''
+Importing many poll categories at once.
+
+Saving a PollCategory renumbers lft/rght of the nodes after it, so loading
+thousands of categories one by one rewrites the table thousands of times.
+Here categories are given as paths, one per line::
+
+    Science > Physics > Optics
+
+New categories are inserted level by level with bulk_create, leaving the
+tree fields alone. Then the nested set of all categories is computed in
+memory in one pass, only changed rows are written, and the result is
+checked, all in one transaction.
+'''
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from .models import PollCategory
+from .caching import bump_version, sitemap_key
+
+
+SEPARATOR = '>'
+MAX_NAME_LENGTH = PollCategory._meta.get_field('name').max_length
+
+
+def parse_paths(lines):
+    '''
+    Return ({name: parent name or None}, {name: line number}, errors) for
+    the category paths in `lines`, errors being keyed by line number. Blank
+    lines and lines starting with # are skipped.
+    '''
+    parents, lines_of, errors = {}, {}, {}
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        names = [name.strip() for name in line.split(SEPARATOR)]
+        if not all(names) or max(len(name) for name in names) > MAX_NAME_LENGTH:
+            errors[number] = [u'Names must be 1 to {0} characters long.'.format(MAX_NAME_LENGTH)]
+            continue
+        parent = None
+        for name in names:
+            if parents.get(name, parent) != parent:
+                errors[number] = [u'"{0}" is already under "{1}".'.format(name, parents[name])]
+                break
+            parents[name] = parent
+            lines_of.setdefault(name, number)
+            parent = name
+    return parents, lines_of, errors
+
+
+def tree_fields(rows):
+    '''
+    Return {pk: (lft, rght, tree_id, level)} for `rows` of (pk, parent pk,
+    name), ordering siblings and trees by name like order_insertion_by.
+    '''
+    children = {}
+    for row in sorted(rows, key=lambda row: row[2]):
+        children.setdefault(row[1], []).append(row[0])
+    fields = {}
+    for tree_id, root in enumerate(children.get(None, []), 1):
+        position, lefts = 1, {}
+        stack = [(root, 0, True)]
+        while stack:  # Not recursive: trees may be deeper than the stack.
+            pk, level, entering = stack.pop()
+            if entering:
+                lefts[pk] = position
+                stack.append((pk, level, False))
+                stack.extend((child, level + 1, True)
+                             for child in reversed(children.get(pk, [])))
+            else:
+                fields[pk] = (lefts.pop(pk), position, tree_id, level)
+            position += 1
+    return fields
+
+
+def rebuild_tree():
+    '''Recompute the tree fields of all categories, return the number of rows updated.'''
+    rows = list(PollCategory.objects.values_list(
+            'pk', 'parent_id', 'name', 'lft', 'rght', 'tree_id', 'level'))
+    fields = tree_fields([row[:3] for row in rows])
+    updated = 0
+    for row in rows:
+        new = fields.get(row[0])
+        # Nodes in a parent cycle are left alone for check_tree() to report.
+        if new is not None and new != tuple(row[3:]):
+            lft, rght, tree_id, level = new
+            PollCategory.objects.filter(pk=row[0]).update(
+                    lft=lft, rght=rght, tree_id=tree_id, level=level)
+            updated += 1
+    return updated
+
+
+def check_tree():
+    '''Return a list of the problems found in the tree fields of the categories.'''
+    errors = []
+    rows = PollCategory.objects.order_by('tree_id', 'lft').values_list(
+            'pk', 'parent_id', 'lft', 'rght', 'tree_id', 'level')
+    ancestors, tree, sizes = [], None, {}
+    for pk, parent_id, lft, rght, tree_id, level in rows:
+        if tree_id != tree:
+            tree, ancestors = tree_id, []
+            if lft != 1 or parent_id is not None:
+                errors.append(u'Tree {0} does not start with a root.'.format(tree_id))
+            sizes[tree_id] = [rght, 0]
+        sizes[tree_id][1] += 1
+        while ancestors and ancestors[-1][1] < lft:
+            ancestors.pop()
+        parent = ancestors[-1] if ancestors else None
+        if (parent_id != (parent and parent[0]) or level != len(ancestors)
+                or rght <= lft or (parent and rght >= parent[1])):
+            errors.append(u'Category {0} is misplaced in the tree.'.format(pk))
+        ancestors.append((pk, rght))
+    for tree_id, (root_rght, size) in sorted(sizes.items()):
+        if root_rght != 2 * size:
+            errors.append(u'Tree {0} has gaps.'.format(tree_id))
+    return errors
+
+
+@transaction.atomic
+def import_categories(lines):
+    '''
+    Create the categories along the paths in `lines` that don't exist yet
+    and return how many were created. Raise ValidationError with a dict of
+    error lists keyed by line number if a path is invalid or contradicts
+    the existing tree; nothing is written then.
+    '''
+    parents, lines_of, errors = parse_paths(lines)
+    existing = dict((pk, (name, parent_id)) for pk, name, parent_id in
+                    PollCategory.objects.values_list('pk', 'name', 'parent_id'))
+    pks = dict((name, pk) for pk, (name, parent_id) in existing.items())
+    for name, parent in parents.items():
+        if name in pks:
+            parent_id = existing[pks[name]][1]
+            current = existing[parent_id][0] if parent_id else None
+            if current != parent:
+                errors.setdefault(lines_of[name], []).append(
+                        u'"{0}" already exists under "{1}".'.format(name, current))
+    if errors:
+        raise ValidationError(errors)
+
+    def depth(name):
+        return 0 if parents[name] is None else depth(parents[name]) + 1
+
+    levels = {}
+    for name in parents:
+        if name not in pks:
+            levels.setdefault(depth(name), []).append(name)
+    created = 0
+    for level in sorted(levels):
+        PollCategory.objects.bulk_create(
+                PollCategory(name=name, parent_id=pks.get(parents[name]),
+                             lft=0, rght=0, tree_id=0, level=0)
+                for name in levels[level])
+        created += len(levels[level])
+        pks = dict(PollCategory.objects.values_list('name', 'pk'))
+
+    rebuild_tree()
+    problems = check_tree()
+    if problems:
+        raise ValidationError({0: problems})
+    bump_version('polls', *set(sitemap_key('categories', pk) for pk in pks.values()))
+    return created
@@ -0,0 +1,53 @@
+'''
+Bar charts of poll results, drawn as SVG.
+
+The chart of a poll is cached together with the number of votes it shows,
+and only drawn again once that number changed (or a choice was edited,
+see polls.caching), so viewing it again costs one cache read.
+'''
+from django.core.cache import cache
+from django.utils.html import escape
+
+
+WIDTH = 400
+ROW_HEIGHT = 40
+BAR_HEIGHT = 16
+
+SVG = (u'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+       u'font-family="sans-serif" font-size="12">{rows}</svg>')
+ROW = (u'<text x="0" y="{text_y}">{label} ({value})</text>'
+       u'<rect x="0" y="{bar_y}" width="{bar_width}" height="{bar_height}" fill="#36c"/>')
+
+
+def chart_key(poll_pk):
+    return 'chart:{0}'.format(poll_pk)
+
+
+def render_chart(bars):
+    '''Return an SVG document with a bar for every (label, value) in `bars`.'''
+    top = max([value for label, value in bars] + [1])
+    rows = []
+    for i, (label, value) in enumerate(bars):
+        rows.append(ROW.format(
+                text_y=i * ROW_HEIGHT + 14, bar_y=i * ROW_HEIGHT + 18,
+                bar_width=max(WIDTH * value // top, 1), bar_height=BAR_HEIGHT,
+                label=escape(label), value=value))
+    return SVG.format(width=WIDTH, height=len(bars) * ROW_HEIGHT, rows=u''.join(rows))
+
+
+def poll_chart(poll):
+    '''Return the SVG chart of the results of `poll`, first preferences if ranked.'''
+    count = poll.num_voters()
+    cached = cache.get(chart_key(poll.pk))
+    if cached is not None and cached[0] == count:
+        return cached[1]
+    if poll.ranked:
+        runoff = poll.runoff()
+        rounds, choices = runoff['rounds'], runoff['choices']
+        first = rounds[0]['votes'] if rounds else [0] * len(choices)
+        bars = [(choice.choice_text, votes) for choice, votes in zip(choices, first)]
+    else:
+        bars = [(choice.choice_text, choice.num_votes) for choice in poll.results()]
+    svg = render_chart(bars)
+    cache.set(chart_key(poll.pk), (count, svg), None)
+    return svg
@@ -0,0 +1,39 @@
+'''
+Purging polls hidden with Poll.mark_deleted().
+
+Votes are deleted in batches of bounded size, each in its own short
+transaction, so the write lock is never held for long. Nothing is kept
+in memory between batches: an interrupted purge just continues with the
+votes that are left when run again.
+'''
+import time
+
+from .models import Vote, ArchivedVote, Ballot
+from .sharding import vote_alias
+
+
+def purge_poll(poll, batch_size=1000, pause=0, progress=None):
+    '''
+    Delete `poll` with all its votes, archived votes or ballots, and its
+    choices. `progress`, if given, is called with the number of votes
+    deleted after every batch.
+    '''
+    alias = vote_alias(poll.vote_shard)
+    batches = [
+        (poll.votes().using(alias), Vote.objects.using(alias)),
+        (poll.archived_votes(), ArchivedVote.objects.all()),
+        (poll.ballot_set.all(), Ballot.objects.all()),
+    ]
+    for rows, manager in batches:
+        while True:
+            pks = list(rows.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            manager.filter(pk__in=pks).delete()
+            if progress is not None:
+                progress(len(pks))
+            if pause:
+                time.sleep(pause)
+    # Only a handful of choices remain, the cascade takes care of them.
+    poll.delete()
+
@@ -0,0 +1,142 @@
+'''
+Finding polls whose question is nearly the same as a new one.
+
+Questions are compared by the Jaccard similarity of their sets of
+trigrams, after lower-casing them and replacing everything but letters
+and digits by single spaces. On SQLite 3.34 and later the normalized
+questions are indexed in the ``polls_poll_trigrams`` FTS5 table with the
+trigram tokenizer (created by migration 0016, rowid = poll id) and kept in
+sync by the signal handlers below; elsewhere there is no index and
+nothing is suggested, rather than scanning all polls.
+
+A poll at least `threshold` similar must share at least
+ceil(threshold * n) of the n trigrams of the question, so it contains one
+of the n - ceil(threshold * n) + 1 rarest of them. Only the polls
+containing those rare trigrams are read from the index, the ones sharing
+most of them first, and only MAX_CANDIDATES public ones are scored. Trigrams
+found in COMMON polls or more (" th", "wha") are skipped, so that every
+lookup reads a bounded number of index entries; a poll sharing nothing
+but such trigrams with the question is not that similar anyway.
+'''
+import math
+import re
+
+from django.conf import settings
+from django.db import connections
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Poll
+
+
+TRIGRAM_TABLE = 'polls_poll_trigrams'
+COMMON = 1000
+MAX_CANDIDATES = 100
+
+
+def uses_trigrams(using='default'):
+    connection = connections[using]
+    return (connection.vendor == 'sqlite' and
+            connection.Database.sqlite_version_info >= (3, 34, 0))
+
+
+def normalize(question):
+    return u' '.join(re.findall(r'[^\W_]+', question.lower(), re.UNICODE))
+
+
+def trigrams(question):
+    text = normalize(question)
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def similarity(a, b):
+    '''Jaccard similarity of two sets of trigrams.'''
+    if not a or not b:
+        return 0.0
+    return len(a & b) / float(len(a | b))
+
+
+def index_questions(poll_ids, using='default', batch_size=500):
+    '''(Re)build the trigram entries of the given polls from the database.'''
+    if not uses_trigrams(using):
+        return
+    poll_ids = list(poll_ids)
+    with connections[using].cursor() as cursor:
+        for start in range(0, len(poll_ids), batch_size):
+            batch = poll_ids[start:start + batch_size]
+            cursor.execute('DELETE FROM {0} WHERE rowid IN ({1})'.format(
+                TRIGRAM_TABLE, ', '.join(['%s'] * len(batch))), batch)
+            rows = Poll.objects.using(using).filter(pk__in=batch).values_list('pk', 'question')
+            cursor.executemany(
+                'INSERT INTO {0} (rowid, question) VALUES (%s, %s)'.format(TRIGRAM_TABLE),
+                [(pk, normalize(question)) for pk, question in rows])
+
+
+def unindex_question(poll_id, using='default'):
+    if not uses_trigrams(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute('DELETE FROM {0} WHERE rowid = %s'.format(TRIGRAM_TABLE), [poll_id])
+
+
+def _candidates(grams, threshold, using):
+    '''Return the ids of the public polls most likely to be `threshold` similar to `grams`.'''
+    grams = sorted(grams)
+    # Polls containing a trigram, up to COMMON of them.
+    postings = 'SELECT * FROM (SELECT rowid FROM {0} WHERE {0} MATCH %s LIMIT {1})'.format(
+            TRIGRAM_TABLE, COMMON)
+    with connections[using].cursor() as cursor:
+        cursor.execute(' UNION ALL '.join(
+                ['SELECT %s, (SELECT count(*) FROM ({0}))'.format(postings)] * len(grams)),
+                [value for gram in grams for value in (gram, u'"{0}"'.format(gram))])
+        frequencies = dict((gram, n) for gram, n in cursor.fetchall() if n)
+        # Trigrams found nowhere count among the rarest as well.
+        prefix = len(frequencies) - int(math.ceil(threshold * len(grams))) + 1
+        rare = [gram for gram in sorted(frequencies, key=frequencies.get)[:max(prefix, 0)]
+                if frequencies[gram] < COMMON]
+        if not rare:
+            return []
+        # Hidden polls mustn't take the places of public ones.
+        cursor.execute(
+                'SELECT t.rowid FROM ({0}) t JOIN {1} p ON p.id = t.rowid '
+                'WHERE p.deleted_at IS NULL AND p.pub_date <= %s '
+                'GROUP BY t.rowid ORDER BY count(*) DESC, t.rowid LIMIT {2}'.format(
+                    ' UNION ALL '.join([postings] * len(rare)), Poll._meta.db_table,
+                    MAX_CANDIDATES),
+                [u'"{0}"'.format(gram) for gram in rare] +
+                [connections[using].ops.adapt_datetimefield_value(timezone.now())])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def similar_polls(question, queryset=None, limit=5, threshold=None):
+    '''
+    Return up to `limit` polls from `queryset` (default: public polls,
+    others are never suggested) whose question is at least `threshold`
+    (default: settings.POLLS_DUPLICATE_THRESHOLD) similar to `question`,
+    most similar first, each with its similarity set.
+    '''
+    if queryset is None:
+        queryset = Poll.objects.public()
+    if threshold is None:
+        threshold = getattr(settings, 'POLLS_DUPLICATE_THRESHOLD', 0.5)
+    grams = trigrams(question)
+    if not grams or not uses_trigrams(queryset.db):
+        return []
+    polls = list(queryset.filter(pk__in=_candidates(grams, threshold, queryset.db)))
+    for poll in polls:
+        poll.similarity = similarity(grams, trigrams(poll.question))
+    polls = [poll for poll in polls if poll.similarity >= threshold]
+    polls.sort(key=lambda poll: (-poll.similarity, poll.pk))
+    return polls[:limit]
+
+
+@receiver(post_save, sender=Poll, dispatch_uid='polls_duplicates_poll_saved')
+def poll_saved(sender, instance, using, update_fields=None, **kwargs):
+    if update_fields is None or 'question' in update_fields:
+        index_questions([instance.pk], using)
+
+
+@receiver(post_delete, sender=Poll, dispatch_uid='polls_duplicates_poll_deleted')
+def poll_deleted(sender, instance, using, **kwargs):
+    unindex_question(instance.pk, using)
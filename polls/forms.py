@@ -1,13 +1,89 @@
+from django import forms
 from django.forms import ModelForm
 from django.forms.models import inlineformset_factory
 
 from .models import Poll, Choice
+from .duplicates import similar_polls
+from .surveys import already_voted, cast_votes
 
 
 class PollForm(ModelForm):
+    # Only shown once similar polls were found, see clean().
+    create_anyway = forms.BooleanField(
+            required=False, widget=forms.HiddenInput,
+            label='None of these, save my poll')
+
     class Meta:
         model = Poll
-        fields = ('question', 'category')
+        fields = ('question', 'category', 'ranked', 'closes_at')
+
+    def __init__(self, *args, **kwargs):
+        super(PollForm, self).__init__(*args, **kwargs)
+        self.similar_polls = []
+        if self.instance.pk is not None:
+            # Existing votes or ballots could not be converted.
+            del self.fields['ranked']
+
+    def clean(self):
+        cleaned_data = super(PollForm, self).clean()
+        question = cleaned_data.get('question')
+        if (question and 'question' in self.changed_data and
+                not cleaned_data.get('create_anyway')):
+            self.similar_polls = similar_polls(
+                    question, Poll.objects.public().exclude(pk=self.instance.pk))
+        if self.similar_polls:
+            self.fields['create_anyway'].widget = forms.CheckboxInput()
+            self.add_error('question', u'Similar polls already exist, vote in one of them '
+                                       u'or confirm that yours is different.')
+        return cleaned_data
 
 
 ChoiceFormSet = inlineformset_factory(Poll, Choice, fields=('choice_text',), extra=5)
+
+
+class SurveyForm(forms.Form):
+    '''
+    A choice field for every public poll of `survey` that `user` can still
+    vote in; the other polls are listed in `skipped` with the reason.
+    '''
+
+    def __init__(self, survey, user, *args, **kwargs):
+        super(SurveyForm, self).__init__(*args, **kwargs)
+        self.user = user
+        self.polls = list(survey.polls.public().order_by('pk'))
+        voted = already_voted(user, self.polls)
+        self.skipped = []
+        open_polls = []
+        for poll in self.polls:
+            if poll.pk in voted:
+                self.skipped.append((poll, "You already voted."))
+            elif poll.created_by_id == user.pk:
+                self.skipped.append((poll, "You can't vote in your own poll."))
+            elif poll.is_closed():
+                self.skipped.append((poll, "Voting in this poll is closed."))
+            elif poll.ranked:
+                self.skipped.append((poll, "Ranked polls are voted on one by one."))
+            else:
+                open_polls.append(poll)
+
+        choices = {}
+        for choice in Choice.objects.filter(poll__in=open_polls).order_by('pk'):
+            choices.setdefault(choice.poll_id, []).append((choice.pk, choice.choice_text))
+        self.open_polls = {}
+        for poll in open_polls:
+            name = 'poll-{0}'.format(poll.pk)
+            self.open_polls[name] = poll
+            self.fields[name] = forms.TypedChoiceField(
+                    label=poll.question, choices=choices.get(poll.pk, []), coerce=int,
+                    widget=forms.RadioSelect,
+                    error_messages={'required': "You didn't select a choice."})
+
+    def clean(self):
+        if not self.open_polls:
+            raise forms.ValidationError("There is nothing left to vote on in this survey.")
+        return super(SurveyForm, self).clean()
+
+    def save(self):
+        '''Cast all votes at once, see polls.surveys.cast_votes().'''
+        cast_votes(self.user, [(poll, self.cleaned_data[name])
+                               for name, poll in sorted(self.open_polls.items())])
@@ -0,0 +1,88 @@
+'''
+Where does a fresh worker spend its time before serving its first request?
+
+`manage.py profile_startup` runs main() in a new interpreter, which times
+every module imported while loading mysite.wsgi and while serving one
+request through the WSGI application.
+'''
+import sys
+import time
+from wsgiref.util import setup_testing_defaults
+
+from django.utils.six.moves import builtins
+
+
+class ImportTimer(object):
+    '''Record how long importing each module took, with and without its imports.'''
+
+    def __init__(self):
+        self.times = {}  # module name: [own seconds, cumulative seconds]
+        self._stack = []
+
+    def install(self):
+        self._original = builtins.__import__
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        builtins.__import__ = self._original
+
+    def _import(self, name, *args, **kwargs):
+        if name in sys.modules:
+            return self._original(name, *args, **kwargs)
+        label = name or self._relative_label(*args)
+        start = time.time()
+        self._stack.append(0.0)
+        try:
+            return self._original(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            times = self.times.setdefault(label, [0.0, 0.0])
+            times[0] += elapsed - nested
+            times[1] += elapsed
+
+    @staticmethod
+    def _relative_label(globals=None, locals=None, fromlist=(), *args):
+        # from . import x
+        package = (globals or {}).get('__package__') or '?'
+        return '{0}.{1}'.format(package, ','.join(fromlist or ()))
+
+    def slowest(self, count):
+        return sorted(self.times.items(), key=lambda item: item[1][0],
+                      reverse=True)[:count]
+
+
+def profile(path):
+    '''Return ([(phase, seconds)], response status, ImportTimer).'''
+    timer = ImportTimer()
+    timer.install()
+    try:
+        start = time.time()
+        from mysite.wsgi import application
+        phases = [('import mysite.wsgi', time.time() - start)]
+
+        environ = {'PATH_INFO': path}
+        setup_testing_defaults(environ)
+        status = []
+        start = time.time()
+        response = application(environ, lambda s, headers, exc_info=None: status.append(s))
+        b''.join(response)
+        phases.append(('first request to ' + path, time.time() - start))
+    finally:
+        timer.uninstall()
+    return phases, status[0] if status else None, timer
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else '/polls/'
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    phases, status, timer = profile(path)
+    for phase, seconds in phases:
+        print('{0:>8.1f} ms  {1}'.format(seconds * 1000, phase))
+    print('Response: {0}'.format(status))
+    print('')
+    print('Slowest imports (own / cumulative ms):')
+    for name, (own, cumulative) in timer.slowest(count):
+        print('{0:>8.1f} {1:>8.1f}  {2}'.format(own * 1000, cumulative * 1000, name))
@@ -0,0 +1,238 @@
+'''
+A storm of simulated voters against the WSGI application, for measuring
+contention before a big poll launch, see `manage.py vote_storm`.
+
+Every simulated user is a thread with its own session and address. It
+votes through the vote view in polls picked with a Zipf-like skew, so a
+few polls get most of the votes, and reads the results page and its
+fragments after every vote. Write statements are timed on each thread's
+database connection: with SQLite, most of their time is spent waiting
+for the database lock, and "database is locked" errors are counted.
+Throttling and load shedding are turned off for the storm, so that every
+vote reaches the database.
+'''
+import logging
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from importlib import import_module
+from io import BytesIO
+from wsgiref.util import setup_testing_defaults
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.signals import got_request_exception
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils.crypto import get_random_string
+from django.utils.six.moves.urllib.parse import urlencode
+
+from .bulk import create_polls
+from .deletion import purge_poll
+from .models import Choice, Poll, PollCategory
+
+
+USER_PREFIX = 'storm-'
+WRITES = ('INSERT', 'UPDATE', 'DELETE')
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def skewed_order(rng, items, skew):
+    '''Shuffle `items` so that the i-th one tends to come first with weight 1 / (i + 1) ** skew.'''
+    keys = [rng.random() ** ((i + 1) ** skew) for i in range(len(items))]
+    return [item for key, item in sorted(zip(keys, items), key=lambda pair: pair[0], reverse=True)]
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)  # operation: [seconds]
+        self.statuses = defaultdict(Counter)  # operation: {status: count}
+        self.writes = []  # seconds spent in each write statement
+        self.locked = 0  # "database is locked" errors
+
+    def record(self, operation, status, seconds):
+        with self.lock:
+            self.latencies[operation].append(seconds)
+            self.statuses[operation][status] += 1
+
+    def record_queries(self, queries):
+        times = [float(q['time']) for q in queries
+                 if q['sql'].lstrip().upper().startswith(WRITES)]
+        with self.lock:
+            self.writes.extend(times)
+
+    def exception(self, sender, **kwargs):
+        if 'locked' in str(sys.exc_info()[1]):
+            with self.lock:
+                self.locked += 1
+
+    def report(self, duration):
+        lines = []
+        total = sum(len(values) for values in self.latencies.values())
+        lines.append('{0} requests in {1:.1f}s: {2:.1f} requests/s'.format(
+                total, duration, total / duration if duration else 0))
+        lines.append('{0:<10} {1:>7} {2:>8} {3:>8} {4:>8} {5:>8}  statuses'.format(
+                'operation', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'errors'))
+        for operation, values in sorted(self.latencies.items()):
+            statuses = self.statuses[operation]
+            errors = sum(n for status, n in statuses.items() if status >= 400)
+            lines.append('{0:<10} {1:>7} {2:>8.1f} {3:>8.1f} {4:>8.1f} {5:>7.1%}  {6}'.format(
+                    operation, len(values), percentile(values, .5) * 1000,
+                    percentile(values, .9) * 1000, percentile(values, .99) * 1000,
+                    float(errors) / len(values),
+                    ' '.join('{0}x{1}'.format(s, n) for s, n in sorted(statuses.items()))))
+        lines.append('{0} write statements, p50 {1:.1f} ms, p99 {2:.1f} ms, max {3:.1f} ms, '
+                     'total {4:.1f}s'.format(
+                len(self.writes), percentile(self.writes, .5) * 1000,
+                percentile(self.writes, .99) * 1000, max(self.writes or [0]) * 1000,
+                sum(self.writes)))
+        lines.append('"database is locked" errors: {0}'.format(self.locked))
+        return '\n'.join(lines)
+
+
+class SimulatedUser(object):
+    '''A logged in visitor talking to a WSGI application directly.'''
+
+    def __init__(self, application, user, address):
+        self.application = application
+        self.address = address
+        # Logged in like the test client's force_login(), hashing a
+        # password per user would only measure the password hasher.
+        engine = import_module(settings.SESSION_ENGINE)
+        session = engine.SessionStore()
+        session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+        session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        self.csrf_token = get_random_string(32)
+        self.cookies = '{0}={1}; {2}={3}'.format(
+                settings.SESSION_COOKIE_NAME, session.session_key,
+                settings.CSRF_COOKIE_NAME, self.csrf_token)
+
+    def request(self, method, path, query='', data=None):
+        '''Return the status code of the response.'''
+        body = urlencode(data or {}).encode('ascii')
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'HTTP_HOST': 'localhost',
+            'HTTP_COOKIE': self.cookies,
+            'REMOTE_ADDR': self.address,
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': BytesIO(body),
+        }
+        setup_testing_defaults(environ)
+        status = []
+        response = self.application(environ, lambda s, headers, exc_info=None: status.append(s))
+        try:
+            for chunk in response:
+                pass
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+        return int(status[0].split()[0])
+
+    def vote(self, poll_pk, choice_pk):
+        return self.request('POST', reverse('polls:voting_form', args=(poll_pk,)), data={
+            'choice': choice_pk, 'csrfmiddlewaretoken': self.csrf_token})
+
+    def read_results(self, poll_pk):
+        path = reverse('polls:results', args=(poll_pk,))
+        status = self.request('GET', path)
+        self.request('GET', reverse('polls:fragments'),
+                     urlencode({'poll': poll_pk, 'next': path}))
+        return status
+
+
+def create_storm_data(users, polls, choices):
+    '''Create the users and polls of a storm, return (user list, {poll pk: [choice pks]}).'''
+    owner, created = User.objects.get_or_create(username=USER_PREFIX + 'owner')
+    category = PollCategory.objects.first() or PollCategory.objects.create(name='Load test')
+    poll_pks = create_polls([
+        {'question': 'Load test poll {0}'.format(i), 'category': category.pk,
+         'choices': ['Answer {0}'.format(j) for j in range(choices)]}
+        for i in range(polls)], owner)
+    User.objects.bulk_create(
+            User(username='{0}user-{1}'.format(USER_PREFIX, i), password='!')
+            for i in range(users))
+    storm_users = list(User.objects.filter(username__startswith=USER_PREFIX + 'user-'))
+    choice_pks = defaultdict(list)
+    for poll_pk, choice_pk in Choice.objects.filter(poll__in=poll_pks).values_list(
+            'poll_id', 'pk'):
+        choice_pks[poll_pk].append(choice_pk)
+    return storm_users, dict((pk, choice_pks[pk]) for pk in poll_pks)
+
+
+def delete_storm_data():
+    '''Remove everything create_storm_data() made, votes included.'''
+    for poll in Poll.objects.filter(created_by__username=USER_PREFIX + 'owner'):
+        purge_poll(poll)
+    User.objects.filter(username__startswith=USER_PREFIX).delete()
+
+
+def run_storm(application, users, polls, votes_per_user, skew=1.2, seed=None):
+    '''
+    Let every user in `users` vote in up to `votes_per_user` of `polls`
+    ({poll pk: [choice pks]}, most popular first) at once, unthrottled.
+    Return (Stats, seconds elapsed).
+    '''
+    stats = Stats()
+    rng = random.Random(seed)
+    poll_pks = list(polls)
+    plans = [skewed_order(rng, poll_pks, skew)[:votes_per_user] for user in users]
+    simulated = [SimulatedUser(application, user, '10.{0}.{1}.{2}'.format(
+                     i >> 16 & 255, i >> 8 & 255, i & 255))
+                 for i, user in enumerate(users)]
+    start_line = threading.Event()
+
+    def storm(visitor, plan, choice_rng):
+        connection.force_debug_cursor = True
+        start_line.wait()
+        try:
+            for poll_pk in plan:
+                for operation, call in [
+                        ('vote', lambda: visitor.vote(poll_pk, choice_rng.choice(polls[poll_pk]))),
+                        ('results', lambda: visitor.read_results(poll_pk))]:
+                    started = time.time()
+                    status = call()
+                    stats.record(operation, status, time.time() - started)
+                    stats.record_queries(connection.queries)
+                    connection.queries_log.clear()
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=storm, args=(visitor, plan, random.Random(rng.random())))
+               for visitor, plan in zip(simulated, plans)]
+    got_request_exception.connect(stats.exception)
+    # Errors are counted, not logged or mailed to the admins one by one.
+    request_logger = logging.getLogger('django.request')
+    request_logger.disabled = True
+    unthrottled = override_settings(POLLS_THROTTLE_USER_RATE=None, POLLS_THROTTLE_IP_RATE=None,
+                                    POLLS_MAX_INFLIGHT_WRITES=None)
+    unthrottled.enable()
+    try:
+        for thread in threads:
+            thread.start()
+        started = time.time()
+        start_line.set()
+        for thread in threads:
+            thread.join()
+        return stats, time.time() - started
+    finally:
+        unthrottled.disable()
+        got_request_exception.disconnect(stats.exception)
+        request_logger.disabled = False
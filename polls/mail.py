@@ -0,0 +1,191 @@
+'''
+Asynchronous outgoing mail.
+
+OutboxEmailBackend only writes messages to settings.EMAIL_OUTBOX_DIR, which
+is cheap and survives restarts; `manage.py send_queued_mail` later delivers
+them through settings.EMAIL_DELIVERY_BACKEND over one reused connection,
+retrying failed messages with exponential backoff.
+
+The outbox is laid out like a maildir: messages are written to tmp/ and
+renamed into new/, a sender claims one by renaming it into cur/, and
+messages that failed too often, or can't be read, end up in failed/. Each file holds a line of
+JSON (sender, recipients, attempts, next try) followed by the raw message.
+'''
+import errno
+import json
+import os
+import time
+import uuid
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+
+
+SUBDIRS = ('tmp', 'new', 'cur', 'failed')
+
+
+def outbox_path(*parts):
+    return os.path.join(settings.EMAIL_OUTBOX_DIR, *parts)
+
+
+def _ensure_outbox():
+    for subdir in SUBDIRS:
+        try:
+            os.makedirs(outbox_path(subdir))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def _write(path, envelope, raw):
+    tmp = outbox_path('tmp', uuid.uuid4().hex)
+    with open(tmp, 'wb') as f:
+        f.write(json.dumps(envelope) + '\n')
+        f.write(raw)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+def _read(path):
+    '''Return the envelope and the raw message of a file, ValueError if it is corrupt.'''
+    with open(path, 'rb') as f:
+        envelope, raw = json.loads(f.readline()), f.read()
+    if not isinstance(envelope, dict) or any(
+            key not in envelope for key in ('from', 'recipients', 'attempts', 'next_try')):
+        raise ValueError('No envelope in {0}.'.format(path))
+    return envelope, raw
+
+
+def enqueue(message):
+    '''Store an EmailMessage in the outbox.'''
+    _ensure_outbox()
+    envelope = {
+        'from': message.from_email,
+        'recipients': message.recipients(),
+        'attempts': 0,
+        'next_try': 0,
+    }
+    name = '{0:.6f}-{1}'.format(time.time(), uuid.uuid4().hex)
+    _write(outbox_path('new', name), envelope,
+           message.message().as_bytes(linesep='\r\n'))
+
+
+class OutboxEmailBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        count = 0
+        for message in email_messages:
+            if not message.recipients():
+                continue
+            try:
+                enqueue(message)
+            except Exception:
+                if not self.fail_silently:
+                    raise
+            else:
+                count += 1
+        return count
+
+
+class _RawMIME(object):
+    def __init__(self, raw):
+        self.raw = raw
+
+    def as_bytes(self, unixfrom=False, linesep='\n'):
+        return self.raw
+
+    as_string = as_bytes
+
+
+class QueuedMessage(object):
+    '''
+    A message read back from the outbox. It quacks enough like an
+    EmailMessage for Django's email backends to send it unchanged.
+    '''
+    encoding = None
+
+    def __init__(self, envelope, raw):
+        self.from_email = envelope['from']
+        self._recipients = envelope['recipients']
+        self._raw = raw
+
+    def recipients(self):
+        return self._recipients
+
+    def message(self):
+        return _RawMIME(self._raw)
+
+
+def requeue_stale(age=3600):
+    '''Give back messages claimed by senders that died more than `age` seconds ago.'''
+    _ensure_outbox()
+    for name in os.listdir(outbox_path('cur')):
+        path = outbox_path('cur', name)
+        try:
+            if os.path.getmtime(path) < time.time() - age:
+                os.rename(path, outbox_path('new', name))
+        except OSError:
+            pass
+
+
+def deliver_outbox(batch_size=100, max_attempts=5, backoff=60):
+    '''
+    Send up to `batch_size` messages that are due. Return the number of
+    messages (sent, failed for good).
+    '''
+    _ensure_outbox()
+    now = time.time()
+    connection = get_connection(settings.EMAIL_DELIVERY_BACKEND)
+    sent = failed = 0
+    opened = False
+    try:
+        for name in sorted(os.listdir(outbox_path('new'))):
+            if sent + failed >= batch_size:
+                break
+            path = outbox_path('cur', name)
+            try:
+                os.rename(outbox_path('new', name), path)
+            except OSError:
+                continue  # Claimed by another sender.
+            # The rename kept the time the message was written, which
+            # requeue_stale() would take for the time it was claimed.
+            os.utime(path, None)
+            try:
+                envelope, raw = _read(path)
+            except (IOError, ValueError):
+                # No use trying again, set it aside for a human to look at.
+                os.rename(path, outbox_path('failed', name))
+                failed += 1
+                continue
+            if envelope['next_try'] > now:
+                os.rename(path, outbox_path('new', name))
+                continue
+
+            try:
+                if not opened:
+                    connection.open()
+                    opened = True
+                connection.send_messages([QueuedMessage(envelope, raw)])
+            except Exception:
+                envelope['attempts'] += 1
+                if envelope['attempts'] >= max_attempts:
+                    _write(outbox_path('failed', name), envelope, raw)
+                    failed += 1
+                else:
+                    envelope['next_try'] = now + backoff * 2 ** (envelope['attempts'] - 1)
+                    _write(outbox_path('new', name), envelope, raw)
+                os.unlink(path)
+                # The connection may be broken, start a new one next time.
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+                opened = False
+            else:
+                os.unlink(path)
+                sent += 1
+    finally:
+        if opened:
+            connection.close()
+    return sent, failed
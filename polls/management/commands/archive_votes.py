@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from polls.archive import archive_poll, inactive_polls
+
+
+class Command(BaseCommand):
+    help = ('Move the votes of closed polls and of polls nobody voted in '
+            'lately to the archive table, in small batches.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90,
+                help='Archive polls without votes for this many days.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                help='Number of votes moved per transaction.')
+        parser.add_argument('--pause', type=float, default=0,
+                help='Seconds to sleep between batches.')
+
+    def handle(self, *args, **options):
+        for poll in inactive_polls(options['days']).order_by('pk'):
+            moved = [0]
+
+            def progress(count):
+                moved[0] += count
+                if options['verbosity'] > 1:
+                    self.stdout.write('  {0} votes archived'.format(moved[0]))
+
+            archive_poll(poll, options['batch_size'], options['pause'], progress)
+            if moved[0]:
+                self.stdout.write(u'Poll {0}: {1} votes archived'.format(poll.pk, moved[0]))
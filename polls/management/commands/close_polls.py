@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from polls.models import Poll
+from polls.routers import is_pinned, pin_to_primary
+
+
+class Command(BaseCommand):
+    help = ('Freeze the results of polls that closed; until then they are '
+            'counted for every visitor.')
+
+    def handle(self, *args, **options):
+        # The frozen results must hold every vote, not what replicas have seen.
+        pinned = is_pinned()
+        pin_to_primary()
+        try:
+            polls = Poll.objects.live().filter(closes_at__lte=timezone.now(), snapshot='')
+            count = 0
+            for poll in polls.iterator():
+                if poll.freeze_results():
+                    count += 1
+        finally:
+            pin_to_primary(pinned)
+        self.stdout.write('Froze the results of {0} polls.'.format(count))
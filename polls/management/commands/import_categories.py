@@ -0,0 +1,34 @@
+import io
+import sys
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.categories import import_categories
+
+
+class Command(BaseCommand):
+    help = ('Create poll categories from a file of paths like '
+            '"Science > Physics", one per line, see polls/categories.py.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to read, - for stdin.')
+
+    def handle(self, *args, **options):
+        try:
+            if options['path'] == '-':
+                lines = sys.stdin.read().decode('utf-8').splitlines()
+            else:
+                with io.open(options['path'], encoding='utf-8') as f:
+                    lines = f.read().splitlines()
+        except (IOError, UnicodeDecodeError) as e:
+            raise CommandError('Cannot read categories: {0}'.format(e))
+
+        try:
+            created = import_categories(lines)
+        except ValidationError as e:
+            for number, errors in sorted(e.message_dict.items()):
+                for error in errors:
+                    self.stderr.write(u'Line {0}: {1}'.format(number, error))
+            raise CommandError('No categories were created.')
+        self.stdout.write('Created {0} categories.'.format(created))
@@ -0,0 +1,43 @@
+import json
+import sys
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.bulk import create_polls
+
+
+class Command(BaseCommand):
+    help = ('Create polls from a JSON file holding {"polls": [...]}, '
+            'see polls/bulk.py for the format.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='JSON file to read, - for stdin.')
+        parser.add_argument('--user', required=True,
+                help='Username of the owner of the new polls.')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError('No such user: {0}'.format(options['user']))
+
+        try:
+            if options['path'] == '-':
+                data = json.load(sys.stdin)
+            else:
+                with open(options['path']) as f:
+                    data = json.load(f)
+            polls = data['polls']
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            raise CommandError('Cannot read polls: {0}'.format(e))
+
+        try:
+            pks = create_polls(polls, user)
+        except ValidationError as e:
+            for position, errors in sorted(e.message_dict.items()):
+                for error in errors:
+                    self.stderr.write(u'Poll {0}: {1}'.format(position, error))
+            raise CommandError('No polls were created.')
+        self.stdout.write('Created {0} polls.'.format(len(pks)))
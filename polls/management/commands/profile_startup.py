@@ -0,0 +1,24 @@
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ('Time the imports of a cold worker: loading mysite.wsgi and '
+            'serving its first request.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/polls/',
+                help='URL of the first request.')
+        parser.add_argument('--top', type=int, default=25,
+                help='Number of slowest imports to list.')
+
+    def handle(self, *args, **options):
+        # A new interpreter, this one has imported everything already.
+        output = subprocess.check_output(
+                [sys.executable, '-c', 'from polls.importtime import main; main()',
+                 options['path'], str(options['top'])],
+                cwd=settings.PROJECT_ROOT)
+        self.stdout.write(output.decode('utf-8'), ending='')
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from polls.models import Poll
+from polls.deletion import purge_poll
+
+
+class Command(BaseCommand):
+    help = ('Remove polls deleted by their owners, with their votes and '
+            'choices, in small batches. Safe to interrupt and run again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                help='Number of votes deleted per query.')
+        parser.add_argument('--pause', type=float, default=0,
+                help='Seconds to sleep between batches.')
+
+    def handle(self, *args, **options):
+        polls = Poll.objects.filter(deleted_at__isnull=False).order_by('deleted_at')
+        for poll in polls:
+            self.stdout.write(u'Purging poll {0}: {1}'.format(poll.pk, poll))
+            deleted = [0]
+
+            def progress(count):
+                deleted[0] += count
+                if options['verbosity'] > 1:
+                    self.stdout.write('  {0} votes deleted'.format(deleted[0]))
+
+            purge_poll(poll, options['batch_size'], options['pause'], progress)
+            self.stdout.write('  done, {0} votes deleted'.format(deleted[0]))
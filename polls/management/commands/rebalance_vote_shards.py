@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.models import Poll, vote_shards
+from polls.sharding import plan_rebalance, move_poll_votes
+
+
+class Command(BaseCommand):
+    help = ('Move polls between the databases in settings.VOTE_SHARDS so '
+            'that each holds about the same number of votes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                help="Only print the moves, don't make them.")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                help='Number of votes copied per query.')
+
+    def handle(self, *args, **options):
+        if not vote_shards():
+            raise CommandError('settings.VOTE_SHARDS is empty.')
+        moves = plan_rebalance()
+        polls = Poll.objects.in_bulk(list(moves))
+        for pk, target in sorted(moves.items()):
+            poll = polls[pk]
+            self.stdout.write(u'Poll {0}: {1} -> {2}'.format(
+                pk, poll.vote_shard or 'default', target))
+            if not options['dry_run']:
+                move_poll_votes(poll, target, options['batch_size'])
+        self.stdout.write('{0} polls moved.'.format(
+            0 if options['dry_run'] else len(moves)))
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from polls.mail import deliver_outbox, requeue_stale
+
+
+class Command(BaseCommand):
+    help = 'Deliver the mail queued in settings.EMAIL_OUTBOX_DIR.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                help='Messages sent over one connection.')
+        parser.add_argument('--max-attempts', type=int, default=5,
+                help='Give up on a message after this many failures.')
+        parser.add_argument('--interval', type=float, default=0,
+                help='Keep running, checking the outbox this often (seconds).')
+
+    def handle(self, *args, **options):
+        requeue_stale()
+        while True:
+            while True:
+                sent, failed = deliver_outbox(options['batch_size'],
+                                              options['max_attempts'])
+                if sent or failed:
+                    self.stdout.write('{0} sent, {1} failed'.format(sent, failed))
+                if sent + failed < options['batch_size']:
+                    break
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from polls.loadtest import create_storm_data, delete_storm_data, run_storm
+
+
+class Command(BaseCommand):
+    help = ('Simulate many users voting at once against mysite.wsgi and '
+            'report throughput, latencies, errors and time spent in writes. '
+            'Creates its own users and polls, removed afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50,
+                help='Number of simulated users, each in its own thread.')
+        parser.add_argument('--polls', type=int, default=10,
+                help='Number of polls to vote in.')
+        parser.add_argument('--choices', type=int, default=4,
+                help='Number of choices per poll.')
+        parser.add_argument('--votes', type=int, default=5,
+                help='Number of polls every user votes in.')
+        parser.add_argument('--skew', type=float, default=1.2,
+                help='Zipf exponent of poll popularity, 0 for uniform.')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--keep', action='store_true',
+                help="Don't delete the users, polls and votes afterwards.")
+
+    def handle(self, *args, **options):
+        from mysite.wsgi import application
+
+        users, polls = create_storm_data(options['users'], options['polls'],
+                                         options['choices'])
+        try:
+            stats, duration = run_storm(application, users, polls,
+                                        options['votes'], options['skew'], options['seed'])
+            self.stdout.write(stats.report(duration))
+        finally:
+            if not options['keep']:
+                delete_storm_data()
@@ -0,0 +1,60 @@
+'''
+Tables in memory-mapped files, shared by the worker processes of a host.
+
+A MappedFile is a header, starting with a magic string and the number of
+slots, followed by that many fixed-size slots. It is created, or emptied
+when it doesn't match, under an exclusive lock on the file. The lock is
+taken with flock() and a mutex, as flock() doesn't keep out the other
+threads of the same process. Without fcntl (on Windows) there is nothing
+to lock with, and callers keep their data per process instead.
+'''
+import mmap
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows.
+    fcntl = None
+
+
+class MappedFile(object):
+
+    def __init__(self, path, slots, header, slot, magic):
+        self.path = path
+        self.slots = slots
+        self.pid = os.getpid()
+        self.size = header.size + slots * slot.size
+        self.mutex = threading.Lock()
+        self.file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+        self.lock()
+        try:
+            self.file.seek(0)
+            data = self.file.read(header.size)
+            if (len(data) != header.size or os.path.getsize(path) != self.size or
+                    header.unpack(data)[:2] != (magic, slots)):
+                empty = header.unpack(b'\0' * header.size)
+                self.file.truncate(0)
+                self.file.truncate(self.size)
+                self.file.seek(0)
+                self.file.write(header.pack(magic, slots, *empty[2:]))
+                self.file.flush()
+            self.map = mmap.mmap(self.file.fileno(), self.size)
+        finally:
+            self.unlock()
+
+    def lock(self, blocking=True):
+        '''Take the lock, or return False if `blocking` is false and it is taken.'''
+        if not self.mutex.acquire(blocking):
+            return False
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.file.fileno(), flags)
+        except IOError:
+            self.mutex.release()
+            return False
+        return True
+
+    def unlock(self):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.mutex.release()
@@ -0,0 +1,237 @@
+'''
+Counters and histograms in the Prometheus text format, served at
+/polls/metrics to staff and to settings.INTERNAL_IPS.
+
+When settings.POLLS_METRICS_FILE is set (e.g. '/dev/shm/polls-metrics'),
+all worker processes of a host add to the same memory-mapped file, so
+every scrape sees the totals of the host however requests were spread
+over the workers. Like the tallies of polls.tallies it is a fixed-size
+open-addressing hash table, here of (series name, value) slots, written
+under an exclusive lock on the file. Without a file, metrics are kept
+per process.
+
+Series are the metric name with its labels, e.g.
+'polls_votes_total{result="accepted"}'; histogram buckets are counted
+cumulatively as they are exposed. The throttling counters of
+polls.throttling are exposed as well.
+'''
+import math
+import os
+import re
+import struct
+import threading
+import zlib
+
+from django.conf import settings
+from django.db import connections
+
+from .mapped import MappedFile, fcntl
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+# name: (type, help, histogram buckets)
+METRICS = [
+    ('polls_votes_total', ('counter', 'Votes posted, by result.', None)),
+    ('polls_created_total', ('counter', 'Polls created, by form or in bulk.', None)),
+    ('polls_request_duration_seconds', (
+        'histogram', 'Time spent serving requests, by URL name.', LATENCY_BUCKETS)),
+    ('polls_request_queries', (
+        'histogram', 'Database queries run by requests, by URL name.', QUERY_BUCKETS)),
+]
+TYPES = dict(METRICS)
+
+
+HEADER = struct.Struct('<8sq')  # magic, number of slots
+SLOT = struct.Struct('<120sd')  # series name, value
+MAGIC = b'POLLMET1'
+
+
+class MetricsFile(MappedFile):
+
+    def __init__(self, path, slots):
+        super(MetricsFile, self).__init__(path, slots, HEADER, SLOT, MAGIC)
+
+    def _find(self, name):
+        '''Return the offset of the slot holding `name` or of an empty one.'''
+        index = (zlib.crc32(name) & 0xffffffff) % self.slots
+        for i in range(self.slots):
+            offset = HEADER.size + (index + i) % self.slots * SLOT.size
+            slot_name = SLOT.unpack_from(self.map, offset)[0].rstrip(b'\0')
+            if slot_name == name or not slot_name:
+                return offset
+        return None
+
+    def add(self, amounts):
+        '''Add {series: amount} to the table; series that don't fit are dropped.'''
+        self.lock()
+        try:
+            for name, amount in amounts.items():
+                name = name.encode('utf-8')
+                offset = self._find(name) if len(name) <= SLOT.size - 8 else None
+                if offset is not None:
+                    value = SLOT.unpack_from(self.map, offset)[1]
+                    SLOT.pack_into(self.map, offset, name, value + amount)
+        finally:
+            self.unlock()
+
+    def items(self):
+        self.lock()
+        try:
+            slots = [SLOT.unpack_from(self.map, HEADER.size + i * SLOT.size)
+                     for i in range(self.slots)]
+        finally:
+            self.unlock()
+        return [(name.rstrip(b'\0').decode('utf-8'), value)
+                for name, value in slots if name.rstrip(b'\0')]
+
+
+class LocalMetrics(object):
+    '''The same as MetricsFile, for this process alone.'''
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def add(self, amounts):
+        with self.lock:
+            for name, amount in amounts.items():
+                self.values[name] = self.values.get(name, 0) + amount
+
+    def items(self):
+        with self.lock:
+            return list(self.values.items())
+
+
+_local = LocalMetrics()
+_file = None
+
+
+def get_store():
+    '''Return the MetricsFile of this process, or the per-process LocalMetrics.'''
+    global _file
+    path = getattr(settings, 'POLLS_METRICS_FILE', None)
+    if not path or fcntl is None:
+        return _local
+    # A file opened before the workers forked would share one lock among them.
+    if _file is None or _file.path != path or _file.pid != os.getpid():
+        _file = MetricsFile(path, getattr(settings, 'POLLS_METRICS_SLOTS', 1024))
+    return _file
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def series(name, **labels):
+    '''Return the series `name` with `labels`, as it is exposed.'''
+    if not labels:
+        return name
+    return u'{0}{{{1}}}'.format(name, u','.join(
+            u'{0}="{1}"'.format(key, _escape(u'{0}'.format(value)))
+            for key, value in sorted(labels.items())))
+
+
+def _histogram(name, value, labels):
+    buckets = TYPES[name][2]
+    amounts = dict((series(name + '_bucket', le=bound, **labels), 1)
+                   for bound in buckets if value <= bound)
+    amounts[series(name + '_bucket', le='+Inf', **labels)] = 1
+    amounts[series(name + '_sum', **labels)] = value
+    amounts[series(name + '_count', **labels)] = 1
+    return amounts
+
+
+def inc(name, amount=1, **labels):
+    get_store().add({series(name, **labels): amount})
+
+
+def observe(name, value, **labels):
+    get_store().add(_histogram(name, value, labels))
+
+
+def record_request(view_name, seconds, queries):
+    '''Observe the duration and the number of queries of a request, under one lock.'''
+    amounts = _histogram('polls_request_duration_seconds', seconds, {'view': view_name})
+    amounts.update(_histogram('polls_request_queries', queries, {'view': view_name}))
+    get_store().add(amounts)
+
+
+def start_counting_queries():
+    '''
+    Log the queries of every database connection of this thread, which
+    costs formatting their SQL, and return the state to pass to
+    stop_counting_queries().
+    '''
+    state = []
+    for connection in connections.all():
+        state.append((connection, connection.queries_logged,
+                      connection.force_debug_cursor, len(connection.queries_log)))
+        connection.force_debug_cursor = True
+    return state
+
+
+def stop_counting_queries(state):
+    '''Return the number of queries run since start_counting_queries().'''
+    count = 0
+    for connection, logged, forced, start in state:
+        count += max(len(connection.queries_log) - start, 0)
+        connection.force_debug_cursor = forced
+        if not logged:
+            # Nobody else wanted them.
+            connection.queries_log.clear()
+    return count
+
+
+LABELS = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def _sort_key(item):
+    name, value = item
+    base, _, labels = name.partition('{')
+    labels = dict(LABELS.findall(labels))
+    le = labels.pop('le', None)
+    bound = float('inf') if le == '+Inf' else float(le or 0)
+    return (sorted(labels.items()), base, bound)
+
+
+def _format(value):
+    if not math.isinf(value) and value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def render():
+    '''Return all metrics of this host in the Prometheus text format.'''
+    # Not at the top: polls.throttling imports the middleware, which imports this.
+    from .throttling import STATS, stats
+
+    families = dict((name, []) for name, info in METRICS)
+    for name, value in get_store().items():
+        base = name.partition('{')[0]
+        for suffix in ('_bucket', '_sum', '_count'):
+            if base.endswith(suffix) and base[:-len(suffix)] in TYPES:
+                base = base[:-len(suffix)]
+        if base in families:
+            families[base].append((name, value))
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS:
+        lines.append(u'# HELP {0} {1}'.format(name, help_text))
+        lines.append(u'# TYPE {0} {1}'.format(name, kind))
+        for series_name, value in sorted(families[name], key=_sort_key):
+            lines.append(u'{0} {1}'.format(series_name, _format(value)))
+
+    throttling = stats()
+    lines.append(u'# HELP polls_throttle_requests_total Writes allowed, throttled or shed.')
+    lines.append(u'# TYPE polls_throttle_requests_total counter')
+    for outcome in STATS:
+        lines.append(u'{0} {1}'.format(series('polls_throttle_requests_total', outcome=outcome),
+                                       throttling[outcome]))
+    lines.append(u'# HELP polls_inflight_writes Write requests being served.')
+    lines.append(u'# TYPE polls_inflight_writes gauge')
+    lines.append(u'polls_inflight_writes {0}'.format(throttling['inflight']))
+    return u'\n'.join(lines) + u'\n'
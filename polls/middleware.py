@@ -0,0 +1,53 @@
+import time
+
+from django.conf import settings
+
+from .metrics import record_request, start_counting_queries, stop_counting_queries
+from .routers import pin_to_primary
+
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+
+class ReplicaPinningMiddleware(object):
+    '''
+    Pin requests that write, and requests by the same client during the
+    next settings.REPLICA_PIN_SECONDS, to the primary database.
+
+    The window is kept in a cookie, so it works across worker processes.
+    '''
+    cookie_name = 'pin_primary'
+
+    def process_request(self, request):
+        pin_to_primary(request.method not in SAFE_METHODS or
+                       self.cookie_name in request.COOKIES)
+
+    def process_response(self, request, response):
+        if request.method not in SAFE_METHODS:
+            response.set_cookie(self.cookie_name, '1', httponly=True,
+                    max_age=getattr(settings, 'REPLICA_PIN_SECONDS', 15))
+        pin_to_primary(False)
+        return response
+
+
+class MetricsMiddleware(object):
+    '''
+    Observe the duration and the number of database queries of every
+    request to a polls URL, see polls.metrics. Goes first, so that the
+    time spent in the other middleware is included.
+    '''
+
+    def process_request(self, request):
+        request._metrics_started = time.time()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.resolver_match.namespace == 'polls':
+            request._metrics_queries = start_counting_queries()
+
+    def process_response(self, request, response):
+        state = getattr(request, '_metrics_queries', None)
+        if state is not None:
+            record_request(request.resolver_match.view_name,
+                           time.time() - request._metrics_started,
+                           stop_counting_queries(state))
+        return response
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-19 07:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0006_poll_category'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='poll',
+            name='hot_score',
+            field=models.FloatField(blank=True, db_index=True, editable=False, null=True),
+        ),
+    ]
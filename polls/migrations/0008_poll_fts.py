@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def create_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        'CREATE VIRTUAL TABLE polls_poll_fts USING fts5(question, choices)')
+    schema_editor.execute(
+        'INSERT INTO polls_poll_fts (rowid, question, choices) '
+        'SELECT p.id, p.question, COALESCE(('
+        '    SELECT group_concat(c.choice_text, \' \') FROM polls_choice c '
+        '    WHERE c.poll_id = p.id), \'\') '
+        'FROM polls_poll p')
+
+
+def drop_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE polls_poll_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0007_poll_hot_score'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts, drop_fts),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-19 07:46
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0008_poll_fts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='poll',
+            name='vote_shard',
+            field=models.CharField(blank=True, editable=False, max_length=30),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-19 08:00
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('polls', '0010_poll_deleted_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Ballot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ranking', models.CommaSeparatedIntegerField(max_length=200)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='poll',
+            name='ranked',
+            field=models.BooleanField(default=False, verbose_name=b'ranked ballots'),
+        ),
+        migrations.AddField(
+            model_name='ballot',
+            name='poll',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='polls.Poll'),
+        ),
+        migrations.AddField(
+            model_name='ballot',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='ballot',
+            unique_together=set([('poll', 'user')]),
+        ),
+    ]
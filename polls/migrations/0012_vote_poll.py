@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import DEFAULT_DB_ALIAS, migrations, models
+import django.db.models.deletion
+
+
+def backfill_vote_poll(apps, schema_editor):
+    '''
+    Copy the poll of every vote's choice onto the vote, and drop all but
+    the first vote of anyone who voted twice in a poll, which the unique
+    index would reject.
+    '''
+    Choice = apps.get_model('polls', 'Choice')
+    Vote = apps.get_model('polls', 'Vote')
+    alias = schema_editor.connection.alias
+    # Vote shards hold no choices, those are always in the default database.
+    polls = {}
+    for choice_id, poll_id in Choice.objects.using(DEFAULT_DB_ALIAS).values_list('pk', 'poll_id'):
+        polls.setdefault(poll_id, []).append(choice_id)
+    votes = Vote.objects.using(alias)
+    for poll_id, choice_ids in polls.items():
+        votes.filter(choice_id__in=choice_ids).update(poll_id=poll_id)
+
+    repeated = votes.order_by().values('poll', 'user').annotate(
+            first=models.Min('id'), n=models.Count('id')).filter(n__gt=1)
+    for row in repeated:
+        votes.filter(poll_id=row['poll'], user_id=row['user'], id__gt=row['first']).delete()
+    # Orphans of choices deleted long ago can't be placed.
+    votes.filter(poll__isnull=True).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0011_ranked_ballots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vote',
+            name='poll',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='polls.Poll'),
+        ),
+        migrations.RunPython(backfill_vote_poll, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='vote',
+            name='poll',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='polls.Poll'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='vote',
+            unique_together=set([('poll', 'user')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-19 08:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0012_vote_poll'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='poll',
+            name='closes_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name=b'voting closes'),
+        ),
+        migrations.AddField(
+            model_name='poll',
+            name='snapshot',
+            field=models.TextField(blank=True, editable=False),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+
+from django.db import migrations
+
+
+def normalize(question):
+    # Frozen copy of polls.duplicates.normalize().
+    return ' '.join(re.findall(r'[^\W_]+', question.lower(), re.UNICODE))
+
+
+def create_trigrams(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite' or connection.Database.sqlite_version_info < (3, 34, 0):
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE polls_poll_trigrams USING fts5(question, tokenize='trigram')")
+    Poll = apps.get_model('polls', 'Poll')
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'INSERT INTO polls_poll_trigrams (rowid, question) VALUES (%s, %s)',
+            [(pk, normalize(question))
+             for pk, question in Poll.objects.values_list('pk', 'question').iterator()])
+
+
+def drop_trigrams(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite' or connection.Database.sqlite_version_info < (3, 34, 0):
+        return
+    schema_editor.execute('DROP TABLE polls_poll_trigrams')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0015_survey'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigrams, drop_trigrams),
+    ]
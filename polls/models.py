@@ -1,12 +1,22 @@
 import datetime
+import json
+import math
+import random
 
 from mptt.models import MPTTModel, TreeForeignKey
 
-from django.db import models
+from django.conf import settings
+from django.db import models, router, transaction
+from django.db.models import Count
 from django.utils import timezone
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 
+from .caching import bump_version, sitemap_key
+from .runoff import count_ballots, parse_ranking
+from .sqlite import retry_on_lock
+from . import tallies
+
 
 class PollCategory(MPTTModel):
     name = models.CharField(max_length=50, unique=True)
@@ -34,9 +44,51 @@ class PollCategory(MPTTModel):
         order_insertion_by = ['name']
 
 
+# Votes lose half of their weight in the "hot" ranking after this long.
+HOT_HALF_LIFE = getattr(settings, 'POLLS_HOT_HALF_LIFE', datetime.timedelta(hours=12))
+HOT_EPOCH = datetime.datetime(2016, 1, 1, tzinfo=timezone.utc)
+
+
+def hot_weight(when):
+    '''
+    Return the base-2 logarithm of the weight of a vote cast at `when`.
+
+    Weights grow by a factor of 2 every HOT_HALF_LIFE, which is the same as
+    every older vote decaying by half, so stored scores never need to be
+    rewritten just because time passes.
+    '''
+    return (when - HOT_EPOCH).total_seconds() / HOT_HALF_LIFE.total_seconds()
+
+
+def add_hot_weight(score, weight):
+    '''Return a hot_score `score` (None: no votes yet) with a vote of `weight` added.'''
+    if score is None:
+        return weight
+    # log2(2**score + 2**weight) without overflowing
+    high, low = max(score, weight), min(score, weight)
+    return high + math.log(1 + 2 ** (low - high), 2)
+
+
+def vote_shards():
+    '''Database aliases that Vote rows are partitioned over, see polls.sharding.'''
+    return getattr(settings, 'VOTE_SHARDS', [])
+
+
 class PollQuerySet(models.QuerySet):
+    def live(self):
+        '''Polls not waiting to be purged by purge_deleted_polls.'''
+        return self.filter(deleted_at__isnull=True)
+
     def public(self):
-        return self.filter(pub_date__lte=timezone.now())
+        return self.live().filter(pub_date__lte=timezone.now())
+
+    def hot(self):
+        '''Public polls that received votes, trending first.'''
+        return self.public().filter(hot_score__isnull=False).order_by('-hot_score')
+
+
+class PollClosed(Exception):
+    '''Raised by Poll.register_vote() when voting in the poll closed meanwhile.'''
 
 
 class Poll(models.Model):
@@ -45,10 +97,39 @@ class Poll(models.Model):
     visible = models.NullBooleanField()
     category = TreeForeignKey(PollCategory, null=False, default=1)
     created_by = models.ForeignKey(User, default=0)
+    # log2 of the sum of hot_weight() of all votes, see register_vote()
+    hot_score = models.FloatField(null=True, blank=True, editable=False, db_index=True)
+    # Database holding this poll's votes, blank for the routed default.
+    vote_shard = models.CharField(max_length=30, blank=True, editable=False)
+    # Set when the poll was deleted, see mark_deleted().
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # Voters rank the choices on a Ballot instead of casting a Vote.
+    ranked = models.BooleanField('ranked ballots', default=False)
+    closes_at = models.DateTimeField('voting closes', null=True, blank=True)
+    # Final results as JSON, written once the poll closed, see frozen_results().
+    snapshot = models.TextField(blank=True, editable=False)
+    # Number of votes moved to ArchivedVote, see polls.archive.
+    archived_voters = models.PositiveIntegerField(default=0, editable=False)
 
     def __unicode__(self):  # Python 3: def __str__(self):
         return self.question
 
+    def save(self, *args, **kwargs):
+        if self.pk is None and not self.vote_shard and vote_shards():
+            self.vote_shard = random.choice(vote_shards())
+        update_fields = kwargs.get('update_fields')
+        if self.pk is not None and self.snapshot and (
+                update_fields is None or 'closes_at' in update_fields):
+            # The results were frozen at the old closing time.
+            using = kwargs.get('using') or router.db_for_write(Poll, instance=self)
+            if Poll.objects.using(using).filter(pk=self.pk).exclude(
+                    closes_at=self.closes_at).exists():
+                self.snapshot = ''
+                self._frozen = None
+                if update_fields is not None:
+                    kwargs['update_fields'] = list(update_fields) + ['snapshot']
+        super(Poll, self).save(*args, **kwargs)
+
     def get_absolute_url(self):
         return reverse('polls:results', args=(self.id,))
 
@@ -61,18 +142,173 @@ class Poll(models.Model):
     was_published_recently.boolean = True
     was_published_recently.short_description = 'Published recently?'
     
+    def is_closed(self):
+        return self.closes_at is not None and self.closes_at <= timezone.now()
+
+    def frozen_results(self):
+        '''
+        Return the final results of a closed poll once freeze_results()
+        stored them, or None. They are a dict with the number of 'voters'
+        and either the 'counts' of the choices (keyed by pk, as strings) or
+        the 'runoff' rounds of a ranked poll.
+        '''
+        if not self.is_closed() or not self.snapshot:
+            return None
+        if getattr(self, '_frozen', None) is None:
+            self._frozen = json.loads(self.snapshot)
+        return self._frozen
+
+    @retry_on_lock
+    def freeze_results(self):
+        '''
+        Store the results of a closed poll, so that votes are never read
+        again, and return True; return False if the poll is open after all.
+        Votes are read where the poll's votes are routed, so call it pinned
+        to the primary (see polls.routers), as `manage.py close_polls` does.
+        '''
+        with transaction.atomic():
+            # register_vote() checks under this lock that the poll is open,
+            # so no vote is committed after the count.
+            closes_at = Poll.objects.select_for_update().filter(
+                    pk=self.pk).values_list('closes_at', flat=True)[0]
+            if closes_at is None or closes_at > timezone.now():
+                return False
+            if self.ranked:
+                frozen = {'voters': self.ballot_set.count(),
+                          'runoff': self._count_runoff(list(self.choice_set.order_by('pk')))}
+            else:
+                counts = self.count_votes()
+                frozen = {'voters': sum(counts.values()),
+                          'counts': dict((str(pk), n) for pk, n in counts.items())}
+            snapshot = json.dumps(frozen, separators=(',', ':'))
+            Poll.objects.filter(pk=self.pk).update(snapshot=snapshot)
+        self.closes_at, self.snapshot, self._frozen = closes_at, snapshot, None
+        bump_version('poll:{0}'.format(self.pk), 'polls')
+        return True
+
+    def vote_db(self):
+        '''Database alias to use for this poll's votes (None: let routers decide).'''
+        return self.vote_shard or None
+
+    def votes(self):
+        '''Return all votes cast in this poll, except archived ones.'''
+        return Vote.objects.using(self.vote_db()).filter(poll_id=self.pk)
+
+    def archived_votes(self):
+        return ArchivedVote.objects.filter(poll_id=self.pk)
+
+    def vote_of(self, user):
+        '''Return the Vote (or ArchivedVote) of `user` in this poll, or None.'''
+        vote = self.votes().filter(user=user).first()
+        if vote is None and self.archived_voters:
+            vote = self.archived_votes().filter(user=user).first()
+        return vote
+
+    def has_voted(self, user):
+        if self.ranked:
+            return self.ballot_set.filter(user=user).exists()
+        return (self.votes().filter(user=user).exists() or
+                (bool(self.archived_voters) and
+                 self.archived_votes().filter(user=user).exists()))
+
     def num_voters(self):
         '''Return the number of people who voted on this poll.'''
-        return Vote.objects.filter(choice__poll=self).count()
+        frozen = self.frozen_results()
+        if frozen is not None:
+            return frozen['voters']
+        if self.ranked:
+            return self.ballot_set.count()
+        shared = tallies.shared_counts([-self.pk])
+        if shared is not None:
+            return shared[-self.pk]
+        return self.votes().count() + self.archived_voters
 
     num_voters.short_description = 'Number of voters'
 
+    def count_votes(self):
+        '''Return {choice pk: number of votes} counted in the database.'''
+        counts = dict(self.votes().order_by().values_list('choice').annotate(Count('id')))
+        if self.archived_voters:
+            for pk, archived in self.choice_set.filter(archived_votes__gt=0).values_list(
+                    'pk', 'archived_votes'):
+                counts[pk] = counts.get(pk, 0) + archived
+        return counts
+
+    def results(self):
+        '''Return the choices of this poll, each with its num_votes set.'''
+        choices = list(self.choice_set.all())
+        frozen = self.frozen_results()
+        if frozen is not None:
+            tally = dict((int(pk), n) for pk, n in frozen['counts'].items())
+        else:
+            tally = tallies.shared_counts([choice.pk for choice in choices])
+        if tally is None:
+            tally = self.count_votes()
+        for choice in choices:
+            choice.num_votes = tally.get(choice.pk, 0)
+        return choices
+
+    def runoff(self):
+        '''Return the instant-runoff rounds of a ranked poll, see Runoff.report().'''
+        choices = list(self.choice_set.order_by('pk'))
+        frozen = self.frozen_results()
+        report = frozen['runoff'] if frozen is not None else self._count_runoff(choices)
+
+        def choice(position):
+            return None if position is None else choices[position]
+        return {
+            'choices': choices,
+            'rounds': [dict(r, eliminated=choice(r['eliminated'])) for r in report['rounds']],
+            'winner': choice(report['winner']),
+        }
+
+    def _count_runoff(self, choices):
+        # With positions for choices, so that the report can be frozen as JSON.
+        return count_ballots(self, [c.pk for c in choices]).report(range(len(choices)))
+
+    def mark_deleted(self):
+        '''
+        Hide the poll at once. Its votes, choices and the poll itself are
+        removed in small batches later by `manage.py purge_deleted_polls`.
+        '''
+        self.deleted_at = timezone.now()
+        Poll.objects.filter(pk=self.pk).update(deleted_at=self.deleted_at)
+        bump_version('poll:{0}'.format(self.pk), 'polls', sitemap_key('polls', self.pk))
+
+    def deletion_status(self):
+        if self.deleted_at is None:
+            return ''
+        # Not num_voters(), which may come from the snapshot, the shared
+        # tallies or archived_voters and doesn't go down with the purge.
+        left = self.votes().count() + self.archived_votes().count() + self.ballot_set.count()
+        return u'Deleting, {0} votes left'.format(left)
+
+    deletion_status.short_description = 'Deletion'
+
+    def register_vote(self, when=None):
+        '''
+        Fold a vote cast at `when` (default: now) into hot_score. Raises
+        PollClosed if voting closed, so that the vote is rolled back with
+        the transaction saving it.
+        '''
+        weight = hot_weight(when or timezone.now())
+        with transaction.atomic():
+            score, closes_at = Poll.objects.select_for_update().filter(
+                    pk=self.pk).values_list('hot_score', 'closes_at')[0]
+            if closes_at is not None and closes_at <= timezone.now():
+                raise PollClosed
+            score = add_hot_weight(score, weight)
+            Poll.objects.filter(pk=self.pk).update(hot_score=score)
+        self.hot_score = score
+
     objects = PollQuerySet.as_manager()
 
 
 class Choice(models.Model):
     poll = models.ForeignKey(Poll)
     choice_text = models.CharField(max_length=200)
+    # Number of votes moved to ArchivedVote, see polls.archive.
+    archived_votes = models.PositiveIntegerField(default=0, editable=False)
 
     def __unicode__(self):  # Python 3: def __str__(self):
         return self.choice_text
@@ -82,6 +318,8 @@ class Choice(models.Model):
 
 
 class Vote(models.Model):
+    # Same as choice.poll, so that a vote is found by poll and user alone.
+    poll = models.ForeignKey(Poll)
     choice = models.ForeignKey(Choice)
     user = models.ForeignKey(User)
 
@@ -91,8 +329,59 @@ class Vote(models.Model):
                 self.choice.choice_text,
                 str(self.user),
                 )
+
+    def save(self, *args, **kwargs):
+        if self.poll_id is None:
+            self.poll_id = self.choice.poll_id
+        super(Vote, self).save(*args, **kwargs)
+
+    class Meta:
+        unique_together = ('poll', 'user')
+
+
+class ArchivedVote(models.Model):
+    '''A Vote of an inactive poll, moved here by `manage.py archive_votes`.'''
+    poll = models.ForeignKey(Poll)
+    choice = models.ForeignKey(Choice)
+    user = models.ForeignKey(User)
+
+    def __unicode__(self):  # Python 3: def __str__(self):
+        return u'{0}: {1} ({2}, archived)'.format(
+                self.poll.question, self.choice.choice_text, str(self.user))
+
+    class Meta:
+        unique_together = ('poll', 'user')
+
+
+class Ballot(models.Model):
+    '''A voter's ranking of the choices of a ranked poll.'''
+    poll = models.ForeignKey(Poll)
+    user = models.ForeignKey(User)
+    # Choice primary keys, most preferred first.
+    ranking = models.CommaSeparatedIntegerField(max_length=200)
+
+    def __unicode__(self):  # Python 3: def __str__(self):
+        return u'{0}: {1} ({2})'.format(self.poll.question, self.ranking, str(self.user))
+
+    def choices(self):
+        '''Return the ranked choices, most preferred first.'''
+        pks = parse_ranking(self.ranking)
+        choices = self.poll.choice_set.in_bulk(pks)
+        return [choices[pk] for pk in pks if pk in choices]
+
     class Meta:
-        unique_together = ('choice', 'user')
+        unique_together = ('poll', 'user')
 
 
+class Survey(models.Model):
+    '''A group of polls answered together in one form, see polls.surveys.'''
+    title = models.CharField(max_length=200)
+    polls = models.ManyToManyField(Poll, related_name='surveys')
+    created_by = models.ForeignKey(User)
+    pub_date = models.DateTimeField('date published', default=timezone.now)
 
+    def __unicode__(self):  # Python 3: def __str__(self):
+        return self.title
+
+    def get_absolute_url(self):
+        return reverse('polls:survey', args=(self.pk,))
@@ -0,0 +1,48 @@
+'''
+Database routing between the primary ('default') and read replicas.
+
+Replicas are the aliases listed in settings.DATABASE_REPLICAS. Reads go to a
+random replica unless the current thread is pinned to the primary, which
+ReplicaPinningMiddleware does for requests that write and for a short while
+after them, so users always see their own votes and polls. Reads of
+objects related to an instance go to the database the instance came from,
+so that following a relation never goes back in time.
+'''
+import random
+import threading
+
+from django.conf import settings
+
+
+PRIMARY = 'default'
+
+_state = threading.local()
+
+
+def pin_to_primary(pinned=True):
+    _state.pinned = pinned
+
+
+def is_pinned():
+    return getattr(_state, 'pinned', False)
+
+
+class PrimaryReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+        instance = hints.get('instance')
+        # Not the vote shards, which hold nothing but votes.
+        if instance is not None and (instance._state.db == PRIMARY or
+                                     instance._state.db in replicas):
+            return instance._state.db
+        if not replicas or is_pinned():
+            return PRIMARY
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Every database holds the same data, so any relation is fine.
+        return True
@@ -0,0 +1,148 @@
+'''
+Instant-runoff counting of the ballots of ranked polls.
+
+A ballot is encoded as a tuple of choice positions (0 for the poll's first
+choice by primary key, ...), most preferred first, and identical ballots
+are stored once with their number: a poll with 100000 ballots usually has
+far fewer distinct rankings. A Runoff keeps the counts of every round.
+A new ballot only adds one to its top continuing choice in each round, and
+rounds are recounted only from the first one whose outcome it changes.
+
+The Runoff of each poll is cached with the pk of the last ballot it
+counted, so showing results only reads the ballots cast since. This
+assumes ballots are committed in pk order, as with SQLite's single writer.
+'''
+from collections import Counter
+
+from django.core.cache import cache
+from django.db.models import Count, Max
+
+
+def top_choice(ballot, counts):
+    '''The most preferred choice of `ballot` still counted in `counts`.'''
+    for position in ballot:
+        if position in counts:
+            return position
+    return None
+
+
+def outcome(counts):
+    '''
+    Return (winner, None) if a choice has a majority of the round's votes or
+    is the last one left, else (None, the choice eliminated). Ties are
+    broken against the choice added last.
+    '''
+    leader = max(counts, key=lambda position: (counts[position], -position))
+    if counts[leader] * 2 > sum(counts.values()) or len(counts) == 1:
+        return leader, None
+    return None, min(counts, key=lambda position: (counts[position], -position))
+
+
+class Runoff(object):
+
+    def __init__(self, choice_ids):
+        self.choice_ids = list(choice_ids)
+        self.positions = dict((pk, i) for i, pk in enumerate(self.choice_ids))
+        self.ballots = Counter()  # encoded ballot: number of ballots
+        self.rounds = []  # {position: votes} of the choices still counted
+        self.last_ballot = 0
+
+    def encode(self, ranking):
+        '''Encode a list of choice pks, ignoring unknown and repeated ones.'''
+        ballot = []
+        for pk in ranking:
+            position = self.positions.get(pk)
+            if position is not None and position not in ballot:
+                ballot.append(position)
+        return tuple(ballot)
+
+    def add(self, ranking, number=1):
+        ballot = self.encode(ranking)
+        if not ballot:
+            return
+        self.ballots[ballot] += number
+        for index, counts in enumerate(self.rounds):
+            top = top_choice(ballot, counts)
+            if top is None:
+                break  # Exhausted, in all later rounds too.
+            before = outcome(counts)
+            counts[top] += number
+            if outcome(counts) != before:
+                del self.rounds[index + 1:]
+                break
+        self._finish()
+
+    def _count(self, continuing):
+        counts = dict.fromkeys(continuing, 0)
+        for ballot, number in self.ballots.items():
+            top = top_choice(ballot, counts)
+            if top is not None:
+                counts[top] += number
+        return counts
+
+    def _finish(self):
+        '''Count rounds after the last one until there is a winner.'''
+        if not self.ballots:
+            return
+        if not self.rounds:
+            self.rounds.append(self._count(range(len(self.choice_ids))))
+        while True:
+            winner, eliminated = outcome(self.rounds[-1])
+            if winner is not None:
+                return
+            self.rounds.append(self._count(
+                    [p for p in self.rounds[-1] if p != eliminated]))
+
+    def report(self, choices):
+        '''
+        Return the rounds for display, `choices` being the Choice objects
+        of the poll ordered by pk: {'choices', 'rounds', 'winner'} where
+        each round has the 'votes' of every choice (None once eliminated),
+        the number of 'exhausted' ballots and the choice 'eliminated'.
+        '''
+        total = sum(self.ballots.values())
+        rounds = []
+        for counts in self.rounds:
+            winner, eliminated = outcome(counts)
+            rounds.append({
+                'votes': [counts.get(i) for i in range(len(choices))],
+                'exhausted': total - sum(counts.values()),
+                'eliminated': None if eliminated is None else choices[eliminated],
+            })
+        return {
+            'choices': choices,
+            'rounds': rounds,
+            'winner': choices[winner] if self.rounds else None,
+        }
+
+
+def parse_ranking(ranking):
+    return [int(pk) for pk in ranking.split(',') if pk]
+
+
+def count_ballots(poll, choice_ids):
+    '''Return the up to date Runoff of `poll`, updating the cached one.'''
+    key = 'runoff:{0}'.format(poll.pk)
+    runoff = cache.get(key)
+    if runoff is None or runoff.choice_ids != list(choice_ids):
+        runoff = Runoff(choice_ids)
+        # Counted from scratch, one row per distinct ranking.
+        last = poll.ballot_set.aggregate(last=Max('pk'))['last'] or 0
+        rows = poll.ballot_set.filter(pk__lte=last).order_by().values_list(
+                'ranking').annotate(Count('id'))
+        for ranking, number in rows:
+            ballot = runoff.encode(parse_ranking(ranking))
+            if ballot:
+                runoff.ballots[ballot] += number
+        runoff._finish()
+        runoff.last_ballot = last
+    else:
+        new = poll.ballot_set.filter(pk__gt=runoff.last_ballot).order_by('pk')
+        rows = list(new.values_list('pk', 'ranking'))
+        if not rows:
+            return runoff
+        for pk, ranking in rows:
+            runoff.add(parse_ranking(ranking))
+        runoff.last_ballot = rows[-1][0]
+    cache.set(key, runoff, None)
+    return runoff
@@ -0,0 +1,104 @@
+'''
+Full-text search over poll questions and choice texts.
+
+On SQLite the text of every poll lives in the ``polls_poll_fts`` FTS5 table
+(created by migration 0008, rowid = poll id), which is kept in sync by the
+signal handlers below. Other databases fall back to a plain ``icontains``
+scan.
+'''
+import re
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Poll, Choice
+
+
+FTS_TABLE = 'polls_poll_fts'
+
+
+def uses_fts(using='default'):
+    return connections[using].vendor == 'sqlite'
+
+
+def match_expression(query):
+    '''
+    Turn free text typed by a user into a safe FTS5 query: every word must
+    match as a prefix. Returns an empty string if there is nothing to search.
+    '''
+    words = re.findall(r'\w+', query, re.UNICODE)
+    return u' '.join(u'"%s"*' % word for word in words)
+
+
+def index_polls(poll_ids, using='default', batch_size=500):
+    '''(Re)build the search entries of the given polls from the database.'''
+    if not uses_fts(using):
+        return
+    poll_ids = list(poll_ids)
+    with connections[using].cursor() as cursor:
+        for start in range(0, len(poll_ids), batch_size):
+            batch = poll_ids[start:start + batch_size]
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute('DELETE FROM {0} WHERE rowid IN ({1})'.format(
+                FTS_TABLE, placeholders), batch)
+            cursor.execute(
+                'INSERT INTO {0} (rowid, question, choices) '
+                'SELECT p.id, p.question, COALESCE(('
+                '    SELECT group_concat(c.choice_text, \' \') FROM polls_choice c '
+                '    WHERE c.poll_id = p.id), \'\') '
+                'FROM polls_poll p WHERE p.id IN ({1})'.format(
+                    FTS_TABLE, placeholders), batch)
+
+
+def index_poll(poll_id, using='default'):
+    '''(Re)build the search entry of one poll from the database.'''
+    index_polls([poll_id], using)
+
+
+def unindex_poll(poll_id, using='default'):
+    if not uses_fts(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute('DELETE FROM {0} WHERE rowid = %s'.format(FTS_TABLE), [poll_id])
+
+
+def search_polls(query, queryset=None):
+    '''
+    Return polls from `queryset` (default: public polls) matching `query`,
+    best matches first.
+    '''
+    if queryset is None:
+        queryset = Poll.objects.public()
+    if not uses_fts(queryset.db):
+        return queryset.filter(
+                Q(question__icontains=query) |
+                Q(choice__choice_text__icontains=query)).distinct()
+
+    expression = match_expression(query)
+    if not expression:
+        return queryset.none()
+    return queryset.extra(
+            select={'rank': '{0}.rank'.format(FTS_TABLE)},
+            tables=[FTS_TABLE],
+            where=['{0}.rowid = polls_poll.id'.format(FTS_TABLE),
+                   '{0} MATCH %s'.format(FTS_TABLE)],
+            params=[expression],
+            order_by=['rank'])
+
+
+@receiver(post_save, sender=Poll, dispatch_uid='polls_search_poll_saved')
+def poll_saved(sender, instance, using, **kwargs):
+    index_poll(instance.pk, using)
+
+
+@receiver(post_delete, sender=Poll, dispatch_uid='polls_search_poll_deleted')
+def poll_deleted(sender, instance, using, **kwargs):
+    unindex_poll(instance.pk, using)
+
+
+@receiver(post_save, sender=Choice, dispatch_uid='polls_search_choice_saved')
+@receiver(post_delete, sender=Choice, dispatch_uid='polls_search_choice_deleted')
+def choice_changed(sender, instance, using, **kwargs):
+    index_poll(instance.poll_id, using)
@@ -0,0 +1,167 @@
+'''
+Partitioning of Vote rows over several databases by poll.
+
+Every poll records the database holding its votes in Poll.vote_shard; new
+polls are spread over settings.VOTE_SHARDS, polls with a blank vote_shard
+keep their votes in the routed default database. Shards hold nothing but
+votes, so queries against them must not join Choice or Poll.
+'''
+from django.db import router
+from django.db.models import Count
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+
+from .models import Poll, Choice, Vote, vote_shards
+
+
+def vote_alias(vote_shard):
+    '''Return the database alias behind a Poll.vote_shard value.'''
+    return vote_shard or router.db_for_write(Vote)
+
+
+def _votes_on(alias, poll):
+    return Vote.objects.using(alias).filter(poll_id=poll.pk)
+
+
+class VotesMoved(Exception):
+    '''
+    Votes were saved on a database that a poll's votes were moved away
+    from. `vote_shards` holds {poll id: vote_shard} of the polls as they are.
+    '''
+
+    def __init__(self, vote_shards):
+        super(VotesMoved, self).__init__(vote_shards)
+        self.vote_shards = vote_shards
+
+
+def check_vote_aliases(aliases):
+    '''
+    Raise VotesMoved unless the votes of each poll of {poll id: alias}
+    are still on `alias`.
+
+    Call it in the transaction that saves the votes, once it has updated
+    the rows of the polls (e.g. with register_vote()): move_poll_votes()
+    switches a poll over by updating its row, so the votes are either
+    committed before the switch, and moved with the others, or rolled back.
+    Without VOTE_SHARDS nothing moves votes, and nothing is checked.
+    '''
+    if not vote_shards():
+        return
+    current = dict(Poll.objects.db_manager(router.db_for_write(Poll)).filter(
+            pk__in=list(aliases)).values_list('pk', 'vote_shard'))
+    if any(vote_alias(current[pk]) != alias for pk, alias in aliases.items()):
+        raise VotesMoved(current)
+
+
+def _copy_votes(votes, target, batch_size):
+    '''
+    Copy those of `votes` (all of one poll) whose user has no vote of the
+    poll in `target` yet.
+    '''
+    after = 0
+    while True:
+        batch = list(votes.filter(pk__gt=after).order_by('pk')[:batch_size])
+        if not batch:
+            return
+        copied = set(Vote.objects.using(target).filter(
+                poll_id=batch[0].poll_id, user_id__in=[v.user_id for v in batch]
+                ).values_list('user_id', flat=True))
+        Vote.objects.using(target).bulk_create(
+                Vote(poll_id=v.poll_id, choice_id=v.choice_id, user_id=v.user_id)
+                for v in batch if v.user_id not in copied)
+        after = batch[-1].pk
+
+
+def move_poll_votes(poll, target, batch_size=1000):
+    '''
+    Move all votes of `poll` to the database `target`.
+
+    Votes are copied in batches and the poll is switched over. Votes are
+    only committed to the old database before the switch (see
+    check_vote_aliases()), so the ones committed in the meantime, whatever
+    their primary key, are copied next and only then the originals are
+    deleted.
+    '''
+    source = vote_alias(poll.vote_shard)
+    if source != target:
+        # Leftovers of an interrupted move would clash with the copies.
+        _votes_on(target, poll).delete()
+        votes = _votes_on(source, poll)
+        _copy_votes(votes, target, batch_size)
+        Poll.objects.filter(pk=poll.pk).update(vote_shard=target)
+        _copy_votes(votes, target, batch_size)
+        votes.delete()
+    else:
+        Poll.objects.filter(pk=poll.pk).update(vote_shard=target)
+    poll.vote_shard = target
+
+
+def poll_sizes():
+    '''Return {poll id: (vote alias, number of votes)} for all polls.'''
+    placement = dict((pk, vote_alias(shard))
+                     for pk, shard in Poll.objects.values_list('pk', 'vote_shard'))
+    sizes = dict.fromkeys(placement, 0)
+    for alias in set(placement.values()):
+        tally = Vote.objects.using(alias).order_by().values_list(
+                'poll').annotate(Count('id'))
+        for poll_id, count in tally:
+            # Skip orphans and stale copies left behind on other databases.
+            if placement.get(poll_id) == alias:
+                sizes[poll_id] += count
+    return dict((pk, (placement[pk], sizes[pk])) for pk in placement)
+
+
+def plan_rebalance(shards=None):
+    '''
+    Return {poll id: target shard} moves that even out the number of votes
+    per shard. Polls whose votes aren't on one of `shards` are always moved.
+    '''
+    shards = shards or vote_shards()
+    sizes = poll_sizes()
+    load = dict.fromkeys(shards, 0)
+    placement = {}
+    homeless = []
+    for pk, (alias, size) in sizes.items():
+        if alias in load:
+            load[alias] += size
+            placement[pk] = alias
+        else:
+            homeless.append(pk)
+
+    moves = {}
+    for pk in sorted(homeless, key=lambda pk: sizes[pk][1], reverse=True):
+        target = min(shards, key=load.get)
+        moves[pk] = placement[pk] = target
+        load[target] += sizes[pk][1]
+
+    while True:
+        heavy = max(shards, key=load.get)
+        light = min(shards, key=load.get)
+        gap = load[heavy] - load[light]
+        # Moving a poll smaller than the gap always narrows it.
+        candidates = [pk for pk, alias in placement.items()
+                      if alias == heavy and 0 < sizes[pk][1] < gap]
+        if not candidates:
+            break
+        pk = min(candidates, key=lambda pk: abs(gap - 2 * sizes[pk][1]))
+        moves[pk] = placement[pk] = light
+        load[heavy] -= sizes[pk][1]
+        load[light] += sizes[pk][1]
+
+    return dict((pk, target) for pk, target in moves.items()
+                if target != sizes[pk][0])
+
+
+@receiver(pre_delete, sender=Poll, dispatch_uid='polls_sharding_poll_deleted')
+def poll_deleted(sender, instance, **kwargs):
+    # The cascade only reaches votes living next to their choices.
+    if instance.vote_shard:
+        instance.votes().delete()
+
+
+@receiver(pre_delete, sender=Choice, dispatch_uid='polls_sharding_choice_deleted')
+def choice_deleted(sender, instance, **kwargs):
+    shard = Poll.objects.filter(pk=instance.poll_id).values_list(
+            'vote_shard', flat=True).first()
+    if shard:
+        Vote.objects.using(shard).filter(choice_id=instance.pk).delete()
@@ -0,0 +1,93 @@
+'''
+Sitemaps of all public polls and categories, for search engines.
+
+The sitemap index lists a sitemap per chunk of POLLS_SITEMAP_CHUNK_SIZE
+primary keys of each section, so chunks stay the same as objects come
+and go. A chunk is read by keyset iteration over its range of primary
+keys, streamed to the crawler and cached at the same time. The cached
+copy is used until the chunk's version is bumped (see
+polls.caching.sitemap_key) or a scheduled poll goes live, so repeated
+crawls don't query the database at all.
+'''
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.core.urlresolvers import reverse
+from django.utils.html import escape
+
+from .caching import check_publications, get_version, sitemap_key
+from .models import Poll, PollCategory
+
+
+CONTENT_TYPE = 'application/xml; charset=utf-8'
+XML = u'<?xml version="1.0" encoding="UTF-8"?>\n'
+URLSET = u'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+SITEMAPINDEX = u'<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+
+SECTIONS = {
+    'polls': lambda: Poll.objects.public(),
+    'categories': lambda: PollCategory.objects.all(),
+}
+
+
+def chunk_size():
+    return getattr(settings, 'POLLS_SITEMAP_CHUNK_SIZE', 5000)
+
+
+def chunk_count(section):
+    last = SECTIONS[section]().model.objects.aggregate(last=Max('pk'))['last']
+    return (last - 1) // chunk_size() + 1 if last else 0
+
+
+def keyset(queryset, after, last, batch_size=500):
+    '''Yield lists of the objects of `queryset` with after < pk <= last, in order.'''
+    while True:
+        batch = list(queryset.filter(pk__gt=after, pk__lte=last).order_by('pk')[:batch_size])
+        if not batch:
+            return
+        yield batch
+        after = batch[-1].pk
+
+
+def sitemap_index(request):
+    site = u'{0}://{1}'.format(request.scheme, request.get_host())
+    parts = [XML, SITEMAPINDEX]
+    for section in sorted(SECTIONS):
+        for chunk in range(chunk_count(section)):
+            parts.append(u'<sitemap><loc>{0}{1}</loc></sitemap>\n'.format(site, escape(
+                    reverse('polls:sitemap', kwargs={'section': section, 'chunk': chunk}))))
+    parts.append(u'</sitemapindex>\n')
+    return HttpResponse(u''.join(parts), content_type=CONTENT_TYPE)
+
+
+def sitemap_chunk(request, section, chunk):
+    chunk = int(chunk)
+    if section not in SECTIONS:
+        raise Http404
+    check_publications()
+    first = chunk * chunk_size() + 1
+    site = u'{0}://{1}'.format(request.scheme, request.get_host())
+    cache_key = u'sitemap:{0}:{1}:{2}:{3}:{4}'.format(
+            site, section, chunk, get_version(sitemap_key(section, first)),
+            get_version('publications'))
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return HttpResponse(cached, content_type=CONTENT_TYPE)
+    if chunk >= chunk_count(section):
+        raise Http404
+
+    def stream():
+        parts = [XML + URLSET]
+        yield parts[-1]
+        queryset = SECTIONS[section]().only('pk')
+        for batch in keyset(queryset, first - 1, first + chunk_size() - 1):
+            parts.append(u''.join(u'<url><loc>{0}{1}</loc></url>\n'.format(
+                    site, escape(obj.get_absolute_url())) for obj in batch))
+            yield parts[-1]
+        parts.append(u'</urlset>\n')
+        yield parts[-1]
+        # Only reached when the whole chunk was sent.
+        cache.set(cache_key, u''.join(parts),
+                  getattr(settings, 'POLLS_SITEMAP_CACHE_SECONDS', 24 * 60 * 60))
+    return StreamingHttpResponse(stream(), content_type=CONTENT_TYPE)
@@ -0,0 +1,58 @@
+'''
+Running on SQLite under concurrent writes.
+
+Every new SQLite connection gets settings.SQLITE_PRAGMAS, by default WAL
+journaling so that pages are read while a vote is written. Waiting for
+the write lock is bounded by the 'timeout' option of the database.
+
+That wait doesn't cover a transaction which read before writing while
+another one committed: SQLite fails it at once with "database is locked".
+Writes that vote or save polls are wrapped in retry_on_lock(), which
+runs the whole transaction again after a short random delay.
+'''
+import random
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import OperationalError, connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+@receiver(connection_created, dispatch_uid='polls_sqlite_pragmas')
+def apply_pragmas(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    cursor = connection.cursor()
+    for name, value in getattr(settings, 'SQLITE_PRAGMAS', []):
+        # In-memory databases (tests) quietly stay in 'memory' journal mode.
+        cursor.execute('PRAGMA {0} = {1}'.format(name, value))
+
+
+def is_lock_error(error):
+    # SQLITE_BUSY is "database is locked", SQLITE_LOCKED "database table is locked".
+    return isinstance(error, OperationalError) and 'locked' in str(error)
+
+
+def retry_on_lock(func):
+    '''
+    Call `func` again, up to settings.POLLS_WRITE_RETRIES times with
+    exponential backoff and full jitter, while it fails because SQLite is
+    locked. `func` must do all its writes in transactions of its own, so
+    that a failed attempt leaves nothing behind; inside an outer
+    transaction it is called just once.
+    '''
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        retries = getattr(settings, 'POLLS_WRITE_RETRIES', 5)
+        delay = getattr(settings, 'POLLS_WRITE_RETRY_DELAY', 0.01)
+        for attempt in range(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if (not is_lock_error(e) or attempt == retries
+                        or any(c.in_atomic_block for c in connections.all())):
+                    raise
+            time.sleep(random.uniform(0, delay * 2 ** attempt))
+    return wrapped
@@ -0,0 +1,44 @@
+// Fills the elements marked with data-fragment="name" on cached pages with
+// the per-user HTML served by the polls:fragments view, and marks the polls
+// the user voted in.
+(function () {
+    var src = document.getElementById('fragments-script').getAttribute('data-src');
+
+    function markVoted(voted) {
+        var items = document.querySelectorAll('[data-poll]');
+        for (var i = 0; i < items.length; i++) {
+            if (voted.indexOf(+items[i].getAttribute('data-poll')) !== -1) {
+                items[i].className += ' voted';
+            }
+        }
+        var filters = document.querySelectorAll('[data-voted-filter]');
+        for (var j = 0; j < filters.length; j++) {
+            filters[j].hidden = false;
+            filters[j].querySelector('input').onchange = function () {
+                document.body.classList.toggle('hide-voted', this.checked);
+            };
+        }
+    }
+
+    document.addEventListener('DOMContentLoaded', function () {
+        var request = new XMLHttpRequest();
+        request.open('GET', src);
+        request.onload = function () {
+            if (request.status !== 200) {
+                return;
+            }
+            var fragments = JSON.parse(request.responseText);
+            var elements = document.querySelectorAll('[data-fragment]');
+            for (var i = 0; i < elements.length; i++) {
+                var name = elements[i].getAttribute('data-fragment');
+                if (fragments.hasOwnProperty(name)) {
+                    elements[i].innerHTML = fragments[name];
+                }
+            }
+            if (fragments.voted) {
+                markVoted(fragments.voted);
+            }
+        };
+        request.send();
+    });
+})();
@@ -0,0 +1,112 @@
+'''
+Voting in all polls of a survey with one form.
+
+Whether the user may still vote is checked for all polls of a survey at
+once: one query per vote database, plus one for archived votes and one
+for ballots when needed. The votes are then inserted with one bulk_create
+per vote database and the hot scores updated with one UPDATE, all in one
+transaction.
+
+bulk_create sends no post_save signals, so cast_votes() does the work of
+the receivers and of the vote view itself: it bumps the cached pages,
+the shared tallies and the sets of voted polls.
+'''
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Case, FloatField, Value, When
+from django.utils import timezone
+
+from .archive import check_not_archived
+from .caching import bump_version
+from .models import ArchivedVote, Ballot, Poll, PollClosed, Vote, add_hot_weight, hot_weight
+from .sharding import VotesMoved, check_vote_aliases, vote_alias
+from .sqlite import retry_on_lock
+from .voted import record_voted
+from . import tallies
+
+
+def already_voted(user, polls):
+    '''Return the primary keys of those of `polls` that `user` voted in.'''
+    by_alias = {}
+    for poll in polls:
+        if not poll.ranked:
+            by_alias.setdefault(vote_alias(poll.vote_shard), []).append(poll.pk)
+    voted = set()
+    for alias, poll_pks in by_alias.items():
+        voted.update(Vote.objects.using(alias).filter(
+                user=user, poll__in=poll_pks).values_list('poll_id', flat=True))
+    archived = [poll.pk for poll in polls if poll.archived_voters]
+    if archived:
+        voted.update(ArchivedVote.objects.filter(
+                user=user, poll__in=archived).values_list('poll_id', flat=True))
+    ranked = [poll.pk for poll in polls if poll.ranked]
+    if ranked:
+        voted.update(Ballot.objects.filter(
+                user=user, poll__in=ranked).values_list('poll_id', flat=True))
+    return voted
+
+
+def _in_transactions(aliases, func):
+    if not aliases:
+        return func()
+    with transaction.atomic(using=aliases[0]):
+        return _in_transactions(aliases[1:], func)
+
+
+def register_votes(poll_pks, when=None):
+    '''
+    Fold one vote cast at `when` (default: now) into hot_score of each
+    poll. Raises PollClosed if voting in one of them closed, see
+    Poll.register_vote().
+    '''
+    now = timezone.now()
+    weight = hot_weight(when or now)
+    polls = Poll.objects.filter(pk__in=poll_pks)
+    scores = {}
+    for pk, score, closes_at in polls.select_for_update().values_list(
+            'pk', 'hot_score', 'closes_at'):
+        if closes_at is not None and closes_at <= now:
+            raise PollClosed
+        scores[pk] = score
+    polls.update(hot_score=Case(
+            *[When(pk=pk, then=Value(add_hot_weight(score, weight)))
+              for pk, score in scores.items()],
+            output_field=FloatField()))
+
+
+@retry_on_lock
+def _save_votes(votes, vote_shards):
+    aliases = dict((pk, vote_alias(shard)) for pk, shard in vote_shards.items())
+    votes_by_alias = {}
+    for vote in votes:
+        votes_by_alias.setdefault(aliases[vote.poll_id], []).append(vote)
+
+    def save():
+        for alias, alias_votes in votes_by_alias.items():
+            Vote.objects.using(alias).bulk_create(alias_votes)
+        register_votes(list(vote_shards))
+        for user_pk in set(vote.user_id for vote in votes):
+            check_not_archived(user_pk, list(vote_shards))
+        check_vote_aliases(aliases)
+    _in_transactions([DEFAULT_DB_ALIAS] + sorted(votes_by_alias), save)
+
+
+def cast_votes(user, answers):
+    '''
+    Save the votes of `user` for the (poll, choice pk) pairs in `answers`,
+    all or nothing. Raises IntegrityError if the user already voted in one
+    of the polls, which the caller should have checked with
+    already_voted(), and PollClosed if voting in one of them closed.
+    '''
+    vote_shards = dict((poll.pk, poll.vote_shard) for poll, choice_pk in answers)
+    poll_pks = [poll.pk for poll, choice_pk in answers]
+    with tallies.counting([(poll.pk, choice_pk) for poll, choice_pk in answers]):
+        while True:
+            try:
+                _save_votes([Vote(poll_id=poll.pk, choice_id=choice_pk, user_id=user.pk)
+                             for poll, choice_pk in answers], vote_shards)
+                break
+            except VotesMoved as moved:
+                vote_shards = moved.vote_shards
+
+    bump_version(*['poll:{0}'.format(pk) for pk in poll_pks])
+    record_voted(user, *poll_pks)
@@ -0,0 +1,228 @@
+'''
+Vote tallies of the hottest polls, shared by all worker processes of a node.
+
+When settings.POLLS_TALLY_FILE is set, the vote counts of the choices of the
+POLLS_TALLY_POLLS hottest polls (and their numbers of voters) are kept in a
+memory-mapped file. Every worker maps the same file, the vote view
+increments counts in place, and the whole table is reloaded from the
+database every POLLS_TALLY_REFRESH seconds by whichever worker notices
+first. Anything not in the table is simply counted in the database.
+
+The file is an open-addressing hash table of (key, count) slots. Keys are
+choice primary keys, and minus poll primary keys for numbers of voters;
+0 marks an empty slot. Writers take an exclusive lock on the file and
+make the generation in the header odd while they write. Readers don't
+lock at all: they read again until they saw the same even generation
+before and after reading.
+
+Votes in polls of the table are saved and counted while holding the lock
+(see counting()), and the table is reloaded while holding it too, so the
+loader either finds a vote in the database or has it counted after it,
+never both. Votes in other polls don't wait for the lock; should the
+table be reloaded with their poll while they are saved, it is marked for
+another reload. The loader reads from the primary database.
+'''
+import struct
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .mapped import MappedFile, fcntl
+from .routers import is_pinned, pin_to_primary
+
+
+HEADER = struct.Struct('<8sqdq')  # magic, number of slots, time of last refresh, generation
+SLOT = struct.Struct('<qq')  # key, count
+MAGIC = b'POLLTLY2'
+GENERATION = struct.Struct('<q')
+GENERATION_OFFSET = HEADER.size - GENERATION.size
+
+
+class TallyStore(MappedFile):
+
+    def __init__(self, path, slots):
+        super(TallyStore, self).__init__(path, slots, HEADER, SLOT, MAGIC)
+
+    def _generation(self):
+        return GENERATION.unpack_from(self.map, GENERATION_OFFSET)[0]
+
+    def _bump_generation(self):
+        GENERATION.pack_into(self.map, GENERATION_OFFSET, self._generation() + 1)
+
+    def _offset(self, index):
+        return HEADER.size + index * SLOT.size
+
+    def _find(self, key):
+        '''Return the offset of the slot holding `key` or of an empty one.'''
+        index = (key * 2654435761) % self.slots
+        for i in range(self.slots):
+            offset = self._offset((index + i) % self.slots)
+            slot_key = SLOT.unpack_from(self.map, offset)[0]
+            if slot_key == key or slot_key == 0:
+                return offset
+        return None
+
+    def _get(self, key):
+        offset = self._find(key)
+        if offset is None:
+            return None
+        slot_key, count = SLOT.unpack_from(self.map, offset)
+        return count if slot_key == key else None
+
+    def get_many(self, keys):
+        '''Return {key: count, or None if not in the table} for `keys`, as of one moment.'''
+        while True:
+            generation = self._generation()
+            if generation % 2 == 0:
+                counts = dict((key, self._get(key)) for key in keys)
+                if self._generation() == generation:
+                    return counts
+            time.sleep(0)
+
+    def get(self, key):
+        return self.get_many([key])[key]
+
+    def incr_locked(self, *keys):
+        '''Count one more for each of `keys` that is in the table. Hold the lock.'''
+        self._bump_generation()
+        try:
+            for key in keys:
+                offset = self._find(key)
+                if offset is not None:
+                    slot_key, count = SLOT.unpack_from(self.map, offset)
+                    if slot_key == key:
+                        SLOT.pack_into(self.map, offset, key, count + 1)
+        finally:
+            self._bump_generation()
+
+    def incr(self, *keys):
+        '''Count one more for each of `keys` that is in the table.'''
+        self.lock()
+        try:
+            self.incr_locked(*keys)
+        finally:
+            self.unlock()
+
+    def refreshed(self):
+        '''Return the time the table was last loaded.'''
+        return HEADER.unpack_from(self.map, 0)[2]
+
+    def age(self):
+        return time.time() - self.refreshed()
+
+    def expire_locked(self):
+        '''Have the table reloaded by the next refresh(). Hold the lock.'''
+        HEADER.pack_into(self.map, 0, MAGIC, self.slots, 0, self._generation())
+
+    def load(self, counts):
+        '''Replace the whole table with `counts`, a {key: count} dict. Hold the lock.'''
+        generation = self._generation()
+        table = bytearray(self.size)
+        HEADER.pack_into(table, 0, MAGIC, self.slots, time.time(), generation + 2)
+        for key, count in list(counts.items())[:self.slots // 2]:
+            index = (key * 2654435761) % self.slots
+            while SLOT.unpack_from(table, self._offset(index))[0]:
+                index = (index + 1) % self.slots
+            SLOT.pack_into(table, self._offset(index), key, count)
+        self._bump_generation()
+        # The slots first, the header with the new generation last.
+        self.map[HEADER.size:] = bytes(table[HEADER.size:])
+        self.map[:HEADER.size] = bytes(table[:HEADER.size])
+
+    def refresh(self, max_age, loader):
+        '''
+        Reload the table from `loader()` if it is older than `max_age`
+        seconds, unless another process is already doing that.
+        '''
+        if self.age() <= max_age or not self.lock(blocking=False):
+            return
+        try:
+            # Votes are saved under the lock, see counting(): the ones
+            # committed before the query are counted in the table already.
+            if self.age() > max_age:
+                self.load(loader())
+        finally:
+            self.unlock()
+
+
+def hot_counts():
+    '''Return the tallies of the hottest polls, as stored in a TallyStore.'''
+    from .models import Poll
+
+    counts = {}
+    # Replicas may not have the votes committed before the reload yet.
+    pinned = is_pinned()
+    pin_to_primary()
+    try:
+        for poll in Poll.objects.hot()[:getattr(settings, 'POLLS_TALLY_POLLS', 20)]:
+            tally = poll.count_votes()
+            for choice_pk in poll.choice_set.values_list('pk', flat=True):
+                counts[choice_pk] = tally.get(choice_pk, 0)
+            counts[-poll.pk] = sum(tally.values())
+    finally:
+        pin_to_primary(pinned)
+    return counts
+
+
+_store = None
+
+
+def get_store():
+    '''Return this process' TallyStore, or None when they are disabled.'''
+    global _store
+    path = getattr(settings, 'POLLS_TALLY_FILE', None)
+    if not path or fcntl is None:
+        return None
+    if _store is None or _store.path != path:
+        _store = TallyStore(path, getattr(settings, 'POLLS_TALLY_SLOTS', 4096))
+    _store.refresh(getattr(settings, 'POLLS_TALLY_REFRESH', 60), hot_counts)
+    return _store
+
+
+def shared_counts(keys):
+    '''
+    Return {key: count} for all `keys` if every one of them is in the
+    shared table, otherwise None.
+    '''
+    store = get_store()
+    if store is None:
+        return None
+    counts = store.get_many(keys)
+    if None in counts.values():
+        return None
+    return counts
+
+
+@contextmanager
+def counting(votes):
+    '''
+    Count the (poll pk, choice pk) pairs of `votes` in the shared table
+    once the block, which saves them, succeeds. If one of the polls is in
+    the table, it is locked throughout, so that it isn't reloaded after
+    the votes are committed but before they are counted.
+    '''
+    store = get_store()
+    if store is None:
+        yield
+        return
+    poll_keys = [-poll_pk for poll_pk, choice_pk in votes]
+    refreshed = store.refreshed()
+    if set(store.get_many(poll_keys).values()) == set([None]):
+        yield
+        # Waits for a reload in progress, which may have missed the votes.
+        store.lock()
+        try:
+            if (store.refreshed() != refreshed and
+                    set(store.get_many(poll_keys).values()) != set([None])):
+                store.expire_locked()
+        finally:
+            store.unlock()
+        return
+    store.lock()
+    try:
+        yield
+        for poll_pk, choice_pk in votes:
+            store.incr_locked(choice_pk, -poll_pk)
+    finally:
+        store.unlock()
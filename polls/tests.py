@@ -1,19 +1,80 @@
 # -*- coding: utf-8 -*-
+import asyncore
 import datetime
+import json
+import math
+import os
+import random
+import shutil
+import smtpd
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from importlib import import_module
+from unittest import skipUnless
 
 from django.http import Http404
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import clear_url_caches, reverse
 from django.utils import timezone
-from django.test import TestCase
-from django.contrib.auth.models import User
-
-from .models import Poll, Choice, Vote, PollCategory
-from .forms import PollForm, ChoiceFormSet
-from .views import vote, ResultsView
-
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.http import HttpResponse
+from django.conf import settings
+from django.core.management import call_command
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.mail import send_mail
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import (IntegrityError, OperationalError, connection, connections,
+                       transaction)
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User, Permission
+
+from .models import (Poll, Choice, Vote, ArchivedVote, Ballot, PollCategory, Survey,
+                     PollClosed, HOT_HALF_LIFE, hot_weight)
+from .forms import PollForm, ChoiceFormSet, SurveyForm
+from .views import vote, save_vote, ResultsView
+from .search import search_polls, match_expression
+from .duplicates import MAX_CANDIDATES, TRIGRAM_TABLE, similar_polls, uses_trigrams
+from .routers import PrimaryReplicaRouter, pin_to_primary, is_pinned
+from .middleware import ReplicaPinningMiddleware
+from .sharding import move_poll_votes, plan_rebalance
+from . import sharding
+from .throttling import INFLIGHT_WINDOW, inflight_keys, stats, take_token
+from .bulk import create_polls
+from .mail import deliver_outbox, outbox_path, requeue_stale
+from .tallies import TallyStore, counting, get_store, hot_counts
+from .metrics import MetricsFile
+from .importtime import ImportTimer
+from .runoff import Runoff
+from .voted import record_voted, voted_key, voted_polls
+from .categories import import_categories, check_tree
+from .surveys import cast_votes
+from .archive import archive_poll, inactive_polls
+from .sqlite import retry_on_lock
+from .loadtest import SimulatedUser, skewed_order, create_storm_data, run_storm
+from .caching import cache_shell, check_publications
+
+
+@contextmanager
+def clock_ahead(delta):
+    """Make timezone.now() run `delta` ahead, as if that much time had passed."""
+    now = timezone.now
+    timezone.now = lambda: now() + delta
+    try:
+        yield
+    finally:
+        timezone.now = now
+
+
+# Most tests expect votes next to their polls, see VoteShardingTests.
+@override_settings(VOTE_SHARDS=[])
 class BaseTestCase(TestCase):
 
     def setUp(self):
+        cache.clear()
         self.u1 = User.objects.create(
             password='0d7ef89790c560955c04b11fa01a2af76c34add5',
             is_superuser=False, username='borsuk',
@@ -172,6 +233,20 @@ class PollMethodTests(BaseTestCase):
         self.assertEqual(first_poll.num_voters(), 1)
         self.assertEqual(second_poll.num_voters(), 3)
 
+    def test_results(self):
+        """
+        results() should return every choice with its number of votes.
+        """
+        poll = self.create_poll(question="Past poll.", days=-3, creator=self.u1)
+        choice1 = Choice.objects.create(poll=poll, choice_text='Answer 1')
+        choice2 = Choice.objects.create(poll=poll, choice_text='Answer 2')
+        Vote.objects.create(user=self.u2, choice=choice1)
+        Vote.objects.create(user=self.u3, choice=choice1)
+
+        self.assertEqual([(c.choice_text, c.num_votes) for c in poll.results()],
+                         [('Answer 1', 2), ('Answer 2', 0)])
+
+
 class PollIndexViewTests(BaseTestCase):
 
     def test_index_view_with_no_polls(self):
@@ -238,6 +313,124 @@ class PollIndexViewTests(BaseTestCase):
             ['<Poll: Past poll 2.>', '<Poll: Past poll 1.>']
         )
 
+    def test_index_view_with_hot_polls(self):
+        """
+        Polls that received votes should be listed as hot, most recent
+        voting activity first.
+        """
+        old_poll = self.create_poll(question="Old favourite.", days=-30, creator=self.u1)
+        new_poll = self.create_poll(question="New favourite.", days=-2, creator=self.u1)
+        quiet_poll = self.create_poll(question="Quiet poll.", days=-1, creator=self.u1)
+        now = timezone.now()
+        for hours in (48, 47, 46):
+            old_poll.register_vote(now - datetime.timedelta(hours=hours))
+        new_poll.register_vote(now)
+        response = self.client.get(reverse('polls:index'))
+
+        self.assertContains(response, 'Hot polls')
+        self.assertQuerysetEqual(
+            response.context['hot_poll_list'],
+            ['<Poll: New favourite.>', '<Poll: Old favourite.>']
+        )
+
+    def test_votes_keep_cached_index(self):
+        """
+        A vote should only drop the cached pages of its poll, not the listings.
+        """
+        poll = self.create_poll(question="Past poll.", days=-1, creator=self.u1)
+        choice = Choice.objects.create(poll=poll, choice_text='Answer')
+        self.client.get(reverse('polls:index'))
+        self.client.get(reverse('polls:results', args=(poll.id,)))
+        Vote.objects.create(user=self.u2, choice=choice)
+
+        with self.assertNumQueries(0):
+            self.client.get(reverse('polls:index'))
+        self.assertContains(self.client.get(reverse('polls:results', args=(poll.id,))),
+                            'Answer -- 1 vote<')
+
+    def test_cached_index_per_query_string(self):
+        """
+        Cached pages should be told apart by their query string and keep
+        their headers.
+        """
+        self.create_poll(question="Past poll.", days=-1, creator=self.u1)
+        first = self.client.get(reverse('polls:index'), {'page': '1'})
+        with self.assertNumQueries(0):
+            cached = self.client.get(reverse('polls:index'), {'page': '1'})
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('polls:index'), {'page': '2'})
+
+        self.assertTrue(len(queries) > 0)
+        self.assertEqual(cached.content, first.content)
+        self.assertEqual(sorted(cached.items()), sorted(first.items()))
+
+    def test_index_view_shows_scheduled_poll_when_published(self):
+        """
+        A cached index should be kept until a scheduled poll goes live,
+        and not a moment longer.
+        """
+        self.create_poll(question="Past poll.", days=-1, creator=self.u1)
+        Poll.objects.create(question="Scheduled poll.", created_by=self.u1,
+                            category=self.pc,
+                            pub_date=timezone.now() + datetime.timedelta(hours=1))
+        self.assertNotContains(self.client.get(reverse('polls:index')), "Scheduled poll.")
+        with clock_ahead(datetime.timedelta(minutes=59)), self.assertNumQueries(0):
+            self.assertNotContains(self.client.get(reverse('polls:index')), "Scheduled poll.")
+
+        with clock_ahead(datetime.timedelta(hours=1, seconds=1)):
+            self.assertContains(self.client.get(reverse('polls:index')), "Scheduled poll.")
+
+
+class HotScoreTests(BaseTestCase):
+
+    def test_register_vote_accumulates(self):
+        """
+        Simultaneous votes should add up: two votes double the weight.
+        """
+        poll = self.create_poll(question="A poll.", days=-1, creator=self.u1)
+        now = timezone.now()
+        poll.register_vote(now)
+        single = poll.hot_score
+        poll.register_vote(now)
+
+        self.assertAlmostEqual(poll.hot_score, single + 1)
+        self.assertAlmostEqual(Poll.objects.get(pk=poll.pk).hot_score, single + 1)
+
+    def test_register_vote_decays(self):
+        """
+        A vote one half-life ago should count half as much as a vote now.
+        """
+        older = self.create_poll(question="Older.", days=-1, creator=self.u1)
+        newer = self.create_poll(question="Newer.", days=-1, creator=self.u1)
+        now = timezone.now()
+        older.register_vote(now - HOT_HALF_LIFE)
+        older.register_vote(now - HOT_HALF_LIFE)
+        newer.register_vote(now)
+
+        self.assertAlmostEqual(older.hot_score, newer.hot_score)
+
+    def test_hot_excludes_future_polls(self):
+        """
+        Future polls should not show up as hot even if they have a score.
+        """
+        future_poll = self.create_poll(question="Future poll.", days=3, creator=self.u1)
+        future_poll.register_vote()
+
+        self.assertQuerysetEqual(Poll.objects.hot(), [])
+
+    def test_vote_view_updates_hot_score(self):
+        """
+        Voting through the view should make the poll hot.
+        """
+        self.client.force_login(self.u2)
+        poll = self.create_poll(question="A poll.", days=-1, creator=self.u1)
+        choice = Choice.objects.create(poll=poll, choice_text='An answer')
+        self.client.post(reverse('polls:voting_form', args=(poll.id,)),
+                         {u'choice': choice.pk})
+
+        self.assertQuerysetEqual(Poll.objects.hot(), ['<Poll: A poll.>'])
+
+
 
 class PollCategoryViewTests(BaseTestCase):
 
@@ -497,8 +690,32 @@ class VoteViewTests(BaseTestCase):
         self.assertEqual(response.status_code, 302)
         self.assertEqual(Vote.objects.all().count(), 0)
 
+    def test_one_vote_per_poll_enforced_by_database(self):
+        """
+        A second vote of the same user in a poll, even for another choice,
+        should be rejected by the unique (poll, user) index.
+        """
+        poll = self.create_poll(question='Past poll.', days=-5, creator=self.u1)
+        choice1 = Choice.objects.create(poll=poll, choice_text='Past answer 1')
+        choice2 = Choice.objects.create(poll=poll, choice_text='Past answer 2')
+        vote = Vote.objects.create(user=self.u2, choice=choice1)
+        self.assertEqual(vote.poll, poll)
+
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Vote.objects.create(user=self.u2, choice=choice2)
+        # The duplicate check is a single lookup, without a join.
+        with self.assertNumQueries(1):
+            self.assertTrue(poll.votes().filter(user=self.u2).exists())
+
 
 class ResultsViewTest(BaseTestCase):
+
+    def get_fragments(self, poll):
+        response = self.client.get(reverse('polls:fragments'),
+                                   {'poll': poll.pk, 'next': '/polls/'})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
     
     def test_results_view_with_a_future_poll(self):
         """
@@ -521,8 +738,10 @@ class ResultsViewTest(BaseTestCase):
         response = self.client.get(reverse('polls:results', args=(past_poll.pk,)))
 
         self.assertContains(response, past_poll.question, status_code=200)
-        self.assertContains(response, 'Update ?')
-        self.assertContains(response, 'Delete ?')
+        fragments = self.get_fragments(past_poll)
+        self.assertIn('Update ?', fragments['poll_actions'])
+        self.assertIn('Delete ?', fragments['poll_actions'])
+        self.assertIn('Logged in as', fragments['userinfo'])
 
     def test_results_view_without_login(self):
         """
@@ -532,9 +751,37 @@ class ResultsViewTest(BaseTestCase):
         response = self.client.get(reverse('polls:results', args=[poll.pk]))
 
         self.assertContains(response, poll.question, status_code=200)
-        self.assertNotContains(response, 'You voted:')
-        self.assertNotContains(response, 'Update ?')
-        self.assertNotContains(response, 'Delete ?')
+        fragments = self.get_fragments(poll)
+        self.assertNotIn('You voted:', fragments['poll_actions'])
+        self.assertNotIn('Update ?', fragments['poll_actions'])
+        self.assertNotIn('Delete ?', fragments['poll_actions'])
+        self.assertIn('log in', fragments['comment_form'])
+
+    def test_results_view_is_shared(self):
+        """
+        The results page should be the same for everyone and served from
+        the cache until the poll changes.
+        """
+        poll = self.create_poll(question='A poll.', days=-5, creator=self.u1)
+        choice = Choice.objects.create(poll=poll, choice_text='An answer')
+        url = reverse('polls:results', args=[poll.pk])
+        anonymous = self.client.get(url).content
+        self.client.force_login(self.u1)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).content, anonymous)
+        self.assertNotContains(self.client.get(url), 'Update ?')
+        Vote.objects.create(user=self.u2, choice=choice)
+        self.assertContains(self.client.get(url), 'An answer -- 1 vote<')
+
+    def test_fragments_your_vote(self):
+        poll = self.create_poll(question='A poll.', days=-5, creator=self.u1)
+        choice = Choice.objects.create(poll=poll, choice_text='An answer')
+        Vote.objects.create(user=self.u2, choice=choice)
+        self.client.force_login(self.u2)
+
+        self.assertIn('You voted: An answer', self.get_fragments(poll)['poll_actions'])
+        self.assertIn('csrfmiddlewaretoken', self.get_fragments(poll)['comment_form'])
 
 
     def test_results_view_without_polls(self):
@@ -850,3 +1097,1709 @@ class PollDeleteViewTests(BaseTestCase):
         response = self.client.get(reverse('polls:delete', args=[poll.pk]))
         self.assertEqual(response.status_code, 404)
         self.assertEqual(Poll.objects.all().count(), 1)
+
+
+class SearchTests(BaseTestCase):
+
+    def test_match_expression(self):
+        """
+        User input should be reduced to quoted prefix terms.
+        """
+        self.assertEqual(match_expression(u'kot" OR pies*'), u'"kot"* "OR"* "pies"*')
+        self.assertEqual(match_expression(u'  ?! '), u'')
+
+    def test_search_questions_and_choices(self):
+        """
+        Polls should be found by words from their question or choices.
+        """
+        cats = self.create_poll(question="Do you like cats?", days=-1, creator=self.u1)
+        dogs = self.create_poll(question="Best breed?", days=-1, creator=self.u1)
+        Choice.objects.create(poll=dogs, choice_text='Dachshund')
+
+        self.assertEqual(list(search_polls(u'cat')), [cats])
+        self.assertEqual(list(search_polls(u'dachs')), [dogs])
+        self.assertEqual(list(search_polls(u'parrot')), [])
+
+    def test_search_index_follows_changes(self):
+        """
+        Edited and deleted polls and choices should be reflected in results.
+        """
+        poll = self.create_poll(question="Old question?", days=-1, creator=self.u1)
+        choice = Choice.objects.create(poll=poll, choice_text='Marmot')
+        poll.question = 'New question?'
+        poll.save()
+        choice.delete()
+
+        self.assertEqual(list(search_polls(u'old')), [])
+        self.assertEqual(list(search_polls(u'marmot')), [])
+        self.assertEqual(list(search_polls(u'new')), [poll])
+        poll.delete()
+        self.assertEqual(list(search_polls(u'new')), [])
+
+    def test_search_ranking(self):
+        """
+        Polls matching more often should come first.
+        """
+        weak = self.create_poll(question="Badger or fox?", days=-1, creator=self.u1)
+        strong = self.create_poll(question="Badger, badger?", days=-1, creator=self.u1)
+
+        self.assertEqual(list(search_polls(u'badger')), [strong, weak])
+
+    def test_search_view_hides_future_polls(self):
+        """
+        The public search should only return published polls.
+        """
+        past_poll = self.create_poll(question="Past badger poll.", days=-1, creator=self.u1)
+        future_poll = self.create_poll(question="Future badger poll.", days=1, creator=self.u1)
+        response = self.client.get(reverse('polls:search'), {'q': 'badger'})
+
+        self.assertContains(response, past_poll.question)
+        self.assertNotContains(response, future_poll.question)
+
+
+@skipUnless(uses_trigrams(), "SQLite 3.34 or later is needed for the trigram index.")
+class DuplicateQuestionTests(BaseTestCase):
+
+    def post_poll(self, question, **extra):
+        data = {
+            u'question': question,
+            u'category': unicode(self.pc.pk),
+            u'choice_set-TOTAL_FORMS': u'2',
+            u'choice_set-INITIAL_FORMS': u'0',
+            u'choice_set-MIN_NUM_FORMS': u'0',
+            u'choice_set-MAX_NUM_FORMS': u'1000',
+            u'choice_set-0-choice_text': u'Yes',
+            u'choice_set-1-choice_text': u'No',
+        }
+        data.update(extra)
+        return self.client.post(reverse('polls:create'), data)
+
+    def indexed(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT rowid, question FROM {0} ORDER BY rowid'.format(TRIGRAM_TABLE))
+            return cursor.fetchall()
+
+    def test_similar_polls_ranked(self):
+        """
+        Public polls with nearly the same question should be found, most
+        similar first, with a fixed number of queries.
+        """
+        exact = self.create_poll(question="Do you like cats?", days=-1, creator=self.u1)
+        close = self.create_poll(question="Do you like cats at all?", days=-1, creator=self.u1)
+        self.create_poll(question="Do you like horse riding?", days=-1, creator=self.u1)
+        self.create_poll(question="Do you like cats?", days=1, creator=self.u1)
+        self.create_poll(question="What is the capital of Peru?", days=-1, creator=self.u1)
+
+        with self.assertNumQueries(3):
+            polls = similar_polls(u'do you like CATS')
+        self.assertEqual(polls, [exact, close])
+        self.assertEqual(polls[0].similarity, 1.0)
+        self.assertEqual(similar_polls(u'Which capital has the most bridges?'), [])
+
+    def test_hidden_polls_not_candidates(self):
+        """
+        Deleted and scheduled polls sharing the question's rarest trigrams
+        should not crowd out the public ones.
+        """
+        for i in range(MAX_CANDIDATES):
+            self.create_poll(question="Quixotic zebra quest?", days=1, creator=self.u1)
+        self.create_poll(question="Quixotic zebra quest!", days=-1,
+                         creator=self.u1).mark_deleted()
+        public = self.create_poll(question="A quixotic zebra quest?", days=-1, creator=self.u1)
+        self.assertEqual(similar_polls(u'Quixotic zebra quest'), [public])
+
+    def test_index_kept_in_sync(self):
+        poll = self.create_poll(question="Tea or coffee?", days=-1, creator=self.u1)
+        self.assertEqual(self.indexed(), [(poll.pk, u'tea or coffee')])
+        poll.question = "Beer or wine?"
+        poll.save()
+        self.assertEqual(similar_polls("Tea or coffee"), [])
+        self.assertEqual(similar_polls("Beer or wine"), [poll])
+
+        pks = create_polls([{'question': 'Milk or juice?', 'category': self.pc.pk}], self.u1)
+        self.assertIn((pks[0], u'milk or juice'), self.indexed())
+        poll.delete()
+        self.assertEqual(self.indexed(), [(pks[0], u'milk or juice')])
+
+    def test_create_poll_suggests_similar_polls(self):
+        """
+        A new poll like an existing one should only be saved once the user
+        confirmed it is different.
+        """
+        existing = self.create_poll(question="Is Pluto a planet?", days=-1, creator=self.u2)
+        self.client.force_login(self.u1)
+
+        response = self.post_poll(u'Is Pluto a planet ?!')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['form'].similar_polls, [existing])
+        self.assertContains(response, reverse('polls:voting_form', args=(existing.id,)))
+        self.assertContains(response, '<input id="id_create_anyway" name="create_anyway" '
+                                      'type="checkbox" />', html=True)
+        self.assertEqual(Poll.objects.count(), 1)
+
+        response = self.post_poll(u'Is Pluto a planet ?!', create_anyway=u'on')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Poll.objects.count(), 2)
+
+    def test_update_without_question_change_not_held(self):
+        self.create_poll(question="Is Pluto a planet?", days=-1, creator=self.u2)
+        poll = self.create_poll(question="Is Pluto a planet?", days=-1, creator=self.u1)
+        form = PollForm({'question': poll.question, 'category': self.pc.pk}, instance=poll)
+        self.assertTrue(form.is_valid())
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(TestCase):
+
+    def tearDown(self):
+        pin_to_primary(False)
+
+    def test_reads_go_to_replica(self):
+        router = PrimaryReplicaRouter()
+
+        self.assertEqual(router.db_for_read(Poll), 'replica')
+        self.assertEqual(router.db_for_write(Poll), 'default')
+
+    def test_pinned_reads_go_to_primary(self):
+        router = PrimaryReplicaRouter()
+        pin_to_primary()
+
+        self.assertEqual(router.db_for_read(Poll), 'default')
+
+    def test_reads_hit_replica_connection(self):
+        """
+        Reads should run on the replica connection, which doesn't see the
+        rows the primary hasn't committed yet, unless the thread is pinned.
+        """
+        poll = Poll.objects.create(question="Replicated?", pub_date=timezone.now(),
+                                   category=PollCategory.objects.create(name="Replicas"))
+        with CaptureQueriesContext(connections['replica']) as queries:
+            self.assertFalse(Poll.objects.filter(pk=poll.pk).exists())
+        self.assertEqual(len(queries), 1)
+
+        pin_to_primary()
+        with CaptureQueriesContext(connections['replica']) as queries:
+            self.assertTrue(Poll.objects.filter(pk=poll.pk).exists())
+        self.assertEqual(len(queries), 0)
+
+    def test_related_reads_follow_instance(self):
+        """
+        Objects related to an instance read from the primary should be read
+        from the primary too, even once the thread is no longer pinned.
+        """
+        poll = Poll.objects.create(question="Replicated?", pub_date=timezone.now(),
+                                   category=PollCategory.objects.create(name="Replicas"))
+        Choice.objects.create(poll=poll, choice_text="Yes")
+        pin_to_primary()
+        poll = Poll.objects.get(pk=poll.pk)
+        pin_to_primary(False)
+
+        with CaptureQueriesContext(connections['replica']) as queries:
+            self.assertEqual([c.choice_text for c in poll.choice_set.all()], ["Yes"])
+            self.assertEqual(poll.category.name, "Replicas")
+        self.assertEqual(len(queries), 0)
+
+    def test_only_pages_from_primary_cached(self):
+        """
+        Pages read from a replica may miss the change their version was
+        bumped for, and pinned clients must see their own writes.
+        """
+        cache.clear()
+        rendered = []
+
+        @cache_shell('poll:{pk}')
+        def view(request, pk):
+            rendered.append(is_pinned())
+            return HttpResponse('Results')
+        request = RequestFactory().get('/polls/1/results/')
+        view(request, pk=1)
+        view(request, pk=1)
+        self.assertEqual(rendered, [False, False])
+
+        pin_to_primary()
+        view(request, pk=1)
+        view(request, pk=1)
+        self.assertEqual(rendered, [False, False, True, True])
+        pin_to_primary(False)
+        self.assertEqual(view(request, pk=1).content, b'Results')
+        self.assertEqual(len(rendered), 4)
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_no_replicas(self):
+        self.assertEqual(PrimaryReplicaRouter().db_for_read(Poll), 'default')
+
+    def test_writes_pin_the_client(self):
+        """
+        A POST should be served by the primary and keep the client there
+        for the following requests.
+        """
+        factory = RequestFactory()
+        middleware = ReplicaPinningMiddleware()
+        request = factory.post('/polls/1/vote')
+        middleware.process_request(request)
+        self.assertTrue(is_pinned())
+        response = middleware.process_response(request, HttpResponse())
+        self.assertFalse(is_pinned())
+
+        request = factory.get('/polls/1/results/')
+        request.COOKIES[middleware.cookie_name] = response.cookies[middleware.cookie_name].value
+        middleware.process_request(request)
+        self.assertTrue(is_pinned())
+
+    def test_reads_are_not_pinned(self):
+        factory = RequestFactory()
+        middleware = ReplicaPinningMiddleware()
+        request = factory.get('/polls/')
+        middleware.process_request(request)
+        response = middleware.process_response(request, HttpResponse())
+
+        self.assertFalse(is_pinned())
+        self.assertNotIn(middleware.cookie_name, response.cookies)
+
+
+@override_settings(VOTE_SHARDS=['votes0', 'votes1'])
+class VoteShardingTests(BaseTestCase):
+    multi_db = True
+
+    def create_sharded_poll(self, question, shard):
+        poll = self.create_poll(question=question, days=-1, creator=self.u1)
+        poll.vote_shard = shard
+        poll.save()
+        for text in ('Answer 1', 'Answer 2'):
+            Choice.objects.create(poll=poll, choice_text=text)
+        return poll
+
+    def test_new_polls_get_a_shard(self):
+        poll = self.create_poll(question="A poll.", days=-1, creator=self.u1)
+
+        self.assertIn(poll.vote_shard, settings.VOTE_SHARDS)
+
+    def test_vote_on_shard(self):
+        """
+        Votes should be stored on, and read from, the poll's shard only.
+        """
+        shard = settings.VOTE_SHARDS[1]
+        poll = self.create_sharded_poll("A poll.", shard)
+        choice = poll.choice_set.all()[0]
+        self.client.force_login(self.u2)
+        url = reverse('polls:voting_form', args=(poll.id,))
+        self.client.post(url, {u'choice': choice.pk})
+        response = self.client.post(url, {u'choice': choice.pk})
+
+        self.assertEqual(response.context['error_message'], "Voting twice is not allowed.")
+        self.assertEqual(Vote.objects.count(), 0)
+        self.assertEqual(Vote.objects.using(shard).count(), 1)
+        self.assertEqual(poll.num_voters(), 1)
+        response = self.client.get(reverse('polls:results', args=(poll.id,)))
+        self.assertContains(response, 'Answer 1 -- 1 vote<')
+        response = self.client.get(reverse('polls:fragments'), {'poll': poll.pk})
+        self.assertIn('You voted: Answer 1', json.loads(response.content)['poll_actions'])
+
+    def test_move_poll_votes(self):
+        """
+        Votes of an unsharded poll should move to the given shard.
+        """
+        poll = self.create_sharded_poll("A poll.", '')
+        choice = poll.choice_set.all()[0]
+        for user in (self.u2, self.u3, self.u4):
+            Vote.objects.create(user=user, choice=choice)
+        shard = settings.VOTE_SHARDS[0]
+        move_poll_votes(poll, shard, batch_size=2)
+
+        self.assertEqual(Poll.objects.get(pk=poll.pk).vote_shard, shard)
+        self.assertEqual(Vote.objects.count(), 0)
+        self.assertEqual(Vote.objects.using(shard).count(), 3)
+        self.assertEqual(poll.num_voters(), 3)
+
+    def test_move_poll_votes_committed_late(self):
+        """
+        A vote committed on the old database during the move should be
+        moved as well, even if its primary key is below the copied ones.
+        """
+        poll = self.create_sharded_poll("A poll.", '')
+        choice = poll.choice_set.all()[0]
+        early_pk = Vote.objects.create(user=self.u2, choice=choice).pk
+        Vote.objects.filter(pk=early_pk).delete()
+        for user in (self.u3, self.u4):
+            Vote.objects.create(user=user, choice=choice)
+        shard = settings.VOTE_SHARDS[0]
+        copy_votes = sharding._copy_votes
+
+        def copy_then_vote(votes, target, batch_size):
+            copy_votes(votes, target, batch_size)
+            if not Vote.objects.filter(user=self.u2).exists():
+                Vote.objects.create(pk=early_pk, user=self.u2, choice=choice)
+        sharding._copy_votes = copy_then_vote
+        try:
+            move_poll_votes(poll, shard, batch_size=1)
+        finally:
+            sharding._copy_votes = copy_votes
+
+        self.assertEqual(Vote.objects.count(), 0)
+        self.assertEqual(sorted(Vote.objects.using(shard).values_list('user_id', flat=True)),
+                         [self.u2.pk, self.u3.pk, self.u4.pk])
+
+    def test_vote_follows_moved_poll(self):
+        """
+        A vote saved for a poll whose votes were moved meanwhile should be
+        saved on the poll's new database.
+        """
+        poll = self.create_sharded_poll("A poll.", '')
+        shard = settings.VOTE_SHARDS[1]
+        move_poll_votes(Poll.objects.get(pk=poll.pk), shard)
+        save_vote(poll, Vote(user=self.u2, poll=poll, choice=poll.choice_set.all()[0]))
+
+        self.assertEqual(poll.vote_shard, shard)
+        self.assertEqual(Vote.objects.count(), 0)
+        self.assertEqual(Vote.objects.using(shard).count(), 1)
+
+    def test_rebalance(self):
+        """
+        The rebalance command should even out the votes per shard.
+        """
+        first, second = settings.VOTE_SHARDS[:2]
+        big = self.create_sharded_poll("Big.", first)
+        small1 = self.create_sharded_poll("Small 1.", first)
+        small2 = self.create_sharded_poll("Small 2.", first)
+        for poll, users in ((big, (self.u2, self.u3)), (small1, (self.u4,)),
+                            (small2, (self.u5,))):
+            for user in users:
+                Vote.objects.using(first).create(user=user, choice=poll.choice_set.all()[0])
+
+        self.assertEqual(plan_rebalance([first, second]), {big.pk: second})
+        call_command('rebalance_vote_shards', stdout=open(os.devnull, 'w'))
+        self.assertEqual(Poll.objects.get(pk=big.pk).vote_shard, second)
+        self.assertEqual(Poll.objects.get(pk=big.pk).num_voters(), 2)
+        self.assertEqual(Vote.objects.using(first).count(), 2)
+
+    def test_delete_poll_deletes_shard_votes(self):
+        shard = settings.VOTE_SHARDS[1]
+        poll = self.create_sharded_poll("A poll.", shard)
+        Vote.objects.using(shard).create(user=self.u2, choice=poll.choice_set.all()[0])
+        poll.delete()
+
+        self.assertEqual(Vote.objects.using(shard).count(), 0)
+
+    @override_settings(VOTE_SHARDS=[])
+    def test_no_alias_check_without_shards(self):
+        poll = self.create_sharded_poll("A poll.", '')
+        with self.assertNumQueries(0):
+            sharding.check_vote_aliases({poll.pk: 'default'})
+
+
+@override_settings(POLLS_THROTTLE_USER_RATE=(2, 60), POLLS_THROTTLE_IP_RATE=(3, 60),
+                   POLLS_MAX_INFLIGHT_WRITES=5)
+class ThrottleTests(BaseTestCase):
+
+    def post_poll(self, question):
+        return self.client.post(reverse('polls:create'), {
+            u'question': question,
+            u'category': unicode(self.pc.pk),
+            u'choice_set-INITIAL_FORMS': u'0',
+            u'choice_set-TOTAL_FORMS': u'0',
+            u'choice_set-MAX_NUM_FORMS': u'1000',
+            u'choice_set-MIN_NUM_FORMS': u'0',
+            })
+
+    def test_throttle_per_user(self):
+        """
+        A user exceeding the rate should get 429 without anything written.
+        """
+        self.client.force_login(self.u1)
+        self.assertEqual(self.post_poll(u'First?').status_code, 302)
+        self.assertEqual(self.post_poll(u'Second?').status_code, 302)
+        response = self.post_poll(u'Third?')
+
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(Poll.objects.count(), 2)
+        self.assertEqual(stats()['throttled_user'], 1)
+
+    def test_throttle_per_ip(self):
+        """
+        Switching accounts shouldn't get around the limit per IP address.
+        """
+        for user in (self.u1, self.u2):
+            self.client.force_login(user)
+            self.post_poll(u'Question by %s?' % user)
+            self.post_poll(u'Favourite colour of %s?' % user)
+
+        self.assertEqual(Poll.objects.count(), 3)
+        self.assertEqual(stats()['throttled_ip'], 1)
+
+    def test_reads_are_not_throttled(self):
+        self.client.force_login(self.u1)
+        for i in range(5):
+            self.assertEqual(self.client.get(reverse('polls:create')).status_code, 200)
+
+    def test_load_shedding(self):
+        """
+        Writes should be turned away while too many are in flight.
+        """
+        self.client.force_login(self.u1)
+        cache.set(inflight_keys()[1], 5)
+        response = self.post_poll(u'Busy?')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(Poll.objects.count(), 0)
+        self.assertEqual(stats()['shed'], 1)
+        self.assertEqual(stats()['inflight'], 5)
+
+    def test_inflight_count_expires(self):
+        """
+        Writes counted in flight by a worker that never finished them
+        should stop counting after two windows.
+        """
+        started = time.time() - 2 * INFLIGHT_WINDOW
+        cache.set_many(dict.fromkeys(inflight_keys(started), 50))
+
+        self.assertEqual(stats()['inflight'], 0)
+        self.client.force_login(self.u1)
+        self.assertEqual(self.post_poll(u'Not busy?').status_code, 302)
+
+    def test_take_token_counts_previous_window(self):
+        """
+        Requests made at the end of the last window should still count
+        against the rate at the start of the next one.
+        """
+        window = int(time.time() // 60)
+        cache.set('throttle:test:%d' % (window - 1), 10)
+
+        self.assertEqual(take_token('throttle:test', (10, 60), now=window * 60 + 3), 3)
+        self.assertEqual(cache.get('throttle:test:%d' % window, 0), 0)
+        self.assertEqual(take_token('throttle:test', (10, 60), now=window * 60 + 6), 0)
+
+    def test_stats_view(self):
+        self.u1.is_staff = True
+        self.u1.save()
+        self.client.force_login(self.u1)
+        self.post_poll(u'First?')
+        response = self.client.get(reverse('polls:throttle_stats'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['allowed'], 1)
+
+
+class BulkCreateTests(BaseTestCase):
+
+    def test_create_polls(self):
+        """
+        All polls and their choices should be created, in order.
+        """
+        pets = PollCategory.objects.create(name='Pets', parent=self.pc)
+        pks = create_polls([
+            {'question': u'Cats or dogs?', 'category': u'Pets', 'choices': [u'Cats', u'Dogs']},
+            {'question': u'Tea?', 'category': self.pc.pk,
+             'pub_date': u'2016-03-01T12:00:00Z'},
+            ], self.u1)
+
+        self.assertEqual([Poll.objects.get(pk=pk).question for pk in pks],
+                         [u'Cats or dogs?', u'Tea?'])
+        first, second = Poll.objects.get(pk=pks[0]), Poll.objects.get(pk=pks[1])
+        self.assertEqual(first.category, pets)
+        self.assertEqual(first.created_by, self.u1)
+        self.assertEqual(set(first.choice_set.values_list('choice_text', flat=True)),
+                         {u'Cats', u'Dogs'})
+        self.assertEqual(second.pub_date.year, 2016)
+        self.assertEqual(list(search_polls(u'dogs')), [first])
+
+    def test_create_polls_in_batches(self):
+        """
+        The number of queries should not grow with the number of polls, and
+        every poll should get its own primary key, in order.
+        """
+        queries = []
+        for size in (10, 400):
+            with CaptureQueriesContext(connection) as context:
+                pks = create_polls([{'question': u'Batch {0} poll {1}?'.format(size, i),
+                                     'category': self.pc.pk, 'choices': [u'Yes', u'No']}
+                                    for i in range(size)], self.u1)
+            queries.append(len(context))
+            self.assertEqual(
+                    list(Poll.objects.filter(pk__in=pks).order_by('pk').values_list(
+                            'question', flat=True)),
+                    [u'Batch {0} poll {1}?'.format(size, i) for i in range(size)])
+            self.assertEqual(Choice.objects.filter(poll__in=pks).count(), 2 * size)
+        self.assertLess(queries[1], queries[0] + 15)
+        self.assertEqual(similar_polls(u'Batch 400 poll 399?')[0].pk, pks[-1])
+
+    def test_invalid_polls_create_nothing(self):
+        """
+        One bad poll should reject the whole batch, reporting its position.
+        """
+        with self.assertRaises(ValidationError) as cm:
+            create_polls([
+                {'question': u'Fine?', 'category': self.pc.pk},
+                {'question': u'', 'category': u'Nope', 'choices': [u'A', u'A']},
+                ], self.u1)
+
+        self.assertEqual(list(cm.exception.message_dict), [1])
+        self.assertEqual(len(cm.exception.message_dict[1]), 3)
+        self.assertEqual(Poll.objects.count(), 0)
+
+    def test_category_of_wrong_type(self):
+        """
+        A category that is neither a name nor a primary key should be
+        reported, not crash the import.
+        """
+        with self.assertRaises(ValidationError) as cm:
+            create_polls([
+                {'question': u'Listed?', 'category': [self.pc.pk]},
+                {'question': u'Nested?', 'category': {'name': u'Pets'}},
+                {'question': u'True?', 'category': True},
+                ], self.u1)
+
+        self.assertEqual(sorted(cm.exception.message_dict), [0, 1, 2])
+        self.assertEqual(cm.exception.message_dict[0],
+                         [u'Category must be a name or a primary key.'])
+
+    def test_bulk_create_view(self):
+        self.u1.user_permissions.add(Permission.objects.get(codename='add_poll'))
+        self.client.force_login(self.u1)
+        body = json.dumps({'polls': [
+            {'question': u'Poll %d?' % i, 'category': self.pc.pk,
+             'choices': [u'Yes', u'No']} for i in range(300)]})
+        response = self.client.post(reverse('polls:bulk_create'), body,
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(json.loads(response.content)['ids']), 300)
+        self.assertEqual(Choice.objects.count(), 600)
+
+    def test_bulk_create_view_without_permission(self):
+        self.client.force_login(self.u1)
+        response = self.client.post(reverse('polls:bulk_create'), '{"polls": []}',
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 403)
+
+    def test_bulk_create_view_errors(self):
+        self.u1.user_permissions.add(Permission.objects.get(codename='add_poll'))
+        self.client.force_login(self.u1)
+        response = self.client.post(reverse('polls:bulk_create'),
+                                    '{"polls": [{"question": "No category?"}]}',
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('0', json.loads(response.content)['errors'])
+
+
+class PollDeletionTests(BaseTestCase):
+
+    def create_voted_poll(self):
+        poll = self.create_poll(question="A poll.", days=-29, creator=self.u1)
+        choice = Choice.objects.create(poll=poll, choice_text='An answer')
+        for user in (self.u2, self.u3, self.u4, self.u5):
+            Vote.objects.create(user=user, choice=choice)
+        return poll
+
+    def test_PollDelete_POST_hides_poll(self):
+        """
+        Deleting should hide the poll at once but leave the purge for later.
+        """
+        self.client.force_login(self.u1)
+        poll = self.create_voted_poll()
+        response = self.client.post(reverse('polls:delete', args=[poll.pk]))
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Poll.objects.public().count(), 0)
+        self.assertEqual(Vote.objects.count(), 4)
+        self.assertEqual(self.client.get(reverse('polls:results', args=[poll.pk])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('polls:update', args=[poll.pk])).status_code, 404)
+        self.assertEqual(Poll.objects.get(pk=poll.pk).deletion_status(), 'Deleting, 4 votes left')
+
+    def test_deletion_status_counts_rows_left(self):
+        """
+        The votes left should go down as the purge deletes archived votes.
+        """
+        poll = self.create_voted_poll()
+        archive_poll(poll)
+        poll.mark_deleted()
+        self.assertEqual(poll.deletion_status(), 'Deleting, 4 votes left')
+        ArchivedVote.objects.filter(pk__in=list(
+                poll.archived_votes().values_list('pk', flat=True)[:3])).delete()
+        self.assertEqual(Poll.objects.get(pk=poll.pk).deletion_status(), 'Deleting, 1 votes left')
+
+    def test_admin_delete_hides_poll(self):
+        """
+        Deleting a poll from its admin page should leave the purge for later too.
+        """
+        poll = self.create_voted_poll()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        response = self.client.post(reverse('admin:polls_poll_delete', args=[poll.pk]),
+                                    {'post': 'yes'})
+
+        self.assertRedirects(response, reverse('admin:polls_poll_changelist'))
+        self.assertIsNotNone(Poll.objects.get(pk=poll.pk).deleted_at)
+        self.assertEqual(Vote.objects.count(), 4)
+
+    def test_purge_deleted_polls(self):
+        """
+        The purge should remove only deleted polls, in batches.
+        """
+        poll = self.create_voted_poll()
+        kept = self.create_poll(question="Kept.", days=-1, creator=self.u1)
+        poll.mark_deleted()
+        call_command('purge_deleted_polls', batch_size=3, stdout=open(os.devnull, 'w'))
+
+        self.assertEqual(list(Poll.objects.all()), [kept])
+        self.assertEqual(Choice.objects.count(), 0)
+        self.assertEqual(Vote.objects.count(), 0)
+
+
+class FakeSMTPServer(smtpd.SMTPServer):
+    """An SMTP stand-in that keeps what it receives in `messages`."""
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def start(self):
+        self.thread = threading.Thread(target=asyncore.loop,
+                                       kwargs={'timeout': 0.1, 'map': self._map})
+        self.thread.start()
+
+    def stop(self):
+        self.close()
+        self.thread.join()
+
+
+class RequeueingBackend(BaseEmailBackend):
+    """A delivery backend during whose sends another sender requeues stale messages."""
+    sent = []
+
+    def send_messages(self, email_messages):
+        requeue_stale(age=60)
+        self.sent.extend(email_messages)
+        return len(email_messages)
+
+
+class MailOutboxTests(TestCase):
+
+    def setUp(self):
+        self.outbox = tempfile.mkdtemp()
+        self.server = FakeSMTPServer()
+        self.server.start()
+        self.settings_override = override_settings(
+            EMAIL_BACKEND='polls.mail.OutboxEmailBackend',
+            EMAIL_DELIVERY_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_OUTBOX_DIR=self.outbox,
+            EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.server.port,
+            EMAIL_USE_TLS=False, EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='')
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.server.stop()
+        shutil.rmtree(self.outbox)
+
+    def test_mail_is_queued_then_delivered(self):
+        """
+        Sending should only write to the outbox, the sender delivers later.
+        """
+        for i in range(3):
+            send_mail(u'Hello %d' % i, u'Za\u017c\xf3\u0142\u0107', 'polls@example.com',
+                      ['borsuk@example.com'])
+
+        self.assertEqual(len(os.listdir(outbox_path('new'))), 3)
+        self.assertEqual(self.server.messages, [])
+        self.assertEqual(deliver_outbox(), (3, 0))
+        self.assertEqual(os.listdir(outbox_path('new')), [])
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.messages[0][1], ['borsuk@example.com'])
+        self.assertIn('Subject: Hello 0', self.server.messages[0][2])
+
+    def test_failed_delivery_is_retried(self):
+        """
+        Messages should stay queued while the server is down and be moved
+        aside after too many attempts.
+        """
+        send_mail(u'Hello', u'Body', 'polls@example.com', ['borsuk@example.com'])
+        self.server.stop()
+
+        self.assertEqual(deliver_outbox(max_attempts=2, backoff=0), (0, 0))
+        self.assertEqual(len(os.listdir(outbox_path('new'))), 1)
+        self.assertEqual(deliver_outbox(max_attempts=2, backoff=0), (0, 1))
+        self.assertEqual(os.listdir(outbox_path('new')), [])
+        self.assertEqual(len(os.listdir(outbox_path('failed'))), 1)
+        self.server = FakeSMTPServer()
+        self.server.start()
+
+    def test_corrupt_message_set_aside(self):
+        """
+        A message that can't be read should go to failed/ without holding
+        up the others.
+        """
+        send_mail(u'Hello', u'Body', 'polls@example.com', ['borsuk@example.com'])
+        with open(outbox_path('new', '0-corrupt'), 'wb') as f:
+            f.write('{"from": \n')
+
+        self.assertEqual(deliver_outbox(), (1, 1))
+        self.assertEqual(os.listdir(outbox_path('failed')), ['0-corrupt'])
+        self.assertEqual(os.listdir(outbox_path('new')), [])
+        self.assertEqual(len(self.server.messages), 1)
+
+    @override_settings(EMAIL_DELIVERY_BACKEND='polls.tests.RequeueingBackend')
+    def test_message_being_sent_not_requeued(self):
+        """
+        A message queued long ago but just claimed shouldn't be given back
+        while it is being sent.
+        """
+        send_mail(u'Hello', u'Body', 'polls@example.com', ['borsuk@example.com'])
+        name = os.listdir(outbox_path('new'))[0]
+        os.utime(outbox_path('new', name), (time.time() - 3600, time.time() - 3600))
+        RequeueingBackend.sent = []
+
+        self.assertEqual(deliver_outbox(), (1, 0))
+        self.assertEqual(len(RequeueingBackend.sent), 1)
+        self.assertEqual(os.listdir(outbox_path('new')), [])
+
+
+class MappedFileTestCase(BaseTestCase):
+    """Runs every test with a fresh file in settings, named by `file_setting`."""
+    file_setting = None
+    extra_settings = {}
+
+    def setUp(self):
+        super(MappedFileTestCase, self).setUp()
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        self.settings_override = override_settings(
+                **dict(self.extra_settings, **{self.file_setting: self.path}))
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        os.unlink(self.path)
+
+
+class TallyStoreTests(MappedFileTestCase):
+    file_setting = 'POLLS_TALLY_FILE'
+    extra_settings = {'POLLS_TALLY_SLOTS': 64}
+
+    def test_store_shared_between_processes(self):
+        """
+        Increments from another process should be visible in this one.
+        """
+        store = TallyStore(self.path, 64)
+        store.load({7: 1, -3: 5})
+        pid = os.fork()
+        if pid == 0:
+            TallyStore(self.path, 64).incr(7, -3, 8)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertEqual(store.get(7), 2)
+        self.assertEqual(store.get(-3), 6)
+        self.assertEqual(store.get(8), None)
+
+    def test_hot_poll_tallies_without_queries(self):
+        """
+        Tallies of hot polls should be read from shared memory and kept up
+        to date by the vote view.
+        """
+        poll = self.create_poll(question="Hot poll.", days=-1, creator=self.u1)
+        choice1 = Choice.objects.create(poll=poll, choice_text='Answer 1')
+        choice2 = Choice.objects.create(poll=poll, choice_text='Answer 2')
+        Vote.objects.create(user=self.u2, choice=choice1)
+        poll.register_vote()
+        get_store()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(poll.num_voters(), 1)
+        self.client.force_login(self.u3)
+        self.client.post(reverse('polls:voting_form', args=(poll.id,)),
+                         {u'choice': choice2.pk})
+        with self.assertNumQueries(1):
+            results = poll.results()
+        self.assertEqual([c.num_votes for c in results], [1, 1])
+        self.assertEqual(poll.num_voters(), 2)
+
+    def test_untracked_polls_use_database(self):
+        poll = self.create_poll(question="Quiet poll.", days=-1, creator=self.u1)
+        choice = Choice.objects.create(poll=poll, choice_text='Answer')
+        Vote.objects.create(user=self.u2, choice=choice)
+
+        self.assertEqual(poll.num_voters(), 1)
+        self.assertEqual(poll.results()[0].num_votes, 1)
+
+    def test_vote_not_counted_twice_around_reload(self):
+        """
+        A reload of the table shouldn't happen between saving a vote and
+        counting it, or the vote would be counted twice.
+        """
+        poll = self.create_poll(question="Hot poll.", days=-1, creator=self.u1)
+        choice = Choice.objects.create(poll=poll, choice_text='Answer')
+        Vote.objects.create(user=self.u2, choice=choice)
+        poll.register_vote()
+        store = get_store()
+
+        with override_settings(POLLS_TALLY_REFRESH=-1):
+            with counting([(poll.pk, choice.pk)]):
+                Vote.objects.create(user=self.u3, choice=choice)
+                # Another worker finds the table due for a reload.
+                worker = threading.Thread(target=get_store)
+                worker.start()
+                worker.join()
+
+        self.assertEqual(store.get_many([choice.pk, -poll.pk]), {choice.pk: 2, -poll.pk: 2})
+
+    def test_votes_in_other_polls_not_locked(self):
+        """
+        Saving a vote in a poll that isn't in the table shouldn't wait for
+        the lock.
+        """
+        poll = self.create_poll(question="Quiet poll.", days=-1, creator=self.u1)
+        choice = Choice.objects.create(poll=poll, choice_text='Answer')
+        store = get_store()
+        locked, release = threading.Event(), threading.Event()
+
+        def hold():
+            store.lock()
+            locked.set()
+            release.wait(5)
+            store.unlock()
+        holder = threading.Thread(target=hold)
+        holder.start()
+        locked.wait()
+        try:
+            with counting([(poll.pk, choice.pk)]):
+                saved_while_locked = holder.is_alive()
+                release.set()
+        finally:
+            release.set()
+            holder.join()
+        self.assertTrue(saved_while_locked)
+
+    def test_reload_during_unlocked_vote_expires_table(self):
+        """
+        If the table is reloaded with a poll while a vote in it is being
+        saved, the reload may have missed the vote and should be redone.
+        """
+        poll = self.create_poll(question="Rising poll.", days=-1, creator=self.u1)
+        choice = Choice.objects.create(poll=poll, choice_text='Answer')
+        store = get_store()
+        with counting([(poll.pk, choice.pk)]):
+            store.lock()
+            store.load({choice.pk: 0, -poll.pk: 0})
+            store.unlock()
+        self.assertGreater(store.age(), 60)
+
+    @override_settings(DATABASE_REPLICAS=['replica'])
+    def test_tallies_loaded_from_primary(self):
+        poll = self.create_poll(question="Hot poll.", days=-1, creator=self.u1)
+        choice = Choice.objects.create(poll=poll, choice_text='Answer')
+        Vote.objects.create(user=self.u2, choice=choice)
+        poll.register_vote()
+        with CaptureQueriesContext(connections['replica']) as replica_queries:
+            counts = hot_counts()
+        self.assertEqual(counts, {choice.pk: 1, -poll.pk: 1})
+        self.assertEqual(len(replica_queries), 0)
+        self.assertFalse(is_pinned())
+
+    def test_readers_wait_for_writers(self):
+        """
+        Readers shouldn't see a table that is being written.
+        """
+        store = TallyStore(self.path, 64)
+        store.load({7: 1})
+        store.lock()
+        store._bump_generation()
+        reads = []
+        reader = threading.Thread(target=lambda: reads.append(store.get(7)))
+        reader.start()
+        reader.join(0.05)
+        self.assertEqual(reads, [])
+        store._bump_generation()
+        store.unlock()
+        reader.join()
+
+        self.assertEqual(reads, [1])
+
+
+class MetricsTests(MappedFileTestCase):
+    file_setting = 'POLLS_METRICS_FILE'
+
+    def metrics(self):
+        response = self.client.get(reverse('polls:metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        return response.content.decode('utf-8').splitlines()
+
+    def test_votes_counted_by_result(self):
+        poll = self.create_poll(question="Counted poll.", days=-1, creator=self.u1)
+        choice = Choice.objects.create(poll=poll, choice_text='Yes')
+        url = reverse('polls:voting_form', args=(poll.id,))
+        for user, data in [(self.u1, {'choice': choice.pk}), (self.u2, {}),
+                           (self.u2, {'choice': choice.pk}), (self.u2, {'choice': choice.pk})]:
+            self.client.force_login(user)
+            self.client.post(url, data)
+
+        lines = self.metrics()
+        self.assertIn('# TYPE polls_votes_total counter', lines)
+        for result, count in [('accepted', 1), ('double_vote', 1), ('own_poll', 1),
+                              ('no_choice', 1)]:
+            self.assertIn('polls_votes_total{{result="{0}"}} {1}'.format(result, count), lines)
+        self.assertIn('polls_throttle_requests_total{outcome="allowed"} 4', lines)
+
+    def test_survey_votes_counted_by_result(self):
+        polls = [self.create_poll(question="Survey poll {0}.".format(i), days=-1,
+                                  creator=self.u1) for i in range(3)]
+        choices = [Choice.objects.create(poll=poll, choice_text='Yes') for poll in polls]
+        survey = Survey.objects.create(title='Survey', created_by=self.u1)
+        survey.polls.add(*polls)
+        url = reverse('polls:survey', args=(survey.id,))
+        self.client.force_login(self.u2)
+        # The third answer is missing.
+        self.client.post(url, {'poll-{0}'.format(polls[0].pk): choices[0].pk,
+                               'poll-{0}'.format(polls[1].pk): choices[1].pk})
+        self.client.post(url, dict(('poll-{0}'.format(choice.poll_id), choice.pk)
+                                   for choice in choices))
+
+        lines = self.metrics()
+        self.assertIn('polls_votes_total{result="no_choice"} 1', lines)
+        self.assertIn('polls_votes_total{result="accepted"} 3', lines)
+
+    def test_requests_timed_and_queries_counted(self):
+        poll = self.create_poll(question="Timed poll.", days=-1, creator=self.u1)
+        for i in range(3):
+            self.client.get(reverse('polls:results', args=(poll.id,)))
+
+        lines = self.metrics()
+        self.assertIn('polls_request_duration_seconds_count{view="polls:results"} 3', lines)
+        self.assertIn('polls_request_duration_seconds_bucket{le="+Inf",view="polls:results"} 3',
+                      lines)
+        self.assertIn('polls_request_queries_count{view="polls:results"} 3', lines)
+        # The first request ran queries, the others were served from the cache.
+        queries = [line for line in lines
+                   if line.startswith('polls_request_queries_sum{view="polls:results"}')]
+        self.assertGreater(int(queries[0].split()[1]), 0)
+        self.assertIn('polls_request_queries_bucket{le="1",view="polls:results"} 2', lines)
+        self.assertFalse(connection.force_debug_cursor)
+
+    def test_metrics_shared_between_processes(self):
+        """
+        Metrics recorded by another worker process should be added up with
+        those of this one.
+        """
+        store = MetricsFile(self.path, 64)
+        store.add({'polls_created_total{source="form"}': 1})
+        pid = os.fork()
+        if pid == 0:
+            MetricsFile(self.path, 64).add({'polls_created_total{source="form"}': 2,
+                                            'polls_created_total{source="bulk"}': 5})
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertEqual(sorted(store.items()), [('polls_created_total{source="bulk"}', 5),
+                                                 ('polls_created_total{source="form"}', 3)])
+
+    def test_metrics_not_public(self):
+        response = self.client.get(reverse('polls:metrics'), REMOTE_ADDR='10.1.2.3')
+        self.assertEqual(response.status_code, 403)
+
+
+class RankedPollTests(BaseTestCase):
+
+    def setUp(self):
+        super(RankedPollTests, self).setUp()
+        self.poll = self.create_poll(question="Ranked poll.", days=-1, creator=self.u1)
+        self.poll.ranked = True
+        self.poll.save()
+        self.a, self.b, self.c = [
+            Choice.objects.create(poll=self.poll, choice_text=text)
+            for text in ('A', 'B', 'C')]
+
+    def test_runoff_rounds(self):
+        """
+        The choice with the fewest votes should be eliminated and its
+        ballots transferred until one choice has a majority.
+        """
+        runoff = Runoff([1, 2, 3])
+        for ranking in ([1, 2], [1], [2, 1], [3, 2], [3, 2]):
+            runoff.add(ranking)
+        report = runoff.report(['A', 'B', 'C'])
+        self.assertEqual([r['votes'] for r in report['rounds']],
+                         [[2, 1, 2], [3, None, 2]])
+        self.assertEqual(report['rounds'][0]['eliminated'], 'B')
+        self.assertEqual(report['winner'], 'A')
+
+    def test_incremental_runoff_matches_recount(self):
+        """
+        Adding ballots one by one should give the same rounds as counting
+        all of them at once.
+        """
+        rng = random.Random(3)
+        choice_ids = [10, 20, 30, 40, 50]
+        runoff = Runoff(choice_ids)
+        for i in range(300):
+            ranking = rng.sample(choice_ids, rng.randint(1, 5))
+            runoff.add(ranking)
+            recount = Runoff(choice_ids)
+            recount.ballots = runoff.ballots.copy()
+            recount._finish()
+            self.assertEqual(runoff.rounds, recount.rounds)
+
+    def test_vote_with_ranking(self):
+        self.client.force_login(self.u2)
+        response = self.client.post(
+                reverse('polls:voting_form', args=(self.poll.id,)),
+                {'rank-{0}'.format(self.a.pk): '2', 'rank-{0}'.format(self.c.pk): '1'})
+        self.assertRedirects(response, reverse('polls:results', args=(self.poll.id,)))
+        ballot = Ballot.objects.get(poll=self.poll, user=self.u2)
+        self.assertEqual([c.choice_text for c in ballot.choices()], ['C', 'A'])
+        self.assertEqual(self.poll.num_voters(), 1)
+
+    def test_vote_with_repeated_rank(self):
+        self.client.force_login(self.u2)
+        response = self.client.post(
+                reverse('polls:voting_form', args=(self.poll.id,)),
+                {'rank-{0}'.format(self.a.pk): '1', 'rank-{0}'.format(self.b.pk): '1'})
+        self.assertContains(response, "Each rank can only be given to one choice.")
+        self.assertFalse(Ballot.objects.exists())
+
+    def test_results_only_read_new_ballots(self):
+        """
+        Results should come from the cached rounds, updated with the
+        ballots cast since they were counted.
+        """
+        users = [self.u2, self.u3, self.u4]
+        for user, ranking in zip(users, [[self.a, self.b], [self.b], [self.c, self.b]]):
+            Ballot.objects.create(poll=self.poll, user=user,
+                                  ranking=','.join(str(c.pk) for c in ranking))
+        self.assertEqual(self.poll.runoff()['winner'], self.b)
+
+        Ballot.objects.create(poll=self.poll, user=self.u5, ranking=str(self.a.pk))
+        # Choices, new ballots.
+        with self.assertNumQueries(2):
+            report = self.poll.runoff()
+        self.assertEqual([r['votes'] for r in report['rounds']],
+                         [[2, 1, 1], [2, 2, None], [2, None, None]])
+        self.assertEqual(report['winner'], self.a)
+
+        response = self.client.get(reverse('polls:results', args=(self.poll.id,)))
+        self.assertContains(response, 'Winner: A')
+
+
+class VotedPollsTests(BaseTestCase):
+
+    def setUp(self):
+        super(VotedPollsTests, self).setUp()
+        self.poll1 = self.create_poll(question="First poll.", days=-1, creator=self.u1)
+        self.poll2 = self.create_poll(question="Second poll.", days=-1, creator=self.u1)
+        self.choice1 = Choice.objects.create(poll=self.poll1, choice_text='Yes')
+        self.choice2 = Choice.objects.create(poll=self.poll2, choice_text='Yes')
+
+    def test_voted_polls_cached_and_updated_on_vote(self):
+        """
+        The polls a user voted in should be loaded once and then kept up to
+        date by the vote view.
+        """
+        Vote.objects.create(user=self.u2, choice=self.choice1)
+        with self.assertNumQueries(3):  # Votes, archived votes and ballots.
+            self.assertEqual(voted_polls(self.u2), set([self.poll1.pk]))
+        with self.assertNumQueries(0):
+            voted_polls(self.u2)
+
+        self.client.force_login(self.u2)
+        self.client.post(reverse('polls:voting_form', args=(self.poll2.id,)),
+                         {u'choice': self.choice2.pk})
+        with self.assertNumQueries(0):
+            self.assertEqual(voted_polls(self.u2), set([self.poll1.pk, self.poll2.pk]))
+
+    def test_locked_set_dropped_on_vote(self):
+        """
+        A vote recorded while the set is locked should drop the set rather
+        than lose the vote.
+        """
+        Vote.objects.create(user=self.u2, choice=self.choice1)
+        voted_polls(self.u2)
+        cache.add(voted_key(self.u2.pk) + ':lock', 1)
+        Vote.objects.create(user=self.u2, choice=self.choice2)
+        record_voted(self.u2, self.poll2.pk)
+        cache.delete(voted_key(self.u2.pk) + ':lock')
+
+        self.assertEqual(voted_polls(self.u2), set([self.poll1.pk, self.poll2.pk]))
+
+    def test_voted_polls_in_fragments_and_search(self):
+        Vote.objects.create(user=self.u2, choice=self.choice1)
+        self.client.force_login(self.u2)
+        response = self.client.get(reverse('polls:fragments'), {'next': '/polls/'})
+        self.assertEqual(json.loads(response.content)['voted'], [self.poll1.pk])
+
+        response = self.client.get(reverse('polls:search'), {'q': 'poll'})
+        self.assertContains(response, 'data-poll="{0}" class=" voted"'.format(self.poll1.pk))
+        self.assertContains(response, 'data-poll="{0}" class=""'.format(self.poll2.pk))
+
+    def test_anonymous_fragments_without_voted(self):
+        response = self.client.get(reverse('polls:fragments'), {'next': '/polls/'})
+        self.assertNotIn('voted', json.loads(response.content))
+
+
+class SurveyTests(BaseTestCase):
+
+    def create_survey(self, polls):
+        survey = Survey.objects.create(title='Survey', created_by=self.u1)
+        survey.polls.add(*polls)
+        return survey
+
+    def create_polls(self, count, creator=None):
+        polls = []
+        for i in range(count):
+            poll = self.create_poll(question='Question {0}.'.format(i), days=-1,
+                                    creator=creator or self.u1)
+            Choice.objects.create(poll=poll, choice_text='Yes')
+            Choice.objects.create(poll=poll, choice_text='No')
+            polls.append(poll)
+        return polls
+
+    def answers(self, polls, text='Yes'):
+        return dict(('poll-{0}'.format(poll.pk), poll.choice_set.get(choice_text=text).pk)
+                    for poll in polls)
+
+    def test_survey_votes_in_all_open_polls(self):
+        """
+        Submitting a survey should vote in every poll the user may still
+        vote in, and skip own, voted and closed polls.
+        """
+        polls = self.create_polls(2)
+        own, = self.create_polls(1, creator=self.u2)
+        voted, closed = self.create_polls(2)
+        Vote.objects.create(user=self.u2, choice=voted.choice_set.get(choice_text='No'))
+        closed.closes_at = timezone.now() - datetime.timedelta(minutes=1)
+        closed.save()
+        survey = self.create_survey(polls + [own, voted, closed])
+        self.client.get(reverse('polls:results', args=(polls[0].id,)))  # Cache the page.
+        self.assertEqual(voted_polls(self.u2), set([voted.pk]))
+
+        self.client.force_login(self.u2)
+        response = self.client.get(reverse('polls:survey', args=(survey.id,)))
+        self.assertEqual(sorted(response.context['form'].fields),
+                         sorted(self.answers(polls)))
+        self.assertEqual(dict(response.context['form'].skipped), {
+            own: "You can't vote in your own poll.",
+            voted: "You already voted.",
+            closed: "Voting in this poll is closed.",
+        })
+
+        response = self.client.post(reverse('polls:survey', args=(survey.id,)),
+                                    self.answers(polls))
+        self.assertRedirects(response, reverse('polls:survey', args=(survey.id,)))
+        for poll in polls:
+            poll = Poll.objects.get(pk=poll.pk)
+            self.assertEqual(poll.vote_of(self.u2).choice.choice_text, 'Yes')
+            self.assertIsNotNone(poll.hot_score)
+        self.assertEqual(Vote.objects.filter(user=self.u2).count(), 3)
+        self.assertEqual(voted_polls(self.u2), set(p.pk for p in polls + [voted]))
+        response = self.client.get(reverse('polls:results', args=(polls[0].id,)))
+        self.assertContains(response, 'Yes -- 1 vote')
+
+    def test_survey_queries_independent_of_size(self):
+        """
+        Checking and saving the votes of a survey should take as many
+        queries for 20 polls as for 2.
+        """
+        queries = []
+        for size in (2, 20):
+            survey = self.create_survey(self.create_polls(size))
+            answers = self.answers(survey.polls.all(), 'No')
+            self.client.force_login(self.u2)
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post(reverse('polls:survey', args=(survey.id,)), answers)
+            self.assertEqual(response.status_code, 302)
+            queries.append(len(context))
+        self.assertEqual(Vote.objects.filter(user=self.u2).count(), 22)
+        self.assertEqual(queries[0], queries[1])
+
+    def test_survey_needs_all_answers(self):
+        polls = self.create_polls(3)
+        survey = self.create_survey(polls)
+        answers = self.answers(polls)
+        del answers['poll-{0}'.format(polls[1].pk)]
+        self.client.force_login(self.u2)
+        response = self.client.post(reverse('polls:survey', args=(survey.id,)), answers)
+        self.assertFormError(response, 'form', 'poll-{0}'.format(polls[1].pk),
+                             "You didn't select a choice.")
+        self.assertFalse(Vote.objects.filter(user=self.u2).exists())
+
+    def test_survey_saves_nothing_when_a_vote_exists(self):
+        """
+        If the user voted in one of the polls after the form was checked,
+        none of the survey's votes should be saved.
+        """
+        polls = self.create_polls(3)
+        form = SurveyForm(self.create_survey(polls), self.u2, self.answers(polls))
+        self.assertTrue(form.is_valid())
+        Vote.objects.create(user=self.u2, choice=polls[2].choice_set.get(choice_text='No'))
+        with self.assertRaises(IntegrityError):
+            form.save()
+        self.assertEqual(Vote.objects.filter(user=self.u2).count(), 1)
+        self.assertIsNone(Poll.objects.get(pk=polls[0].pk).hot_score)
+
+
+class CategoryImportTests(BaseTestCase):
+
+    def tree(self):
+        return list(PollCategory.objects.order_by('pk').values_list(
+                'name', 'parent__name', 'lft', 'rght', 'tree_id', 'level'))
+
+    def test_import_builds_same_tree_as_mptt(self):
+        """
+        Imported categories should end up exactly where inserting them one
+        by one (or mptt's own rebuild) would put them.
+        """
+        created = import_categories([
+            'Science > Physics > Optics',
+            '# comment',
+            'Science > Biology',
+            'All polls > Misc',
+            '',
+            'Arts',
+        ])
+        self.assertEqual(created, 6)
+        self.assertEqual(check_tree(), [])
+        imported = self.tree()
+        PollCategory.objects.rebuild()
+        self.assertEqual(self.tree(), imported)
+        science = PollCategory.objects.get(name='Science')
+        self.assertEqual([c.name for c in science.get_descendants()],
+                         ['Biology', 'Physics', 'Optics'])
+
+    def test_import_rejects_conflicting_paths(self):
+        PollCategory.objects.create(name='Physics')
+        before = self.tree()
+        with self.assertRaises(ValidationError) as cm:
+            import_categories(['Science > Physics', 'Arts > Music', 'Music'])
+        self.assertEqual(sorted(cm.exception.message_dict), [1, 3])
+        self.assertEqual(self.tree(), before)
+
+    def test_admin_import(self):
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.force_login(admin_user)
+        url = reverse('admin:polls_pollcategory_import')
+        response = self.client.post(url, {'paths': 'Sport > Chess\nSport > Go'})
+        self.assertRedirects(response, reverse('admin:polls_pollcategory_changelist'))
+        self.assertEqual(PollCategory.objects.get(name='Go').parent.name, 'Sport')
+
+        response = self.client.post(url, {'paths': 'Chess'})
+        self.assertContains(response, 'Line 1: &quot;Chess&quot; already exists under &quot;Sport&quot;.')
+
+
+class ClosedPollTests(BaseTestCase):
+
+    def setUp(self):
+        super(ClosedPollTests, self).setUp()
+        self.poll = self.create_poll(question="Closing poll.", days=-1, creator=self.u1)
+        self.choice1 = Choice.objects.create(poll=self.poll, choice_text='Yes')
+        self.choice2 = Choice.objects.create(poll=self.poll, choice_text='No')
+        Vote.objects.create(user=self.u2, choice=self.choice1)
+        Vote.objects.create(user=self.u3, choice=self.choice1)
+
+    def close(self, poll):
+        poll.closes_at = timezone.now() - datetime.timedelta(minutes=1)
+        poll.save()
+
+    def test_vote_rejected_after_closing(self):
+        self.close(self.poll)
+        self.client.force_login(self.u4)
+        response = self.client.post(reverse('polls:voting_form', args=(self.poll.id,)),
+                                    {u'choice': self.choice2.pk})
+        self.assertEqual(response.context['error_message'], "Voting in this poll is closed.")
+        self.assertFalse(Vote.objects.filter(user=self.u4).exists())
+
+    def test_results_served_from_snapshot(self):
+        """
+        Once frozen, the results of a closed poll should not depend on the
+        votes anymore.
+        """
+        self.close(self.poll)
+        call_command('close_polls', stdout=open(os.devnull, 'w'))
+        Vote.objects.all().delete()
+
+        poll = Poll.objects.get(pk=self.poll.pk)
+        self.assertEqual(poll.num_voters(), 2)
+        self.assertEqual(dict((c.choice_text, c.num_votes) for c in poll.results()),
+                         {'Yes': 2, 'No': 0})
+        response = self.client.get(reverse('polls:results', args=(poll.id,)))
+        self.assertContains(response, 'Yes -- 2 votes')
+        response = self.client.get(reverse('polls:index'))
+        self.assertContains(response, '(2 voters, closed)')
+
+    def test_ranked_results_frozen(self):
+        poll = self.create_poll(question="Ranked poll.", days=-1, creator=self.u1)
+        poll.ranked = True
+        poll.save()
+        a = Choice.objects.create(poll=poll, choice_text='A')
+        b = Choice.objects.create(poll=poll, choice_text='B')
+        Ballot.objects.create(poll=poll, user=self.u2, ranking='{0},{1}'.format(b.pk, a.pk))
+        self.close(poll)
+        self.assertEqual(poll.runoff()['winner'], b)
+        call_command('close_polls', stdout=open(os.devnull, 'w'))
+
+        Ballot.objects.all().delete()
+        poll = Poll.objects.get(pk=poll.pk)
+        report = poll.runoff()
+        self.assertEqual(report['winner'], b)
+        self.assertEqual(report['rounds'][0]['votes'], [0, 1])
+        self.assertEqual(poll.num_voters(), 1)
+
+    def test_results_not_frozen_by_visitors(self):
+        """
+        Until close_polls ran, the results of a closed poll should be
+        counted without writing anything.
+        """
+        self.close(self.poll)
+        response = self.client.get(reverse('polls:results', args=(self.poll.id,)))
+        self.assertContains(response, 'Yes -- 2 votes')
+        self.assertEqual(Poll.objects.get(pk=self.poll.pk).snapshot, '')
+
+    def test_vote_rejected_when_closed_meanwhile(self):
+        """
+        A vote saved after the poll closed should be rolled back, or the
+        frozen results would miss it.
+        """
+        self.poll.closes_at = timezone.now() + datetime.timedelta(minutes=1)
+        self.poll.save()
+        with clock_ahead(datetime.timedelta(minutes=2)):
+            with self.assertRaises(PollClosed):
+                save_vote(self.poll, Vote(user=self.u4, poll=self.poll, choice=self.choice2))
+            call_command('close_polls', stdout=open(os.devnull, 'w'))
+            self.assertEqual(Poll.objects.get(pk=self.poll.pk).frozen_results()['voters'], 2)
+        self.assertFalse(Vote.objects.filter(user=self.u4).exists())
+
+    def test_snapshot_cleared_when_reopened(self):
+        self.close(self.poll)
+        call_command('close_polls', stdout=open(os.devnull, 'w'))
+        poll = Poll.objects.get(pk=self.poll.pk)
+        poll.closes_at = timezone.now() + datetime.timedelta(days=1)
+        poll.save(update_fields=['closes_at'])
+        self.assertEqual(Poll.objects.get(pk=self.poll.pk).snapshot, '')
+
+        Vote.objects.create(user=self.u4, choice=self.choice2)
+        self.close(poll)
+        self.assertEqual(poll.num_voters(), 3)
+
+    def test_listing_refreshed_when_poll_closes(self):
+        self.poll.closes_at = timezone.now() + datetime.timedelta(minutes=1)
+        self.poll.save()
+        self.assertNotContains(self.client.get(reverse('polls:index')), 'closed)')
+        with clock_ahead(datetime.timedelta(minutes=2)):
+            self.assertContains(self.client.get(reverse('polls:index')), 'closed)')
+
+
+class ArchiveTests(BaseTestCase):
+
+    def setUp(self):
+        super(ArchiveTests, self).setUp()
+        long_ago = timezone.now() - datetime.timedelta(days=100)
+        self.old = self.create_poll(question="Old poll.", days=-200, creator=self.u1)
+        self.yes = Choice.objects.create(poll=self.old, choice_text='Yes')
+        self.no = Choice.objects.create(poll=self.old, choice_text='No')
+        for user, choice in [(self.u2, self.yes), (self.u3, self.yes), (self.u4, self.no)]:
+            Vote.objects.create(user=user, choice=choice)
+            self.old.register_vote(when=long_ago)
+
+        self.recent = self.create_poll(question="Recent poll.", days=-1, creator=self.u1)
+        choice = Choice.objects.create(poll=self.recent, choice_text='Yes')
+        Vote.objects.create(user=self.u2, choice=choice)
+        self.recent.register_vote()
+
+    def test_archive_inactive_polls(self):
+        """
+        Only votes of inactive polls should be moved, two at a time here,
+        and their results should stay the same.
+        """
+        call_command('archive_votes', batch_size=2, stdout=open(os.devnull, 'w'))
+
+        self.assertEqual(ArchivedVote.objects.count(), 3)
+        self.assertEqual(list(Vote.objects.values_list('poll_id', flat=True)),
+                         [self.recent.pk])
+        old = Poll.objects.get(pk=self.old.pk)
+        self.assertEqual(old.archived_voters, 3)
+        self.assertEqual(old.num_voters(), 3)
+        self.assertEqual(old.count_votes(), {self.yes.pk: 2, self.no.pk: 1})
+
+    def test_archive_polls_without_hot_score(self):
+        """
+        Polls whose votes were all cast before hot scores existed should
+        be archived as well.
+        """
+        unscored = self.create_poll(question="Unscored poll.", days=-400, creator=self.u1)
+        choice = Choice.objects.create(poll=unscored, choice_text='Yes')
+        Vote.objects.create(user=self.u2, choice=choice)
+        self.assertIsNone(Poll.objects.get(pk=unscored.pk).hot_score)
+        self.assertIn(unscored, inactive_polls(90))
+
+        call_command('archive_votes', stdout=open(os.devnull, 'w'))
+        self.assertFalse(unscored.votes().exists())
+        unscored = Poll.objects.get(pk=unscored.pk)
+        self.assertEqual(unscored.archived_voters, 1)
+        self.assertEqual(unscored.count_votes(), {choice.pk: 1})
+
+    def test_archived_votes_still_count_per_user(self):
+        call_command('archive_votes', stdout=open(os.devnull, 'w'))
+        old = Poll.objects.get(pk=self.old.pk)
+        self.assertTrue(old.has_voted(self.u2))
+        self.assertFalse(old.has_voted(self.u5))
+        self.assertEqual(old.vote_of(self.u4).choice, self.no)
+        self.assertEqual(voted_polls(self.u3), set([self.old.pk]))
+
+        self.client.force_login(self.u2)
+        response = self.client.post(reverse('polls:voting_form', args=(old.id,)),
+                                    {u'choice': self.no.pk})
+        self.assertEqual(response.context['error_message'], "Voting twice is not allowed.")
+
+        # New votes are counted next to the archived ones.
+        self.client.force_login(self.u5)
+        self.client.post(reverse('polls:voting_form', args=(old.id,)), {u'choice': self.no.pk})
+        self.assertEqual(old.num_voters(), 4)
+        self.assertEqual(old.count_votes(), {self.yes.pk: 2, self.no.pk: 2})
+
+    def test_vote_rejected_after_archived_meanwhile(self):
+        """
+        A vote checked against a poll read before its votes were archived
+        should not be saved next to the archived one.
+        """
+        call_command('archive_votes', stdout=open(os.devnull, 'w'))
+        self.assertEqual(self.old.archived_voters, 0)
+        with self.assertRaises(IntegrityError):
+            save_vote(self.old, Vote(user=self.u2, poll=self.old, choice=self.no))
+        with self.assertRaises(IntegrityError):
+            cast_votes(self.u2, [(self.old, self.no.pk)])
+        self.assertFalse(Vote.objects.filter(poll=self.old).exists())
+        call_command('archive_votes', stdout=open(os.devnull, 'w'))
+        self.assertEqual(ArchivedVote.objects.filter(poll=self.old).count(), 3)
+
+
+# Requests through the WSGI application close old connections, which
+# would end the transaction of a TestCase.
+@override_settings(VOTE_SHARDS=[])
+class VoteStormTests(TransactionTestCase):
+
+    def test_skewed_order_prefers_first_items(self):
+        rng = random.Random(1)
+        firsts = Counter(skewed_order(rng, range(10), 1.2)[0] for i in range(2000))
+        self.assertEqual(firsts.most_common(1)[0][0], 0)
+        self.assertGreater(firsts[0], firsts[1])
+        self.assertGreater(firsts[1], firsts[5])
+
+    def test_simulated_user_votes_through_wsgi(self):
+        """
+        A simulated user should be logged in and pass the CSRF check when
+        voting through the WSGI application.
+        """
+        from mysite.wsgi import application
+
+        users, polls = create_storm_data(users=1, polls=2, choices=3)
+        poll_pk = list(polls)[0]
+        visitor = SimulatedUser(application, users[0], '10.0.0.1')
+        self.assertEqual(visitor.vote(poll_pk, polls[poll_pk][1]), 302)
+        self.assertEqual(visitor.read_results(poll_pk), 200)
+        self.assertEqual(Vote.objects.get(user=users[0]).choice_id, polls[poll_pk][1])
+
+
+@override_settings(VOTE_SHARDS=[], POLLS_MAX_INFLIGHT_WRITES=None,
+                   POLLS_THROTTLE_IP_RATE=None)
+class ConcurrentVoteTests(TransactionTestCase):
+
+    def test_parallel_votes_all_counted(self):
+        """
+        Votes posted at the same time from many threads should all be
+        saved and counted, none failing because SQLite was locked.
+        """
+        cache.clear()
+        owner = User.objects.create(username='owner')
+        poll = Poll.objects.create(question='Busy poll.', created_by=owner,
+                                   category=PollCategory.objects.create(name='All polls'),
+                                   pub_date=timezone.now() - datetime.timedelta(days=1))
+        choices = [Choice.objects.create(poll=poll, choice_text=str(i)) for i in range(3)]
+        voters = [User.objects.create(username='voter{0}'.format(i)) for i in range(24)]
+        url = reverse('polls:voting_form', args=(poll.id,))
+        start, statuses = threading.Event(), []
+
+        def vote(client, choice):
+            start.wait()
+            try:
+                statuses.append(client.post(url, {'choice': choice.pk}).status_code)
+            finally:
+                connection.close()
+
+        threads = []
+        for i, voter in enumerate(voters):
+            client = self.client_class()
+            client.force_login(voter)
+            threads.append(threading.Thread(target=vote, args=(client, choices[i % 3])))
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses, [302] * len(voters))
+        self.assertEqual(poll.votes().count(), len(voters))
+        # Every vote made it into the hot score too.
+        hot_score = Poll.objects.get(pk=poll.pk).hot_score
+        self.assertAlmostEqual(hot_score, hot_weight(timezone.now()) + math.log(len(voters), 2),
+                               places=2)
+
+    def test_no_retry_inside_shard_transaction(self):
+        """
+        A transaction on a vote shard should fail as a whole rather than
+        have part of it run again.
+        """
+        calls = []
+
+        @retry_on_lock
+        def locked():
+            calls.append(1)
+            raise OperationalError('database is locked')
+        with self.assertRaises(OperationalError):
+            with transaction.atomic(using='votes0'):
+                locked()
+        self.assertEqual(len(calls), 1)
+
+    @override_settings(POLLS_THROTTLE_USER_RATE=(1, 60), POLLS_THROTTLE_IP_RATE=(1, 60),
+                       POLLS_MAX_INFLIGHT_WRITES=1)
+    def test_storm_not_throttled(self):
+        from mysite.wsgi import application
+
+        cache.clear()
+        PollCategory.objects.create(name='All polls')
+        users, polls = create_storm_data(users=4, polls=2, choices=2)
+        stats, duration = run_storm(application, users, polls, votes_per_user=2, seed=1)
+        self.assertEqual(dict(stats.statuses['vote']), {302: 8})
+        self.assertEqual(Vote.objects.count(), 8)
+
+
+@override_settings(POLLS_SITEMAP_CHUNK_SIZE=2)
+class SitemapTests(BaseTestCase):
+
+    def setUp(self):
+        super(SitemapTests, self).setUp()
+        self.polls = [self.create_poll(question='Question {0}?'.format(i), days=-1,
+                                       creator=self.u1) for i in range(3)]
+
+    def chunk(self, section, chunk):
+        response = self.client.get(reverse('polls:sitemap', args=(section, chunk)))
+        if response.streaming:
+            return b''.join(response.streaming_content).decode('utf-8')
+        return response.content.decode('utf-8')
+
+    def url(self, obj):
+        return u'<loc>http://testserver{0}</loc>'.format(obj.get_absolute_url())
+
+    def test_index_lists_chunks(self):
+        response = self.client.get(reverse('polls:sitemap_index'))
+        last = Poll.objects.order_by('-pk')[0].pk
+        for chunk in range((last - 1) // 2 + 1):
+            self.assertContains(response, 'http://testserver/polls/sitemap-polls-{0}.xml'.format(
+                    chunk))
+        self.assertContains(response, 'http://testserver/polls/sitemap-categories-0.xml')
+        self.assertEqual(self.client.get(reverse(
+                'polls:sitemap', args=('polls', last // 2 + 1))).status_code, 404)
+
+    def test_chunks_list_public_objects(self):
+        hidden = self.create_poll(question='Later?', days=1, creator=self.u1)
+        content = u''.join(self.chunk('polls', chunk) for chunk in
+                           set((poll.pk - 1) // 2 for poll in self.polls + [hidden]))
+        for poll in self.polls:
+            self.assertEqual(content.count(self.url(poll)), 1)
+        self.assertNotIn(self.url(hidden), content)
+        self.assertIn(self.url(self.pc), self.chunk('categories', 0))
+
+    def test_chunks_cached_until_they_change(self):
+        """
+        A chunk should be served from the cache until one of its polls
+        changed; other chunks stay cached.
+        """
+        poll = self.polls[0]
+        chunk = (poll.pk - 1) // 2
+        self.chunk('polls', chunk)
+        with self.assertNumQueries(0):
+            self.chunk('polls', chunk)
+
+        # Lands in a later chunk: chunks hold two keys and the poll is the fourth.
+        self.create_poll(question='Newer?', days=-1, creator=self.u1)
+        Vote.objects.create(user=self.u2, choice=Choice.objects.create(poll=poll, choice_text='A'))
+        check_publications()  # Looks for the next publication again, after the new poll.
+        with self.assertNumQueries(0):
+            self.chunk('polls', chunk)
+
+        poll.mark_deleted()
+        self.assertNotIn(self.url(poll), self.chunk('polls', chunk))
+
+    def test_chunk_refreshed_when_poll_goes_live(self):
+        poll = self.create_poll(question='Soon?', days=0, creator=self.u1)
+        poll.pub_date = timezone.now() + datetime.timedelta(hours=1)
+        poll.save()
+        chunk = (poll.pk - 1) // 2
+        self.assertNotIn(self.url(poll), self.chunk('polls', chunk))
+        with clock_ahead(datetime.timedelta(hours=1, seconds=1)):
+            self.assertIn(self.url(poll), self.chunk('polls', chunk))
+
+
+class ChartTests(BaseTestCase):
+
+    def test_chart_redrawn_when_votes_change(self):
+        """
+        The chart should be drawn once per number of votes and served from
+        the cache in between.
+        """
+        poll = self.create_poll(question="Charted poll.", days=-1, creator=self.u1)
+        choice1 = Choice.objects.create(poll=poll, choice_text='Cats & dogs')
+        choice2 = Choice.objects.create(poll=poll, choice_text='Fish')
+        Vote.objects.create(user=self.u2, choice=choice1)
+        url = reverse('polls:chart', args=(poll.id,))
+
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertContains(response, 'Cats &amp; dogs (1)')
+        with self.assertNumQueries(2):  # The poll and its number of votes.
+            self.client.get(url)
+
+        Vote.objects.create(user=self.u3, choice=choice2)
+        self.assertContains(self.client.get(url), 'Fish (1)')
+        choice2.choice_text = 'Birds'
+        choice2.save()
+        self.assertContains(self.client.get(url), 'Birds (1)')
+
+
+class StartupTests(TestCase):
+
+    def test_import_timer(self):
+        """
+        ImportTimer should time modules imported while installed, and only
+        those.
+        """
+        sys.modules.pop('colorsys', None)
+        timer = ImportTimer()
+        timer.install()
+        try:
+            import colorsys
+            import json
+        finally:
+            timer.uninstall()
+        self.assertEqual(list(timer.times), ['colorsys'])
+        own, cumulative = timer.times['colorsys']
+        self.assertTrue(0 <= own <= cumulative)
+
+    def test_admin_loaded_lazily(self):
+        """
+        The admin URLconf should only be imported once an admin URL is
+        requested, and still be served then.
+        """
+        # Earlier tests may have loaded it into the resolvers already.
+        sys.modules.pop('mysite.admin_urls', None)
+        reload(import_module(settings.ROOT_URLCONF))
+        clear_url_caches()
+        try:
+            self.client.get('/polls/')
+            self.assertFalse('mysite.admin_urls' in sys.modules)
+            response = self.client.get('/admin/')
+            self.assertEqual(response.status_code, 302)
+            self.assertTrue('mysite.admin_urls' in sys.modules)
+        finally:
+            clear_url_caches()
@@ -0,0 +1,138 @@
+'''
+Throttling and load shedding for views that write.
+
+Every client is limited per user and per IP address to
+settings.POLLS_THROTTLE_USER_RATE / POLLS_THROTTLE_IP_RATE, given as
+(requests, seconds). On top of that, when more than
+settings.POLLS_MAX_INFLIGHT_WRITES write requests are being served at once,
+new ones are turned away. All state lives in the default cache, so it is
+shared between worker processes as long as the cache is, and is only
+changed with cache.add() and cache.incr(), so that concurrent requests
+are all counted.
+'''
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from .middleware import SAFE_METHODS
+
+
+STATS = ('allowed', 'throttled_user', 'throttled_ip', 'shed')
+
+# Writes in flight are counted per window of INFLIGHT_WINDOW seconds, in
+# keys that expire after two windows: a request counts until the end of the
+# window after the one it started in, or until it is done. The count of a
+# worker that died while serving a request expires along with the key.
+INFLIGHT_KEY = 'throttle:inflight:%d'
+INFLIGHT_WINDOW = 60
+
+
+def _incr(key, delta=1, timeout=None):
+    cache.add(key, 0, timeout)
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # Evicted in between, start over.
+        cache.set(key, max(delta, 0), timeout)
+        return max(delta, 0)
+
+
+def _decr(key):
+    try:
+        cache.decr(key)
+    except ValueError:
+        # Expired, and what was counted with it.
+        pass
+
+
+def count(name):
+    _incr('throttle:stats:' + name)
+
+
+def inflight_keys(now=None):
+    '''Return the keys counting writes in flight in the current and the last window.'''
+    window = int((now or time.time()) // INFLIGHT_WINDOW)
+    return INFLIGHT_KEY % window, INFLIGHT_KEY % (window - 1)
+
+
+def stats():
+    '''Return the counters of throttled and shed requests.'''
+    values = cache.get_many(['throttle:stats:' + name for name in STATS])
+    result = dict((name, values.get('throttle:stats:' + name, 0)) for name in STATS)
+    result['inflight'] = sum(cache.get_many(inflight_keys()).values())
+    return result
+
+
+def take_token(key, rate, now=None):
+    '''
+    Count a request made `now` (default: now) against the limit `key` of
+    `rate`. Return 0 if it is within the limit, otherwise the number of
+    seconds until one would be.
+
+    Requests are counted per window of the rate's period. The number made
+    during the last period is estimated as the count of the current window
+    plus that of the previous one, weighted by how much of it is still in
+    the last period.
+    '''
+    if not rate:
+        return 0
+    capacity, period = rate
+    window, elapsed = divmod(now or time.time(), period)
+    current = '%s:%d' % (key, window)
+    previous = cache.get('%s:%d' % (key, window - 1), 0)
+    taken = previous * (1 - elapsed / float(period)) + _incr(current, timeout=2 * period)
+    if taken <= capacity:
+        return 0
+    # Turned away, so not counted.
+    _decr(current)
+    wait = period - elapsed
+    if previous:
+        wait = min(wait, (taken - capacity) * period / float(previous))
+    return wait
+
+
+def too_many_requests(wait):
+    response = HttpResponse('Too many requests, slow down.', status=429,
+                            content_type='text/plain')
+    response['Retry-After'] = str(int(wait) + 1)
+    return response
+
+
+def throttle_writes(view):
+    '''Throttle POST (and other unsafe) requests to `view`.'''
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if request.method in SAFE_METHODS:
+            return view(request, *args, **kwargs)
+
+        limit = getattr(settings, 'POLLS_MAX_INFLIGHT_WRITES', None)
+        current, last = inflight_keys()
+        inflight = _incr(current, timeout=2 * INFLIGHT_WINDOW) + (cache.get(last) or 0)
+        try:
+            if limit and inflight > limit:
+                count('shed')
+                response = HttpResponse('Server busy, try again later.',
+                        status=503, content_type='text/plain')
+                response['Retry-After'] = '1'
+                return response
+
+            if request.user.is_authenticated():
+                wait = take_token('throttle:user:%s' % request.user.pk,
+                        getattr(settings, 'POLLS_THROTTLE_USER_RATE', None))
+                if wait:
+                    count('throttled_user')
+                    return too_many_requests(wait)
+            wait = take_token('throttle:ip:%s' % request.META.get('REMOTE_ADDR'),
+                    getattr(settings, 'POLLS_THROTTLE_IP_RATE', None))
+            if wait:
+                count('throttled_ip')
+                return too_many_requests(wait)
+
+            count('allowed')
+            return view(request, *args, **kwargs)
+        finally:
+            _decr(current)
+    return wrapped
@@ -1,14 +1,24 @@
 from django.conf.urls import patterns, url
 
-from . import views
+from . import sitemaps, views
 
 
 urlpatterns = [
     url(r'^$', views.IndexView.as_view(), name='index'),
     url(r'^(?P<pk>\d+)/vote$', views.vote, name='voting_form'),
     url(r'^(?P<pk>\d+)/results/$', views.ResultsView.as_view(), name='results'),
+    url(r'^(?P<pk>\d+)/chart.svg$', views.chart, name='chart'),
     url(r'^create/$', views.create_poll, name='create'),
+    url(r'^survey/(?P<pk>\d+)/$', views.survey, name='survey'),
+    url(r'^bulk-create/$', views.bulk_create_polls, name='bulk_create'),
     url(r'^category/(?P<pk>\d+)/$', views.category, name='category'),
+    url(r'^search/$', views.search, name='search'),
+    url(r'^fragments/$', views.fragments, name='fragments'),
+    url(r'^throttle-stats/$', views.throttle_stats, name='throttle_stats'),
+    url(r'^metrics$', views.metrics_view, name='metrics'),
+    url(r'^sitemap\.xml$', sitemaps.sitemap_index, name='sitemap_index'),
+    url(r'^sitemap-(?P<section>\w+)-(?P<chunk>\d+)\.xml$', sitemaps.sitemap_chunk,
+        name='sitemap'),
     url(r'^(?P<pk>\d+)/delete$', views.PollDelete.as_view(), name='delete'),
     url(r'^(?P<pk>\d+)/update$', views.update_poll, name='update'),
     ]
@@ -1,14 +1,34 @@
+import json
+
+from django.conf import settings
 from django.core.urlresolvers import reverse, reverse_lazy
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import (login_required, permission_required,
+                                            user_passes_test)
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
 from django.utils.decorators import method_decorator
-from django.http import HttpResponseRedirect
+from django.views.decorators.http import require_POST
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render
+from django.template.loader import render_to_string
 from django.utils import timezone
+from django.utils.http import is_safe_url
+from django.views.decorators.cache import never_cache
 from django.views import generic
-from django.http import Http404
+from django.http import Http404, JsonResponse
 
-from .models import Choice, Poll, Vote, PollCategory
-from .forms import PollForm, ChoiceFormSet
+from .archive import check_not_archived
+from .models import Ballot, Choice, Poll, PollClosed, Vote, PollCategory, Survey
+from .forms import PollForm, ChoiceFormSet, SurveyForm
+from .search import search_polls
+from .bulk import create_polls
+from .throttling import throttle_writes, stats
+from .caching import cache_shell
+from .charts import poll_chart
+from .sharding import VotesMoved, check_vote_aliases, vote_alias
+from .voted import voted_polls, record_voted
+from .sqlite import retry_on_lock
+from . import metrics, tallies
 
 
 class IndexView(generic.ListView):
@@ -20,8 +40,16 @@ class IndexView(generic.ListView):
         Return the last five published polls (not including those set to be
         published in the future).
         """
-        return Poll.objects.filter(
-                pub_date__lte=timezone.now()).order_by('-pub_date')[:5]
+        return Poll.objects.public().order_by('-pub_date')[:5]
+
+    @method_decorator(cache_shell('polls', timeout_setting='POLLS_LISTING_CACHE_SECONDS'))
+    def dispatch(self, *args, **kwargs):
+        return super(IndexView, self).dispatch(*args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super(IndexView, self).get_context_data(**kwargs)
+        context['hot_poll_list'] = Poll.objects.hot()[:5]
+        return context
 
 
 class ResultsView(generic.DetailView):
@@ -32,51 +60,197 @@ class ResultsView(generic.DetailView):
         return get_object_or_404(self.model.objects.public(), 
                 pk=self.kwargs['pk'])
 
-    def get_context_data(self, **kwargs):
-        context = super(ResultsView, self).get_context_data(**kwargs)
-        your_vote = ''
-        if self.request.user.is_authenticated():
-            # Would break with AnonymousUser 
-            try:
-                your_vote = Vote.objects.get(
-                        user=self.request.user,
-                        choice__poll__pk=self.object.pk
-                        )
-                your_vote = your_vote.choice.choice_text
-            except (KeyError, Vote.DoesNotExist):
-                pass
-
-        context['your_vote'] = your_vote
-        return context
+    @method_decorator(cache_shell('poll:{pk}'))
+    def dispatch(self, *args, **kwargs):
+        return super(ResultsView, self).dispatch(*args, **kwargs)
+
+
+def chart(request, pk):
+    poll = get_object_or_404(Poll.objects.public(), pk=pk)
+    return HttpResponse(poll_chart(poll), content_type='image/svg+xml')
+
+
+def your_vote(poll, user):
+    """Return the text of the choice `user` voted for in `poll`, or ''."""
+    if not user.is_authenticated():
+        return ''
+    if poll.ranked:
+        ballot = poll.ballot_set.filter(user=user).first()
+        if ballot is None:
+            return ''
+        return u' > '.join(choice.choice_text for choice in ballot.choices())
+    vote = poll.vote_of(user)
+    return vote.choice.choice_text if vote is not None else ''
+
+
+@never_cache
+def fragments(request):
+    """
+    The parts of the cached pages that depend on the user, as HTML snippets
+    keyed by the data-fragment names they fill in (see polls/shell.html),
+    and under 'voted' the polls the user voted in, for marking lists.
+    """
+    next_path = request.GET.get('next', '')
+    if not is_safe_url(next_path, host=request.get_host()):
+        next_path = reverse('polls:index')
+    fragments = {
+        'userinfo': render_to_string('userinfo.html', {'next_path': next_path},
+                                     request=request),
+    }
+
+    if request.user.is_authenticated():
+        fragments['voted'] = sorted(voted_polls(request.user))
+
+    poll_pk = request.GET.get('poll', '')
+    if poll_pk.isdigit():
+        poll = get_object_or_404(Poll.objects.public(), pk=poll_pk)
+        context = {'poll': poll, 'your_vote': your_vote(poll, request.user)}
+        for name in ('poll_actions', 'comment_form'):
+            fragments[name] = render_to_string(
+                    'polls/fragments/{0}.html'.format(name), context, request=request)
+    return JsonResponse(fragments)
 
 
 @login_required
+@throttle_writes
 def vote(request, pk):
     p = get_object_or_404(Poll.objects.public(), pk=pk)
 
-    error_message = None
-    if Vote.objects.filter(user=request.user, choice__poll=p).exists():
-        error_message = "Voting twice is not allowed."
+    # Why the vote was rejected, as counted in the polls_votes_total metric.
+    error_message = rejected = None
+    if p.has_voted(request.user):
+        error_message, rejected = "Voting twice is not allowed.", 'double_vote'
     elif p.created_by == request.user:
-        error_message = "You can't vote in your own poll!"
+        error_message, rejected = "You can't vote in your own poll!", 'own_poll'
+    elif p.is_closed():
+        error_message, rejected = "Voting in this poll is closed.", 'closed'
 
-    if request.method=='POST' and not error_message:
+    if request.method=='POST' and not error_message and p.ranked:
+        ranking, error_message = read_ranking(p, request.POST)
+        if error_message:
+            rejected = 'bad_ranking'
+        else:
+            try:
+                save_vote(p, Ballot(poll=p, user=request.user, ranking=ranking))
+            except IntegrityError:
+                error_message, rejected = "Voting twice is not allowed.", 'double_vote'
+            except PollClosed:
+                error_message, rejected = "Voting in this poll is closed.", 'closed'
+        if not error_message:
+            record_voted(request.user, p.pk)
+            metrics.inc('polls_votes_total', result='accepted')
+            return HttpResponseRedirect(reverse('polls:results', args=(p.id,)))
+    elif request.method=='POST' and not error_message:
         try:
             selected_choice = p.choice_set.get(pk=request.POST['choice'])
         except (KeyError, Choice.DoesNotExist):
-            error_message = "You didn't select a choice."
+            error_message, rejected = "You didn't select a choice.", 'no_choice'
+        if not error_message:
+            v = Vote(user=request.user, poll=p, choice=selected_choice)
+            try:
+                with tallies.counting([(p.pk, selected_choice.pk)]):
+                    save_vote(p, v)
+            except IntegrityError:
+                # Another request of the same user got there first.
+                error_message, rejected = "Voting twice is not allowed.", 'double_vote'
+            except PollClosed:
+                error_message, rejected = "Voting in this poll is closed.", 'closed'
         if not error_message:
-            v = Vote(user=request.user, choice=selected_choice)
-            v.save()
+            record_voted(request.user, p.pk)
+            metrics.inc('polls_votes_total', result='accepted')
             return HttpResponseRedirect(reverse('polls:results', args=(p.id,)))
- 
+
+    if request.method == 'POST':
+        metrics.inc('polls_votes_total', result=rejected)
     return render(request, 'polls/voting_form.html', {
     'poll': p,
     'error_message': error_message,
+    'ranks': range(1, p.choice_set.count() + 1) if p.ranked else None,
     })
 
 
 @login_required
+@throttle_writes
+def survey(request, pk):
+    """Vote in all polls of a survey at once."""
+    survey = get_object_or_404(Survey, pk=pk, pub_date__lte=timezone.now())
+    form = SurveyForm(survey, request.user, request.POST or None)
+    if request.method == 'POST':
+        if not form.is_valid():
+            # Counted as in vote(), for the polls without a valid answer.
+            missing = len([name for name in form.errors if name in form.open_polls])
+            if missing:
+                metrics.inc('polls_votes_total', missing, result='no_choice')
+        else:
+            rejected = None
+            try:
+                form.save()
+            except IntegrityError:
+                # Another request of the same user voted in one of the polls.
+                form.add_error(None, "Voting twice is not allowed.")
+                rejected = 'double_vote'
+            except PollClosed:
+                form.add_error(None, "Voting in one of these polls closed meanwhile.")
+                rejected = 'closed'
+            metrics.inc('polls_votes_total', len(form.open_polls), result=rejected or 'accepted')
+            if rejected is None:
+                return HttpResponseRedirect(reverse('polls:survey', args=(survey.id,)))
+    return render(request, 'polls/survey.html', {'survey': survey, 'form': form})
+
+
+@retry_on_lock
+def save_vote(poll, vote):
+    """Save a Vote or Ballot and count it in the poll's hot score, all or nothing."""
+    while True:
+        using = vote_alias(poll.vote_shard) if isinstance(vote, Vote) else None
+        try:
+            with transaction.atomic(), transaction.atomic(using=using):
+                vote.save(using=using)
+                poll.register_vote()
+                if isinstance(vote, Vote):
+                    check_not_archived(vote.user_id, [poll.pk])
+                    check_vote_aliases({poll.pk: using})
+            return
+        except VotesMoved as moved:
+            poll.vote_shard = moved.vote_shards[poll.pk]
+            vote.pk = None
+
+
+@retry_on_lock
+@transaction.atomic
+def save_poll(form, formset, created_by=None):
+    """Save a PollForm and its ChoiceFormSet, all or nothing."""
+    poll = form.save(commit=False)
+    if created_by is not None:
+        poll.created_by = created_by
+    poll.save()
+    formset.instance = poll
+    formset.save()
+    return poll
+
+
+def read_ranking(poll, data):
+    """
+    Return (ranking, error message) from the rank-<choice pk> fields of a
+    ranked voting form; choices left without a rank are not ranked.
+    """
+    ranks = {}
+    for choice_pk in poll.choice_set.values_list('pk', flat=True):
+        rank = data.get('rank-{0}'.format(choice_pk), '')
+        if not rank:
+            continue
+        if not rank.isdigit():
+            return None, "Ranks must be numbers."
+        if int(rank) in ranks:
+            return None, "Each rank can only be given to one choice."
+        ranks[int(rank)] = choice_pk
+    if not ranks:
+        return None, "You didn't rank any choice."
+    return ','.join(str(ranks[rank]) for rank in sorted(ranks)), None
+
+
+@login_required
+@throttle_writes
 def create_poll(request, template='polls/poll_form.html'):
 
     if request.method=='POST':
@@ -85,13 +259,8 @@ def create_poll(request, template='polls/poll_form.html'):
         formset = ChoiceFormSet(request.POST)
 
         if form.is_valid() and formset.is_valid():
-            p = form.save(commit=False)
-            p.created_by = request.user
-            p.save()
-
-            formset.instance = p
-            formset.save()
-
+            p = save_poll(form, formset, created_by=request.user)
+            metrics.inc('polls_created_total', source='form')
             return HttpResponseRedirect(reverse('polls:results', args=(p.id,)))
     else:
         form = PollForm()
@@ -101,11 +270,36 @@ def create_poll(request, template='polls/poll_form.html'):
     return render(request, template, {'form': form, 'formset': formset})
 
 
+@require_POST
+@permission_required('polls.add_poll', raise_exception=True)
+@throttle_writes
+def bulk_create_polls(request):
+    """
+    Create all polls from a JSON body like {"polls": [...]}, see polls.bulk.
+    Responds with the primary keys of the new polls or with the errors.
+    """
+    try:
+        polls = json.loads(request.body.decode('utf-8'))['polls']
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'errors': {'polls': ['Expected {"polls": [...]}.']}},
+                            status=400)
+    try:
+        pks = create_polls(polls, request.user)
+    except ValidationError as e:
+        return JsonResponse({'errors': e.message_dict}, status=400)
+    metrics.inc('polls_created_total', len(pks), source='bulk')
+    return JsonResponse({'ids': pks}, status=201)
+
+
 class PollDelete(generic.DeleteView):
     model = Poll
     success_url = reverse_lazy('polls:index')
 
+    def get_queryset(self):
+        return Poll.objects.live()
+
     @method_decorator(login_required)
+    @method_decorator(throttle_writes)
     def dispatch(self, *args, **kwargs):
         poll = self.get_object()
         if poll.created_by != self.request.user:
@@ -113,18 +307,25 @@ class PollDelete(generic.DeleteView):
 
         return super(PollDelete, self).dispatch(*args, **kwargs)
 
+    def delete(self, request, *args, **kwargs):
+        # A cascade over all votes could take minutes, leave it to a job.
+        self.object = self.get_object()
+        self.object.mark_deleted()
+        return HttpResponseRedirect(self.get_success_url())
+
 
 @login_required
+@throttle_writes
 def update_poll(request, pk):
-    poll = get_object_or_404(Poll, pk=pk)
-    if poll.created_by != request.user:
+    poll = get_object_or_404(Poll.objects.live(), pk=pk)
+    # The results of closed polls are frozen, see Poll.frozen_results().
+    if poll.created_by != request.user or poll.is_closed():
         raise Http404
     if request.method == 'POST':
         poll_form = PollForm(request.POST, instance=poll)
         choice_formset = ChoiceFormSet(request.POST, instance=poll)
         if poll_form.is_valid() and choice_formset.is_valid():
-            poll_form.save()
-            choice_formset.save()
+            save_poll(poll_form, choice_formset)
             return HttpResponseRedirect(reverse('polls:results', args=[pk]))
     else:
         poll_form = PollForm(instance=poll)
@@ -136,6 +337,7 @@ def update_poll(request, pk):
 
 
 
+@cache_shell('polls', timeout_setting='POLLS_LISTING_CACHE_SECONDS')
 def category(request, pk):
     cat = get_object_or_404(PollCategory, pk=pk)
     return render(request, 'polls/category.html', {
@@ -143,3 +345,26 @@ def category(request, pk):
         })
 
 
+def search(request):
+    query = request.GET.get('q', '').strip()
+    polls = search_polls(query)[:20] if query else []
+    return render(request, 'polls/search.html', {
+        'query': query,
+        'poll_list': polls,
+        'voted': voted_polls(request.user),
+        })
+
+
+# Not the admin's staff_member_required: importing it loads the whole admin.
+@user_passes_test(lambda user: user.is_staff)
+def throttle_stats(request):
+    return JsonResponse(stats())
+
+
+@never_cache
+def metrics_view(request):
+    """All metrics in the Prometheus text format, for scrapers on INTERNAL_IPS and for staff."""
+    if (request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS
+            and not request.user.is_staff):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
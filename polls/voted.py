@@ -0,0 +1,95 @@
+'''
+The polls each user voted in, for marking poll lists.
+
+The primary keys are cached per user as a packed array of integers, read
+from the votes, archived votes and ballots of the user when missing (one
+query each, and one per vote database), and extended by the vote view
+after every vote (or survey).
+
+Both are done under a lock in the cache, so that two requests of the same
+user don't write back sets missing each other's vote. A rebuilt set is
+only stored if no vote was recorded while it was read, as counted in
+'voted:<user pk>:recorded'.
+'''
+import time
+from array import array
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import ArchivedVote, Ballot, Vote, vote_shards
+from .sharding import vote_alias
+
+
+# Seconds a lock on a cached set is kept by a request that died holding it.
+LOCK_SECONDS = 5
+
+
+def voted_key(user_pk):
+    return 'voted:{0}'.format(user_pk)
+
+
+def _timeout():
+    return getattr(settings, 'POLLS_VOTED_CACHE_SECONDS', 24 * 60 * 60)
+
+
+def _store(user_pk, poll_pks):
+    packed = array('l', sorted(poll_pks)).tostring()
+    cache.set(voted_key(user_pk), packed, _timeout())
+
+
+def _lock(user_pk, attempts=10):
+    '''Take the lock on the cached set of `user_pk`, waiting a little if needed.'''
+    for attempt in range(attempts):
+        if cache.add(voted_key(user_pk) + ':lock', 1, LOCK_SECONDS):
+            return True
+        time.sleep(0.005)
+    return False
+
+
+def _unlock(user_pk):
+    cache.delete(voted_key(user_pk) + ':lock')
+
+
+def voted_polls(user):
+    '''Return the set of primary keys of the polls `user` voted in.'''
+    if not user.is_authenticated():
+        return set()
+    key = voted_key(user.pk)
+    packed = cache.get(key)
+    if packed is not None:
+        return set(array('l', packed))
+    recorded = cache.get(key + ':recorded')
+    poll_pks = set(Ballot.objects.filter(user=user).values_list('poll_id', flat=True))
+    poll_pks.update(ArchivedVote.objects.filter(user=user).values_list('poll_id', flat=True))
+    for alias in set([vote_alias('')] + vote_shards()):
+        poll_pks.update(Vote.objects.using(alias).filter(user=user).values_list(
+                'poll_id', flat=True))
+    if _lock(user.pk, attempts=1):
+        try:
+            # Not if a vote was recorded meanwhile: the queries may have missed it.
+            if cache.get(key + ':recorded') == recorded:
+                _store(user.pk, poll_pks)
+        finally:
+            _unlock(user.pk)
+    return poll_pks
+
+
+def record_voted(user, *poll_pks):
+    '''Add `poll_pks` to the cached set of `user`, if there is one.'''
+    key = voted_key(user.pk)
+    cache.add(key + ':recorded', 0, _timeout())
+    try:
+        cache.incr(key + ':recorded')
+    except ValueError:
+        pass  # Evicted, which voted_polls() notices as well.
+    if not _lock(user.pk):
+        # Rather than wait any longer, have the next read rebuild it.
+        cache.delete(key)
+        return
+    try:
+        packed = cache.get(key)
+        if packed is not None:
+            _store(user.pk, set(array('l', packed)) | set(poll_pks))
+    finally:
+        _unlock(user.pk)